@@ -0,0 +1,171 @@
+# Copyright 2013 Johan Rydberg.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Resolve the Ubuntu AMI to run in a region.
+
+Images are looked up by owner and name and the result is cached on
+disk, so that creating a stage does not have to talk to EC2 to find
+out what image to run.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+#: Pinned AMIs that take precedence over the looked up images.
+AMI_MAPPING = {
+    }
+
+#: Canonical's account, the owner of the official Ubuntu images.
+UBUNTU_OWNER = '099720109477'
+
+#: Name pattern of the Ubuntu images that we run.
+UBUNTU_IMAGE_NAME = 'ubuntu/images/ebs/ubuntu-precise-12.04-amd64-server-*'
+
+#: Number of seconds a resolved AMI is considered valid.
+DEFAULT_TTL = 24 * 60 * 60
+
+DEFAULT_CACHE_FILE = '~/.gilliam/ami-cache.json'
+
+
+class AmiCache(object):
+    """On-disk cache of resolved AMIs, keyed on region.
+
+    Every entry is stored together with the time it was resolved and
+    entries older than `ttl` seconds are ignored.
+    """
+
+    def __init__(self, filename=DEFAULT_CACHE_FILE, ttl=DEFAULT_TTL,
+                 clock=time.time):
+        self.filename = os.path.expanduser(filename)
+        self.ttl = ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+
+    def get(self, region):
+        """Return cached AMI for `region` or `None`."""
+        entry = self._load().get(region)
+        if entry is None:
+            return None
+        if self.clock() - entry.get('resolved_at', 0) > self.ttl:
+            return None
+        return entry.get('ami')
+
+    def set(self, region, ami):
+        self.update({region: ami})
+
+    def update(self, mapping):
+        """Store all `region -> ami` pairs in `mapping`."""
+        with self._lock:
+            entries = self._load()
+            now = self.clock()
+            for region, ami in mapping.items():
+                entries[region] = {'ami': ami, 'resolved_at': now}
+            self._save(entries)
+
+    def _load(self):
+        try:
+            with open(self.filename) as fp:
+                return json.load(fp)
+        except (EnvironmentError, ValueError):
+            return {}
+
+    def _save(self, entries):
+        dirname = os.path.dirname(self.filename)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname, 0o700)
+        # Write to a temporary file and rename it so that a concurrent
+        # reader never sees a half-written cache.
+        tmpname = '{0}.{1}'.format(self.filename, os.getpid())
+        with open(tmpname, 'w') as fp:
+            json.dump(entries, fp, indent=2, sort_keys=True)
+        os.rename(tmpname, self.filename)
+
+
+def find_image(conn):
+    """Look up the most recent Ubuntu image available through `conn`.
+
+    :returns: the image id or `None` if no image could be found.
+    """
+    images = conn.get_all_images(owners=[UBUNTU_OWNER], filters={
+            'name': UBUNTU_IMAGE_NAME,
+            'architecture': 'x86_64',
+            'root-device-type': 'ebs',
+            'state': 'available'})
+    if not images:
+        return None
+    # The image names end with the build date so the last one in
+    # lexicographical order is the most recent one.
+    return max(images, key=lambda image: image.name).id
+
+
+def resolve(conn, region, cache=None):
+    """Return the AMI to run in `region`.
+
+    Pinned images in `AMI_MAPPING` are returned as is.  Otherwise the
+    cache is consulted before asking EC2.
+
+    :raises LookupError: if no image is available in the region.
+    """
+    if region in AMI_MAPPING:
+        return AMI_MAPPING[region]
+    cache = cache if cache is not None else AmiCache()
+    ami = cache.get(region)
+    if ami is None:
+        log.debug("looking up AMI for region {0}".format(region))
+        ami = find_image(conn)
+        if ami is None:
+            raise LookupError("no AMI available in region {0}".format(region))
+        cache.set(region, ami)
+    return ami
+
+
+def warm(regions, connect, cache=None):
+    """Resolve AMIs for all `regions` concurrently and store them in
+    the cache.
+
+    :param connect: callable that given a region name returns an EC2
+        connection to that region.
+
+    :returns: a `region -> ami` mapping.  Regions without an image, or
+        where the lookup failed, are left out.
+    """
+    cache = cache if cache is not None else AmiCache()
+    resolved = {}
+
+    def lookup(region):
+        try:
+            ami = AMI_MAPPING.get(region) or find_image(connect(region))
+        except Exception:
+            log.exception("failed to look up AMI for region {0}".format(
+                    region))
+            return
+        if ami is not None:
+            resolved[region] = ami
+
+    threads = [threading.Thread(target=lookup, args=(region,))
+               for region in regions]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    cache.update(resolved)
+    return resolved
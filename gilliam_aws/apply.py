@@ -0,0 +1,267 @@
+# Copyright 2013 Johan Rydberg.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Create several stages at once from a manifest.
+
+A manifest is a YAML file with the stages to create and the options
+to create them with, the same options as `gilliam aws create` takes::
+
+    defaults:
+      region: eu-west-1
+      instance-type: executor=c3.xlarge,sr=m1.small
+    stages:
+      team-a:
+        executors: 3
+      team-b: {}
+
+All stages are created by one process, so that they share the EC2 API
+rate limits of their region, the AMI of a region is only resolved
+once, and the nodes of all stages are configured by one pool of at
+most `parallel` workers.
+
+A stage that fails is left as far as it got; its stage config is
+still written so that it can be removed with `gilliam aws destroy`.
+"""
+
+import collections
+import logging
+import os
+import sys
+import threading
+
+from . import services
+from .ec2 import KEY_DIR, AmazonWebServicesStage
+
+
+log = logging.getLogger(__name__)
+
+
+def load_manifest(path):
+    """Read the manifest at `path`.
+
+    :returns: an ordered `stage name -> options` mapping, where the
+        options of every stage include the defaults.
+    :raises ValueError: if the manifest cannot be read or understood.
+    """
+    import yaml
+    try:
+        with open(path) as fp:
+            manifest = yaml.safe_load(fp) or {}
+    except (EnvironmentError, yaml.YAMLError), e:
+        raise ValueError("cannot read manifest {0}: {1}".format(path, e))
+    defaults = manifest.get('defaults') or {}
+    stages = manifest.get('stages')
+    if not isinstance(stages, dict) or not stages:
+        raise ValueError("manifest {0} lists no stages".format(path))
+    plan = collections.OrderedDict()
+    for name in sorted(stages):
+        options = dict(defaults)
+        options.update(stages[name] or {})
+        plan[name] = options
+    return plan
+
+
+def create_args(name, options):
+    """Turn the manifest `options` of stage `name` into `gilliam aws
+    create` arguments.
+    """
+    args = [name]
+    for option, value in sorted(options.items()):
+        flag = '--' + option.replace('_', '-')
+        if value is True:
+            args.append(flag)
+        elif value is not None and value is not False:
+            args.extend([flag, str(value)])
+    return args
+
+
+class Target(object):
+    """A stage to create and how far it has come."""
+
+    __slots__ = ('name', 'config', 'conn', 'bootstrap_tag', 'stage',
+                 'configure', 'benchmarks', 'error')
+
+    def __init__(self, name, config, conn, bootstrap_tag):
+        self.name = name
+        self.config = config
+        self.conn = conn
+        self.bootstrap_tag = bootstrap_tag
+        self.stage = None
+        self.configure = None
+        self.benchmarks = {}
+        self.error = None
+
+
+class Progress(object):
+    """Combined progress view of all stages: one line listing the
+    stages in every phase, written whenever a stage moves on.
+    """
+
+    PHASES = ('pending', 'launching', 'configuring', 'bootstrapping',
+              'done', 'failed')
+
+    def __init__(self, names, stream=sys.stderr):
+        self.stream = stream
+        self.phases = dict((name, 'pending') for name in names)
+        self._lock = threading.Lock()
+
+    def update(self, name, phase):
+        with self._lock:
+            self.phases[name] = phase
+            self.stream.write(self.format() + '\n')
+            self.stream.flush()
+
+    def format(self):
+        parts = []
+        for phase in self.PHASES:
+            names = sorted(name for name, current in self.phases.items()
+                           if current == phase)
+            if names:
+                parts.append('{0}: {1}'.format(phase, ' '.join(names)))
+        return ' | '.join(parts)
+
+
+def _fail(target, error, progress):
+    log.error("{0}: {1}".format(target.name, error))
+    target.error = str(error)
+    progress.update(target.name, 'failed')
+
+
+def launch(targets, progress, parallel=10):
+    """Launch the instances of all `targets`, at most `parallel`
+    stages at a time, without waiting for status checks.
+    """
+    from .configure import Configure
+
+    # Every stage makes a key pair of its own; make sure they do not
+    # race to create the directory they are stored in.
+    if not os.path.isdir(KEY_DIR):
+        os.makedirs(KEY_DIR, 0700)
+
+    budget = threading.Semaphore(parallel)
+
+    def run(target):
+        with budget:
+            progress.update(target.name, 'launching')
+            try:
+                target.stage = AmazonWebServicesStage.create(
+                    target.conn, target.config, target.name,
+                    wait_for_status_checks=False)
+            except Exception, e:
+                _fail(target, e, progress)
+                return
+            target.configure = Configure(target.stage.username,
+                                         target.stage.ssh_key_file)
+
+    threads = [threading.Thread(target=run, args=(target,))
+               for target in targets]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def _provision(host, hosts, timeout):
+    """Configure `host` once it answers over SSH.  Runs in a worker
+    process.
+
+    :returns: a `(disk benchmark, error)` tuple.
+    """
+    from .configure import wait_for_ssh
+    stage, configure = hosts[host]
+    node = [node for node in stage.nodes if node.public_dns_name == host][0]
+    try:
+        wait_for_ssh(host, timeout)
+        return services.configure_node(stage, node, configure), None
+    except (Exception, SystemExit), e:
+        return None, str(e)
+
+
+def _bootstrap(host, hosts, tags):
+    """Bootstrap the stage of `host` from it.  Runs in a worker
+    process.
+
+    :returns: `None` or the error that made the bootstrap fail.
+    """
+    stage, configure = hosts[host]
+    try:
+        services.bootstrap(host, stage, configure, tags[host])
+    except (Exception, SystemExit), e:
+        return str(e)
+
+
+def _pool(targets):
+    """Return a :class:`gilliam_aws.configure.Configure` to run the
+    worker pool with.  Workers connect to every host with the key of
+    its own stage, so any stage will do.
+    """
+    return targets[0].configure
+
+
+def configure(targets, progress, parallel=10, timeout=600):
+    """Configure the nodes of all `targets` with one pool of at most
+    `parallel` workers.  A node is configured as soon as it answers
+    over SSH.
+    """
+    targets = [target for target in targets if target.error is None]
+    if not targets:
+        return
+    hosts = {}
+    for target in targets:
+        progress.update(target.name, 'configuring')
+        for node in target.stage.nodes:
+            hosts[node.public_dns_name] = (target.stage, target.configure)
+    results = _pool(targets).parallel(list(hosts), _provision,
+                                      (hosts, timeout), parallel=parallel)
+    for target in targets:
+        for node in target.stage.nodes:
+            benchmark, error = results[node.public_dns_name]
+            if error is not None:
+                _fail(target, "{0}: {1}".format(
+                        node.public_dns_name, error), progress)
+                break
+            target.benchmarks[node.public_dns_name] = benchmark
+
+
+def bootstrap(targets, progress, parallel=10):
+    """Bootstrap all `targets` concurrently, each from its first node."""
+    targets = [target for target in targets if target.error is None]
+    if not targets:
+        return
+    hosts, tags, by_host = {}, {}, {}
+    for target in targets:
+        progress.update(target.name, 'bootstrapping')
+        host = target.stage.nodes[0].public_dns_name
+        hosts[host] = (target.stage, target.configure)
+        tags[host] = target.bootstrap_tag
+        by_host[host] = target
+    errors = _pool(targets).parallel(list(hosts), _bootstrap, (hosts, tags),
+                                     parallel=parallel)
+    for host, target in by_host.items():
+        if errors[host] is not None:
+            _fail(target, errors[host], progress)
+        else:
+            progress.update(target.name, 'done')
+
+
+def apply(targets, parallel=10, timeout=600, progress=None):
+    """Create all `targets`.  A stage that fails does not stop the
+    others; its error is left in `Target.error`.
+    """
+    progress = progress or Progress([target.name for target in targets])
+    launch(targets, progress, parallel=parallel)
+    configure(targets, progress, parallel=parallel, timeout=timeout)
+    bootstrap(targets, progress, parallel=parallel)
+    return targets
@@ -0,0 +1,329 @@
+# Copyright 2013 Johan Rydberg.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Load driven autoscaling of the executor nodes of a stage.
+
+The :class:`Controller` periodically measures the load of every
+executor node with a probe, compares the utilization of the stage to
+the target of a :class:`Policy` and asks a scaler to add or drain
+executor nodes.  Probes and scalers are plain objects so that the
+controller can be run against fake executors.
+"""
+
+import logging
+import math
+import time
+
+from . import services
+
+
+log = logging.getLogger(__name__)
+
+
+#: Images of the containers that we run ourselves on every node.
+OWN_IMAGES = (services.SERVICE_REGISTRY_IMAGE, services.EXECUTOR_IMAGE,
+              services.PROXY_IMAGE)
+
+
+class ProbeError(Exception):
+    """The load of a node could not be measured."""
+
+
+def _repository(image):
+    return image.split(':')[0]
+
+
+def _get_json(url, timeout):
+    """Default transport of :class:`LoadProbe`."""
+    import requests
+    response = requests.get(url, timeout=timeout)
+    response.raise_for_status()
+    return response.json()
+
+
+class LoadProbe(object):
+    """Measures the load of a node as the number of containers
+    listed by an HTTP API on the node.
+
+    :param port: Port of the API.
+    :param path: Path of the resource listing containers.
+    :param exclude: Images of containers that are not counted.
+    :param transport: Callable that given a URL and a timeout returns
+        the decoded JSON response.
+    """
+
+    def __init__(self, port, path, exclude=(), timeout=5,
+                 transport=_get_json):
+        self.port = port
+        self.path = path
+        self.exclude = exclude
+        self.timeout = timeout
+        self.transport = transport
+
+    def load(self, host):
+        """Return the number of containers running on `host`.
+
+        :raises ProbeError: if the API cannot be reached.
+        """
+        url = 'http://{0}:{1}{2}'.format(host, self.port, self.path)
+        try:
+            containers = self.transport(url, self.timeout)
+        except Exception, e:
+            raise ProbeError("{0}: {1}".format(url, e))
+        return len([container for container in containers
+                    if _repository(container.get('Image', ''))
+                    not in self.exclude])
+
+
+class DockerProbe(object):
+    """Measures the load of a node as the number of containers that
+    Docker runs on it, except for our own.  The Docker API only
+    listens on the node itself, so containers are listed over SSH.
+
+    :param configure: :class:`gilliam_aws.configure.Configure` used to
+        reach the node.
+    :param command: Shell command that lists the image of every
+        running container; see
+        :func:`gilliam_aws.configure.docker_images_command`.
+    """
+
+    def __init__(self, configure, exclude=OWN_IMAGES, timeout=30,
+                 command=None):
+        self.configure = configure
+        self.exclude = exclude
+        self.timeout = timeout
+        self.command = command
+
+    def load(self, host):
+        """Return the number of containers running on `host`.
+
+        :raises ProbeError: if the node cannot be reached.
+        """
+        if self.command is None:
+            from .configure import docker_images_command
+            self.command = docker_images_command()
+        result = self.configure.run_all(
+            [host], self.command, use_sudo=True, timeout=self.timeout)[0]
+        if result.failed:
+            raise ProbeError("{0}: {1}".format(host, result.output))
+        return len([image for image in result.output.split()
+                    if _repository(image) not in self.exclude])
+
+
+#: Counts the containers managed by the executor.
+EXECUTOR_PROBE = LoadProbe(9000, '/container')
+
+
+class Policy(object):
+    """Target utilization rules.
+
+    :param capacity: Number of containers an executor node can run.
+    :param target: Utilization to aim for, between 0 and 1.
+    :param scale_up_cooldown: Seconds to wait after a scaling action
+        before adding nodes.
+    :param scale_down_cooldown: Seconds to wait after a scaling action
+        before draining a node.
+    """
+
+    def __init__(self, capacity, target=0.7, min_nodes=1, max_nodes=10,
+                 scale_up_cooldown=300, scale_down_cooldown=900):
+        self.capacity = capacity
+        self.target = target
+        self.min_nodes = min_nodes
+        self.max_nodes = max_nodes
+        self.scale_up_cooldown = scale_up_cooldown
+        self.scale_down_cooldown = scale_down_cooldown
+
+    def desired(self, load):
+        """Return the number of nodes needed to run `load` containers
+        at the target utilization.
+        """
+        nodes = int(math.ceil(load / (self.capacity * self.target)))
+        return max(self.min_nodes, min(self.max_nodes, nodes))
+
+
+class StageScaler(object):
+    """Adds and drains executor nodes of an AWS stage.
+
+    :param configure: :class:`gilliam_aws.configure.Configure` used to
+        set up new nodes and to stop the executor of drained nodes.
+    :param probe: Probe that counts the containers of the nodes
+        while one is drained.  It has to work with the executor of
+        the drained node stopped; defaults to a :class:`DockerProbe`.
+    :param pool: Optional :class:`gilliam_aws.pool.WarmPool` that new
+        nodes are taken from before any is launched.
+    """
+
+    def __init__(self, conn, stage, configure, probe=None, drain_timeout=600,
+                 pool=None, sleep=time.sleep):
+        self.conn = conn
+        self.stage = stage
+        self.configure = configure
+        self.probe = probe or DockerProbe(configure)
+        self.pool = pool
+        self.drain_timeout = drain_timeout
+        self.sleep = sleep
+
+    def nodes(self):
+        self.stage.refresh(self.conn)
+        return [node for node in self.stage.nodes_with_role('executor')
+                if node.state == 'running']
+
+    def removable(self, node):
+        """Only plain executor nodes are drained; nodes that also run
+        a service registry or router are left alone.
+        """
+        return node.roles == ('executor',)
+
+    def add(self, count):
+        if self.pool is not None:
+            while count and self.pool.take() is not None:
+                count -= 1
+        if count:
+            for node in self.stage.add_nodes(self.conn, ('exec',), count):
+                services.configure_node(self.stage, node, self.configure)
+        if self.pool is not None:
+            self.pool.top_up_in_background()
+
+    def _load(self, nodes):
+        """Return the summed load of `nodes`, or `None` if any of
+        them cannot be measured.
+        """
+        total = 0
+        for node in nodes:
+            try:
+                total += self.probe.load(node.public_dns_name)
+            except ProbeError, e:
+                log.debug("could not measure load of {0}: {1}".format(
+                        node.id, e))
+                return None
+        return total
+
+    def drain(self, node):
+        """Stop the executor on `node` so that it no longer gets any
+        work, wait for its containers to be rescheduled on the other
+        nodes and then terminate it.
+
+        Without its executor nothing removes the containers left on
+        `node`, so rather than waiting for them to go away, the other
+        nodes are watched until their load has grown by as many
+        containers as `node` had.  The containers left behind go away
+        with the instance.
+        """
+        others = [other for other in self.nodes() if other.id != node.id]
+        moving = self._load([node])
+        before = self._load(others)
+        with self.configure.enter(node.public_dns_name):
+            self.configure.docker_stop(services.EXECUTOR_IMAGE)
+        deadline = time.time() + self.drain_timeout
+        while moving != 0:
+            after = self._load(others)
+            if None not in (moving, before, after) and \
+                    after - before >= moving:
+                break
+            if time.time() >= deadline:
+                log.warning("containers of node {0} were not rescheduled "
+                            "within {1}s".format(node.id, self.drain_timeout))
+                break
+            self.sleep(10)
+        self.stage.remove_node(self.conn, node)
+
+
+class Controller(object):
+    """Decides when to scale, based on measured load.
+
+    Nodes whose load cannot be measured are assumed to be running at
+    capacity and are never drained.
+    """
+
+    def __init__(self, scaler, probe, policy, clock=time.time):
+        self.scaler = scaler
+        self.probe = probe
+        self.policy = policy
+        self.clock = clock
+        self._last_action_at = None
+
+    def measure(self, nodes):
+        """Return a `node -> load` mapping; `None` for unknown load."""
+        loads = {}
+        for node in nodes:
+            try:
+                loads[node] = self.probe.load(node.public_dns_name)
+            except ProbeError, e:
+                log.warning("could not measure load of {0}: {1}".format(
+                        node.id, e))
+                loads[node] = None
+        return loads
+
+    def _cooled_down(self, cooldown):
+        return (self._last_action_at is None
+                or self.clock() - self._last_action_at >= cooldown)
+
+    def step(self):
+        """Measure and possibly scale once.
+
+        :returns: the decision, one of `'up'`, `'down'` or `None`.
+        """
+        nodes = self.scaler.nodes()
+        loads = self.measure(nodes)
+        capacity = self.policy.capacity
+        load = sum(capacity if l is None else l for l in loads.values())
+        current = len(nodes)
+        desired = self.policy.desired(load)
+        utilization = load / float(max(current, 1) * capacity)
+        log.info("load {0} on {1} nodes ({2:.0%} utilization); "
+                 "desired {3} nodes".format(load, current, utilization,
+                                            desired))
+
+        if desired > current:
+            if not self._cooled_down(self.policy.scale_up_cooldown):
+                log.info("scale up to {0} nodes held back by cooldown".format(
+                        desired))
+                return None
+            log.info("scaling up from {0} to {1} nodes at {2:.0%} "
+                     "utilization".format(current, desired, utilization))
+            self.scaler.add(desired - current)
+            self._last_action_at = self.clock()
+            return 'up'
+
+        if desired < current:
+            if not self._cooled_down(self.policy.scale_down_cooldown):
+                log.info("scale down to {0} nodes held back by "
+                         "cooldown".format(desired))
+                return None
+            candidates = [node for node in nodes
+                          if self.scaler.removable(node)
+                          and loads[node] is not None]
+            if not candidates:
+                log.info("no node can be drained")
+                return None
+            # Drain one node at a time, the one with least to move.
+            node = min(candidates, key=lambda node: loads[node])
+            log.info("scaling down from {0} to {1} nodes at {2:.0%} "
+                     "utilization; draining {3} (load {4})".format(
+                    current, current - 1, utilization, node.id, loads[node]))
+            self.scaler.drain(node)
+            self._last_action_at = self.clock()
+            return 'down'
+
+        return None
+
+    def run(self, interval=60, sleep=time.sleep):
+        while True:
+            try:
+                self.step()
+            except Exception:
+                log.exception("autoscaling step failed")
+            sleep(interval)
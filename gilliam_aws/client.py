@@ -0,0 +1,300 @@
+# Copyright 2013 Johan Rydberg.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Rate limited and retrying access to the EC2 API.
+
+Every call is named after the API action it performs.  Calls are
+throttled per action with a token bucket, and retried with exponential
+backoff and jitter when EC2 throttles us or fails in a transient way.
+Actions that are not idempotent are only retried when throttled, since
+after a timeout or server error EC2 may well have carried them out.
+"""
+
+import atexit
+import inspect
+import logging
+import random
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+#: Error codes that tell us that the call was rejected because we
+#: made too many.
+THROTTLING_CODES = frozenset([
+    'RequestLimitExceeded',
+    'Throttling',
+    'ThrottlingException',
+    ])
+
+#: Error codes that tell us to back off and try again.
+RETRYABLE_CODES = THROTTLING_CODES | frozenset([
+    'InternalError',
+    'InternalFailure',
+    'ServiceUnavailable',
+    'Unavailable',
+    ])
+
+#: Error codes of launches that may succeed with another instance
+#: type or in another availability zone.  EC2 reports some of them
+#: as server errors, but retrying the same launch only delays moving
+#: on to the next choice.
+CAPACITY_ERROR_CODES = frozenset([
+    'InsufficientInstanceCapacity',
+    'InstanceLimitExceeded',
+    'Unsupported',
+    ])
+
+#: Actions that must not be repeated unless EC2 refused them outright.
+NON_IDEMPOTENT_ACTIONS = frozenset([
+    'run_instances',
+    'create_security_group',
+    'authorize_security_group',
+    'create_key_pair',
+    'create_placement_group',
+    ])
+
+#: Default `(rate, burst)` of calls per second for an action.
+DEFAULT_RATE = (10.0, 20)
+
+#: Per action `(rate, burst)`.  Mutating calls are cheaper to throttle
+#: than to have rejected.
+RATES = {
+    'run_instances': (2.0, 5),
+    'terminate_instances': (5.0, 10),
+    'create_security_group': (2.0, 5),
+    'authorize_security_group': (5.0, 10),
+    'create_key_pair': (1.0, 2),
+    }
+
+
+class TokenBucket(object):
+    """Token bucket that refills `rate` tokens per second up to
+    `burst` tokens.
+    """
+
+    def __init__(self, rate, burst, clock=time.time, sleep=time.sleep):
+        self.rate = float(rate)
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+        self._tokens = float(burst)
+        self._updated_at = clock()
+        self._lock = threading.Lock()
+
+    def _reserve(self):
+        """Take a token and return number of seconds to wait before
+        it may be used.
+        """
+        with self._lock:
+            now = self.clock()
+            self._tokens = min(self.burst, self._tokens
+                               + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+    def acquire(self):
+        delay = self._reserve()
+        if delay > 0:
+            self.sleep(delay)
+
+
+class ActionStats(object):
+    """Call counters and accumulated latency for one action."""
+
+    __slots__ = ('calls', 'errors', 'retries', 'latency', 'max_latency')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+
+
+def is_retryable(error, idempotent=True):
+    """Return `True` if `error` is a throttling or transient error.
+    Unless `idempotent` only throttling counts.  Capacity errors are
+    never retried.
+    """
+    code = getattr(error, 'error_code', None) or getattr(error, 'code', None)
+    if code in THROTTLING_CODES:
+        return True
+    if code in CAPACITY_ERROR_CODES:
+        return False
+    if not idempotent:
+        return False
+    if code in RETRYABLE_CODES:
+        return True
+    status = getattr(error, 'status', None)
+    if isinstance(status, int) and status >= 500:
+        return True
+    # Connection resets, timeouts and the like.
+    return isinstance(error, EnvironmentError)
+
+
+class Client(object):
+    """Wraps an EC2 connection so that every call is rate limited,
+    retried and accounted for.
+
+    Methods of the connection can be called directly on the client;
+    calls on objects returned by boto (instances, security groups)
+    should go through :meth:`call`::
+
+        client.get_all_instances()
+        client.call('terminate_instances', instance.terminate)
+
+    boto connections must not be used by several threads at once.
+    Given a `factory` that makes new connections, every thread other
+    than the one that made the client gets a connection of its own;
+    the rate limits and stats are still shared.  Objects returned by
+    boto keep using the connection that fetched them.
+    """
+
+    def __init__(self, conn, rates=RATES, max_attempts=8, base_delay=0.5,
+                 max_delay=20.0, clock=time.time, sleep=time.sleep,
+                 factory=None):
+        self.factory = factory
+        self._shared_conn = conn
+        self._local = threading.local()
+        self._local.conn = conn
+        self.rates = rates
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.clock = clock
+        self.sleep = sleep
+        self._buckets = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    @property
+    def conn(self):
+        """The connection of the calling thread."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._shared_conn
+            if self.factory is not None:
+                conn = self.factory()
+            self._local.conn = conn
+        return conn
+
+    def reset(self):
+        """Make new connections from here on.  A forked process must
+        call this before using the client, so as not to share the
+        connection of its parent.  Without a `factory` the connection
+        is kept.
+        """
+        if self.factory is not None:
+            self._local = threading.local()
+
+    def __getattr__(self, name):
+        attr = getattr(self.conn, name)
+        if not callable(attr) or inspect.isclass(attr):
+            return attr
+
+        def invoke(*args, **kwargs):
+            return self.call(name, attr, *args, **kwargs)
+        return invoke
+
+    def _bucket(self, action):
+        with self._lock:
+            bucket = self._buckets.get(action)
+            if bucket is None:
+                rate, burst = self.rates.get(action, DEFAULT_RATE)
+                bucket = self._buckets[action] = TokenBucket(
+                    rate, burst, clock=self.clock, sleep=self.sleep)
+            return bucket
+
+    def _account(self, action, latency, error=False, retry=False):
+        with self._lock:
+            stats = self._stats.get(action)
+            if stats is None:
+                stats = self._stats[action] = ActionStats()
+            stats.calls += 1
+            stats.latency += latency
+            stats.max_latency = max(stats.max_latency, latency)
+            if error:
+                stats.errors += 1
+            if retry:
+                stats.retries += 1
+
+    def _backoff(self, attempt):
+        """Full jitter: sleep a random time up to the exponential
+        ceiling of the attempt.
+        """
+        ceiling = min(self.max_delay, self.base_delay * (2 ** attempt))
+        return random.uniform(0, ceiling)
+
+    def call(self, action, fn, *args, **kwargs):
+        """Call `fn` as API action `action`."""
+        bucket = self._bucket(action)
+        idempotent = action not in NON_IDEMPOTENT_ACTIONS
+        attempt = 0
+        while True:
+            bucket.acquire()
+            start = self.clock()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception, e:
+                attempt += 1
+                retry = (is_retryable(e, idempotent)
+                         and attempt < self.max_attempts)
+                self._account(action, self.clock() - start, error=True,
+                              retry=retry)
+                if not retry:
+                    raise
+                delay = self._backoff(attempt)
+                log.debug("{0} failed ({1}); retrying in {2:.2f}s".format(
+                        action, e, delay))
+                self.sleep(delay)
+            else:
+                self._account(action, self.clock() - start)
+                return result
+
+    def stats(self):
+        """Return a `action -> ActionStats` mapping."""
+        with self._lock:
+            return dict(self._stats)
+
+    def dump_stats(self, logger=log):
+        for action, stats in sorted(self.stats().items()):
+            logger.debug(
+                "{0}: {1} calls, {2} errors, {3} retries, "
+                "{4:.3f}s avg, {5:.3f}s max".format(
+                    action, stats.calls, stats.errors, stats.retries,
+                    stats.latency / stats.calls, stats.max_latency))
+
+    def dump_stats_at_exit(self):
+        """Dump the stats of this client when the process exits."""
+        with _exit_lock:
+            if not _exit_clients:
+                atexit.register(_dump_stats_of_clients)
+            if self not in _exit_clients:
+                _exit_clients.append(self)
+
+
+#: Clients to dump stats of at exit; one handler serves them all.
+_exit_clients = []
+_exit_lock = threading.Lock()
+
+
+def _dump_stats_of_clients():
+    for client in _exit_clients:
+        client.dump_stats()
@@ -12,65 +12,331 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import argparse
 import logging
 import os
+import pipes
 import random
 import sys
 
 from gilliam_cli.command import Command, ListerCommand
 from gilliam_cli.config import StageConfig
 
-from .configure import Configure
-from .ec2 import AmazonWebServicesStage, connect
+# Modules that pull in boto or fabric must not be imported here; the
+# gilliam CLI loads these entry points on every invocation.  Import
+# them where they are needed instead.
+from . import ami, services, tuning
+from .ec2 import (ADDRESS_MODES, DEFAULT_INSTANCE_TYPE,
+                  AmazonWebServicesStage, connect, parse_data_volumes,
+                  parse_instance_types, parse_placement, parse_zones,
+                  region_names)
 
 
 log = logging.getLogger(__name__)
 
 
-_SERVICE_REGISTRY_IMAGE = 'gilliam/service-registry'
-_EXECUTOR_IMAGE = 'gilliam/executor'
-_BOOTSTRAP_IMAGE = 'gilliam/bootstrap'
-_PROXY_IMAGE = 'gilliam/proxy'
-
-
 #: Tag of bootstrap image to run.
 _DEFAULT_BOOTSTRAP_TAG = 'latest'
 
 
 def _connect(stage_config):
-    return connect(
+    conn = connect(
         stage_config.get('aws_region'),
         aws_access_key_id=stage_config.get('aws_access_key_id'),
         aws_secret_access_key=stage_config.get('aws_secret_access_key'))
+    conn.dump_stats_at_exit()
+    return conn
+
+
+def _warm_pool(conn, stage, configure):
+    """Return the warm pool of `stage` or `None` if it has none."""
+    from .pool import WarmPool
+    size = int(stage.config.get('aws_warm_pool_size') or 0)
+    if not size:
+        return None
+    return WarmPool(conn, stage, configure, size)
+
+
+def _service_registry_urls(stage):
+    """Return the service registry URLs that the CLI should use."""
+    return ['http://{0}:3222'.format(node.public_dns_name)
+            for node in stage.nodes_with_role('service-registry')]
 
 
 class Status(ListerCommand):
-    """display status about stage"""
+    """display status about stage
+
+    With `--watch` the stage is polled every `--interval` seconds and
+    nodes are printed as they change, one per line, as text or JSON
+    (`--json`).
 
-    FIELDS = ('id', 'host', 'state', 'roles', 'launched_at', 'az')
+    With `--check-tuning` every running node is checked for drift
+    from the stage's tuning profile.
+    """
+
+    FIELDS = ('id', 'host', 'state', 'roles', 'type', 'launched_at', 'az')
 
     requires = {'stage': True}
-    
+
+    def get_parser(self, prog_name):
+        parser = ListerCommand.get_parser(self, prog_name)
+        parser.add_argument('--watch', action='store_true')
+        parser.add_argument('--interval', type=int, default=5,
+                            metavar="SECONDS")
+        parser.add_argument('--json', action='store_true')
+        parser.add_argument('--check-tuning', action='store_true')
+        return parser
+
     def take_action(self, options):
         conn = _connect(self.app.config.stage_config)
+        if options.watch:
+            self._watch(conn, options)
 
         stage = AmazonWebServicesStage.get(
             conn, self.app.config.stage_config,
             self.app.config.stage
             )
 
+        drift = self._tuning_drift(stage) if options.check_tuning else None
+        fallbacks = stage.config.get('aws_ec2_fallbacks') or {}
+
         def it(stage):
             for node in stage.nodes:
-                yield (
+                row = (
                     node.id,
                     node.public_dns_name,
                     node.state,
-                    ' '.join(stage._roles(node)),
+                    ' '.join(node.roles + (('warm-pool',) if node.pooled
+                                           else ())),
+                    node.instance_type,
                     node.launch_time,
                     node.placement
                     )
+                if drift is not None:
+                    row += (drift.get(node.public_dns_name, ''),)
+                if fallbacks:
+                    row += (self._fallback(fallbacks.get(node.id)),)
+                yield row
+
+        fields = self.FIELDS + (('tuning',) if drift is not None else ())
+        fields += ('launch',) if fallbacks else ()
+        return fields, it(stage)
+
+    def _fallback(self, outcome):
+        """Describe what a node launched with fallback did not get."""
+        if not outcome:
+            return ''
+        return 'fallback from ' + ', '.join(
+            '{0}@{1} ({2})'.format(instance_type, zone or 'any', code)
+            for instance_type, zone, code in outcome['attempts'])
+
+    def _tuning_drift(self, stage):
+        """Return a `hostname -> drift summary` mapping for the
+        running nodes of the stage.
+        """
+        from .configure import Configure
+
+        profile = stage.config.get('tuning_profile') or 'none'
+        keys = tuning.sysctl_keys(profile)
+        hosts = [node.public_dns_name for node in stage.nodes
+                 if node.state == 'running']
+        if not keys:
+            return dict((host, 'ok') for host in hosts)
+        configure = Configure(stage.username, stage.ssh_key_file)
+        summary = {}
+        for result in configure.run_all(
+                hosts, 'sysctl {0}'.format(' '.join(keys))):
+            if result.return_code is None:
+                summary[result.host] = 'unreachable'
+                continue
+            drift = tuning.drift(
+                profile, tuning.parse_sysctl(result.output))
+            summary[result.host] = ('ok' if not drift else 'drift: ' +
+                                    ' '.join(key for key, _, _ in drift))
+        return summary
+
+    def _watch(self, conn, options):
+        from . import watch
+        format = watch.format_json if options.json else watch.format_text
+
+        def emit(*event):
+            sys.stdout.write(format(*event) + '\n')
+            sys.stdout.flush()
+
+        watch.watch(conn, self.app.config.stage_config,
+                    self.app.config.stage, emit, interval=options.interval)
+
+
+class Autoscale(Command):
+    """add and drain executor nodes based on load:
+
+      gilliam aws autoscale --capacity 20 --max-nodes 8
+
+    Every `--interval` seconds the number of containers on each
+    executor node is measured, through the executor API (`--probe
+    executor`) or by listing the Docker containers over SSH (`--probe
+    docker`).  The stage is scaled to run at `--target` utilization of
+    `--capacity` containers per node.  Runs until interrupted.
+    """
+
+    requires = {'stage': True}
+
+    def get_parser(self, prog_name):
+        parser = Command.get_parser(self, prog_name)
+        parser.add_argument('--capacity', type=int, required=True,
+                            metavar="CONTAINERS")
+        parser.add_argument('--target', type=float, default=0.7)
+        parser.add_argument('--min-nodes', type=int, default=1, metavar="N")
+        parser.add_argument('--max-nodes', type=int, default=10, metavar="N")
+        parser.add_argument('--probe', choices=('executor', 'docker'),
+                            default='executor')
+        parser.add_argument('--interval', type=int, default=60,
+                            metavar="SECONDS")
+        parser.add_argument('--scale-up-cooldown', type=int, default=300,
+                            metavar="SECONDS")
+        parser.add_argument('--scale-down-cooldown', type=int, default=900,
+                            metavar="SECONDS")
+        parser.add_argument('--drain-timeout', type=int, default=600,
+                            metavar="SECONDS")
+        return parser
+
+    def take_action(self, options):
+        from . import autoscale
+        from .configure import Configure
+
+        conn = _connect(self.app.config.stage_config)
+        stage = AmazonWebServicesStage.get(
+            conn, self.app.config.stage_config,
+            self.app.config.stage
+            )
+        configure = Configure(stage.username, stage.ssh_key_file)
+        probe = {'executor': autoscale.EXECUTOR_PROBE,
+                 'docker': autoscale.DockerProbe(configure)}[options.probe]
+        policy = autoscale.Policy(
+            options.capacity, target=options.target,
+            min_nodes=options.min_nodes, max_nodes=options.max_nodes,
+            scale_up_cooldown=options.scale_up_cooldown,
+            scale_down_cooldown=options.scale_down_cooldown)
+        scaler = autoscale.StageScaler(
+            conn, stage, configure,
+            drain_timeout=options.drain_timeout,
+            pool=_warm_pool(conn, stage, configure))
+        autoscale.Controller(scaler, probe, policy).run(options.interval)
+
+
+class Scale(Command):
+    """set the number of executor nodes of the stage:
+
+      gilliam aws scale 4
+
+    New nodes are taken from the warm pool when there is one (see
+    `gilliam aws pool`).  When scaling down, plain executor nodes are
+    drained and terminated; nodes that run a service registry or
+    router are kept.
+    """
+
+    requires = {'stage': True}
+
+    def get_parser(self, prog_name):
+        parser = Command.get_parser(self, prog_name)
+        parser.add_argument('executors', type=int)
+        parser.add_argument('--drain-timeout', type=int, default=600,
+                            metavar="SECONDS")
+        return parser
+
+    def take_action(self, options):
+        from . import autoscale
+        from .configure import Configure
+
+        stage_config = self.app.config.stage_config
+        conn = _connect(stage_config)
+        stage = AmazonWebServicesStage.get(
+            conn, stage_config, self.app.config.stage)
+        configure = Configure(stage.username, stage.ssh_key_file)
+        scaler = autoscale.StageScaler(
+            conn, stage, configure,
+            drain_timeout=options.drain_timeout,
+            pool=_warm_pool(conn, stage, configure))
+
+        nodes = scaler.nodes()
+        if options.executors > len(nodes):
+            scaler.add(options.executors - len(nodes))
+        else:
+            removable = [node for node in nodes if scaler.removable(node)]
+            surplus = len(nodes) - options.executors
+            if surplus > len(removable):
+                sys.exit("cannot scale below {0} executors".format(
+                        len(nodes) - len(removable)))
+            for node in removable[len(removable) - surplus:]:
+                scaler.drain(node)
+
+        stage_config.set('aws_ec2_executors', options.executors)
+        stage_config.write()
+
+
+class Pool(Command):
+    """keep a warm pool of stopped, configured executor nodes:
 
-        return self.FIELDS, it(stage)
+      gilliam aws pool --size 2
+
+    The pool is topped up to the given size right away and is then
+    topped up in the background whenever nodes are taken from it.
+    """
+
+    requires = {'stage': True}
+
+    def get_parser(self, prog_name):
+        parser = Command.get_parser(self, prog_name)
+        parser.add_argument('--size', type=int, required=True, metavar="K")
+        return parser
+
+    def take_action(self, options):
+        from .configure import Configure
+        from .pool import WarmPool
+
+        stage_config = self.app.config.stage_config
+        conn = _connect(stage_config)
+        stage = AmazonWebServicesStage.get(
+            conn, stage_config, self.app.config.stage)
+        configure = Configure(stage.username, stage.ssh_key_file)
+        stage_config.set('aws_warm_pool_size', options.size)
+        stage_config.write()
+        WarmPool(conn, stage, configure, options.size).top_up()
+
+
+class Images(ListerCommand):
+    """resolve and cache the AMIs to run in each region:
+
+      gilliam aws images [--region REGION ...]
+
+    All regions are looked up concurrently unless regions are
+    given with `--region`.  Credentials are passed the same way as
+    for `gilliam aws create`.
+    """
+
+    FIELDS = ('region', 'ami')
+
+    def get_parser(self, prog_name):
+        parser = ListerCommand.get_parser(self, prog_name)
+        parser.add_argument('--access-key-id', metavar="DATA")
+        parser.add_argument('--secret-access-key', metavar="DATA")
+        parser.add_argument('--region', action='append', dest='regions',
+                            metavar="REGION")
+        return parser
+
+    def take_action(self, options):
+        access_key_id = (options.access_key_id
+                         or os.getenv('AWS_ACCESS_KEY_ID'))
+        secret_access_key = (options.secret_access_key
+                             or os.getenv('AWS_SECRET_ACCESS_KEY'))
+
+        def _connect_region(region):
+            return connect(region, aws_access_key_id=access_key_id,
+                           aws_secret_access_key=secret_access_key)
+
+        mapping = ami.warm(options.regions or region_names(),
+                           _connect_region)
+        return self.FIELDS, sorted(mapping.items())
 
 
 class Destroy(Command):
@@ -82,7 +348,275 @@ class Destroy(Command):
             conn, self.app.config.stage_config,
             self.app.config.stage
             )
-        stage.destroy(conn)
+        if stage is not None:
+            stage.destroy(conn)
+
+
+class Stop(Command):
+    """stop all instances of the stage, to be started again with
+    `gilliam aws start`
+    """
+
+    requires = {'stage': True}
+
+    def take_action(self, options):
+        stage_config = self.app.config.stage_config
+        conn = _connect(stage_config)
+        stage = AmazonWebServicesStage.get(
+            conn, stage_config, self.app.config.stage)
+        nodes = [node for node in stage.nodes
+                 if not node.pooled and node.state in ('pending', 'running')]
+        # Remember what the containers were started with so that start
+        # can tell which of them need new addresses.
+        stage_config.set('aws_wiring', dict(
+                (node.id, services.wiring(stage, node)) for node in nodes))
+        stage_config.write()
+        log.info("stopping {0} instance(s)".format(len(nodes)))
+        stage.stop_nodes(conn, nodes, wait=True)
+
+
+class Start(Command):
+    """start a stage stopped with `gilliam aws stop`
+
+    Containers are started again as they were, except on nodes whose
+    addresses, or whose service registries' addresses, changed while
+    stopped.  Those get new containers.
+    """
+
+    requires = {'stage': True}
+
+    def take_action(self, options):
+        from .configure import Configure
+
+        stage_config = self.app.config.stage_config
+        conn = _connect(stage_config)
+        stage = AmazonWebServicesStage.get(
+            conn, stage_config, self.app.config.stage)
+        nodes = [node for node in stage.nodes
+                 if not node.pooled and node.state == 'stopped']
+        if not nodes:
+            log.info("no stopped instances to start")
+            return
+        log.info("starting {0} instance(s)".format(len(nodes)))
+        stage.start_nodes(conn, nodes)
+        # Starting rebuilds the node records with the new addresses.
+        nodes = [stage.node(node.id) for node in nodes]
+
+        wiring = stage_config.get('aws_wiring') or {}
+        configure = Configure(stage.username, stage.ssh_key_file)
+        for node in nodes:
+            rewire = wiring.get(node.id) != services.wiring(stage, node)
+            services.resume_services(stage, node, configure, rewire)
+
+        stage_config.set('service_registry', _service_registry_urls(stage))
+        stage_config.write()
+
+
+class Exec(Command):
+    """run a command on all nodes of the stage:
+
+      gilliam aws exec --role executor -- df -h /
+
+    The command is run on up to `--parallel` nodes at a time.  Output
+    and exit code of every node is printed, followed by a summary of
+    the nodes that failed and that took more than twice the median
+    time.
+
+    Arguments are quoted, so they reach the command as given.  A
+    command given as a single argument is run by the shell as is,
+    which allows for pipelines:
+
+      gilliam aws exec -- 'docker ps | wc -l'
+    """
+
+    requires = {'stage': True}
+
+    def get_parser(self, prog_name):
+        parser = Command.get_parser(self, prog_name)
+        parser.add_argument('--role', metavar="ROLE")
+        parser.add_argument('--parallel', type=int, default=10, metavar="N")
+        parser.add_argument('--timeout', type=int, metavar="SECONDS")
+        parser.add_argument('--sudo', action='store_true')
+        parser.add_argument('command', nargs=argparse.REMAINDER)
+        return parser
+
+    def take_action(self, options):
+        from .configure import Configure, stragglers
+
+        command = options.command
+        if command and command[0] == '--':
+            command = command[1:]
+        if not command:
+            sys.exit("no command given")
+
+        conn = _connect(self.app.config.stage_config)
+        stage = AmazonWebServicesStage.get(
+            conn, self.app.config.stage_config,
+            self.app.config.stage
+            )
+        nodes = (stage.nodes_with_role(options.role) if options.role
+                 else [node for node in stage.nodes if not node.pooled])
+        hosts = [node.public_dns_name for node in nodes
+                 if node.state == 'running']
+
+        if len(command) > 1:
+            command = ' '.join(pipes.quote(arg) for arg in command)
+        else:
+            command = command[0]
+        configure = Configure(stage.username, stage.ssh_key_file)
+        results = configure.run_all(hosts, command,
+                                    parallel=options.parallel,
+                                    use_sudo=options.sudo,
+                                    timeout=options.timeout)
+        for result in results:
+            sys.stdout.write('--- {0} (exit {1}, {2:.1f}s)\n'.format(
+                    result.host, result.return_code, result.elapsed))
+            if result.output:
+                sys.stdout.write(result.output.rstrip('\n') + '\n')
+
+        failed = [result for result in results if result.failed]
+        sys.stdout.write('--- {0} host(s), {1} failed\n'.format(
+                len(results), len(failed)))
+        for result in failed:
+            sys.stdout.write('failed: {0} (exit {1})\n'.format(
+                    result.host, result.return_code))
+        for result in stragglers(results):
+            sys.stdout.write('straggler: {0} ({1:.1f}s)\n'.format(
+                    result.host, result.elapsed))
+        if failed:
+            sys.exit(1)
+
+
+class Push(Command):
+    """distribute a file to all nodes of the stage:
+
+      gilliam aws push images.tar /var/lib/gilliam/images.tar
+
+    The file is uploaded to one node and then copied node-to-node over
+    the private network, doubling the number of nodes that have it
+    every round.  Nodes that already have an identical file are
+    skipped.
+    """
+
+    requires = {'stage': True}
+
+    def get_parser(self, prog_name):
+        parser = Command.get_parser(self, prog_name)
+        parser.add_argument('file')
+        parser.add_argument('dest')
+        parser.add_argument('--role', metavar="ROLE")
+        parser.add_argument('--parallel', type=int, default=10, metavar="N")
+        return parser
+
+    def take_action(self, options):
+        from .configure import Configure
+        from .push import push
+
+        conn = _connect(self.app.config.stage_config)
+        stage = AmazonWebServicesStage.get(
+            conn, self.app.config.stage_config,
+            self.app.config.stage
+            )
+        nodes = (stage.nodes_with_role(options.role) if options.role
+                 else [node for node in stage.nodes if not node.pooled])
+        nodes = [node for node in nodes if node.state == 'running']
+
+        configure = Configure(stage.username, stage.ssh_key_file)
+        skipped, done, failed = push(configure, nodes, options.file,
+                                     options.dest, parallel=options.parallel)
+        log.info("{0} node(s) updated, {1} already up to date".format(
+                len(done), len(skipped)))
+        if failed:
+            sys.exit("failed to push to {0}".format(
+                    ', '.join(node.public_dns_name for node in failed)))
+
+
+class Reconfigure(Command):
+    """bring running containers in line with the stage configuration
+
+    The containers that every node should run are derived from its
+    roles and compared to the running ones.  Only containers whose
+    image, command, environment or ports differ are replaced.  Nodes
+    are converged up to `--parallel` at a time.
+    """
+
+    requires = {'stage': True}
+
+    def get_parser(self, prog_name):
+        parser = Command.get_parser(self, prog_name)
+        parser.add_argument('--parallel', type=int, default=10, metavar="N")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="only show what would be replaced")
+        return parser
+
+    def take_action(self, options):
+        from .configure import Configure
+        from .reconfigure import reconfigure
+
+        conn = _connect(self.app.config.stage_config)
+        stage = AmazonWebServicesStage.get(
+            conn, self.app.config.stage_config,
+            self.app.config.stage
+            )
+        configure = Configure(stage.username, stage.ssh_key_file)
+        changes = reconfigure(stage, configure, parallel=options.parallel,
+                              dry_run=options.dry_run)
+        for host, replaced in sorted(changes.items()):
+            for component, reasons in replaced:
+                sys.stdout.write("{0}: {1} ({2})\n".format(
+                        host, component, ', '.join(reasons)))
+        log.info("{0} container(s) {1}".format(
+                sum(len(replaced) for replaced in changes.values()),
+                'differ' if options.dry_run else 'replaced'))
+
+
+class Upgrade(Command):
+    """roll new executor and proxy images onto the stage:
+
+      gilliam aws upgrade --image executor=1.2 --image proxy=1.2
+
+    The images are pulled on all executor nodes first.  Then the
+    containers are replaced `--batch-size` nodes at a time, waiting
+    for the health endpoints of every batch before moving on.  If a
+    batch does not become healthy all upgraded nodes are rolled back.
+    """
+
+    requires = {'stage': True}
+
+    def get_parser(self, prog_name):
+        parser = Command.get_parser(self, prog_name)
+        parser.add_argument('--image', action='append', default=[],
+                            required=True, metavar="COMPONENT=TAG")
+        parser.add_argument('--batch-size', type=int, default=1, metavar="N")
+        parser.add_argument('--health-timeout', type=int, default=120,
+                            metavar="SECONDS")
+        parser.add_argument('--parallel', type=int, default=10, metavar="N")
+        return parser
+
+    def take_action(self, options):
+        from .configure import Configure
+        from .upgrade import RollingUpgrade, UpgradeError, parse_images
+
+        try:
+            tags = parse_images(options.image)
+        except ValueError, e:
+            sys.exit(str(e))
+
+        stage_config = self.app.config.stage_config
+        conn = _connect(stage_config)
+        stage = AmazonWebServicesStage.get(
+            conn, stage_config, self.app.config.stage)
+        configure = Configure(stage.username, stage.ssh_key_file)
+        rollout = RollingUpgrade(stage, configure, tags,
+                                 batch_size=options.batch_size,
+                                 parallel=options.parallel,
+                                 health_timeout=options.health_timeout)
+        try:
+            count = rollout.run()
+        except UpgradeError, e:
+            sys.exit(str(e))
+        stage_config.write()
+        log.info("upgraded {0} node(s)".format(count))
 
 
 class Create(Command):
@@ -99,6 +633,26 @@ class Create(Command):
 
     The stage is created in the EU east region unless region is
     specified with `--region`.
+
+    `--instance-type` takes a single type, or a type per role such as
+    `executor=c3.2xlarge,sr=m1.small`.  Service registries only run on
+    nodes of their own, and get their own type, with
+    `--dedicated-service-registries`.  Nodes added later by `gilliam
+    aws scale` get the type of their role too.
+
+    When EC2 is out of capacity other types, given after the preferred
+    one as in `executor=c3.2xlarge|m3.2xlarge`, and the zones of
+    `--zones` (`[ROLE=]ZONE|ZONE,...`) are tried in order.  With
+    `--race N` N of them are launched at once and the first to
+    succeed is kept.
+
+    With `--pipelined` nodes are not waited for to pass EC2 status
+    checks; each node is configured, up to `--parallel` at a time, as
+    soon as it answers over SSH.
+
+    Before anything is launched credentials, AMI, instance quota, key
+    pair, security group limit and images are checked, all at once.
+    Use `--skip-preflight` to go ahead without the checks.
     """
 
     def get_parser(self, prog_name):
@@ -107,7 +661,27 @@ class Create(Command):
         parser.add_argument('--access-key-id', metavar="DATA")
         parser.add_argument('--secret-access-key', metavar="DATA")
         parser.add_argument('--region', default='us-east-1', metavar="REGION")
-        parser.add_argument('--instance-type', default='m1.small', metavar="TYPE")
+        parser.add_argument('--instance-type', default=DEFAULT_INSTANCE_TYPE,
+                            metavar="[ROLE=]TYPE")
+        parser.add_argument('--ami', metavar="ID")
+        parser.add_argument('--placement', metavar="cluster|spread|az=ZONE")
+        parser.add_argument('--zones', metavar="[ROLE=]ZONE[|ZONE...]")
+        parser.add_argument('--race', type=int, default=1, metavar="N")
+        parser.add_argument('--data-volume',
+                            metavar="[ROLE=]KIND[:SIZE[:IOPS]]")
+        parser.add_argument('--storage-driver', metavar="DRIVER")
+        parser.add_argument('--executors', type=int, default=1, metavar="N")
+        parser.add_argument('--service-registries', type=int, metavar="N")
+        parser.add_argument('--dedicated-service-registries',
+                            action='store_true')
+        parser.add_argument('--address-mode', default='public',
+                            choices=sorted(ADDRESS_MODES))
+        parser.add_argument('--host-network', metavar="proxy[,executor]")
+        parser.add_argument('--tuning', default='none',
+                            choices=sorted(tuning.PROFILES))
+        parser.add_argument('--pipelined', action='store_true')
+        parser.add_argument('--skip-preflight', action='store_true')
+        parser.add_argument('--parallel', type=int, default=10, metavar="N")
         parser.add_argument('--repository', metavar="NAME")
         parser.add_argument('-B', '--bootstrap-tag', metavar="TAG",
                             default=_DEFAULT_BOOTSTRAP_TAG)
@@ -120,22 +694,34 @@ class Create(Command):
         self._build_config(stage_config, options)
 
         # step 1. create resources
-        conn = _connect(stage_config)
-        stage = AmazonWebServicesStage.create(conn, stage_config,
-                                              options.name)
+        try:
+            conn = _connect(stage_config)
+        except ValueError, e:
+            sys.exit(str(e))
+        if not options.skip_preflight:
+            self._preflight(conn, stage_config, options)
+        self._resolve_image(conn, stage_config, options)
+        try:
+            stage = AmazonWebServicesStage.create(
+                conn, stage_config, options.name,
+                wait_for_status_checks=not options.pipelined)
+        except ValueError, e:
+            sys.exit(str(e))
 
         # step 2. configure resources
+        from .configure import Configure
         configure = Configure(stage.username, stage.ssh_key_file)
-        self._configure(stage, configure)
+        if options.pipelined:
+            # Every node is configured as soon as it is reachable; the
+            # only barrier is before the bootstrap.
+            benchmarks = services.configure_nodes_pipelined(
+                stage, configure, parallel=options.parallel)
+        else:
+            benchmarks = self._configure(stage, configure)
         self._bootstrap(stage, configure, options.bootstrap_tag)
 
         # step 3. update stage config
-        stage_config.set('service_registry', [
-                'http://{0}:3222'.format(hostname)
-                for (hostname, roles) in stage.iter_roles()
-                if 'service-registry' in roles])
-        if options.repository:
-            stage_config.set('repository', options.repository)
+        self._record(stage_config, stage, benchmarks, options)
 
         # stage 4. profit.
         stage_config.write()
@@ -163,81 +749,257 @@ class Create(Command):
         vars = [('aws_access_key_id', options.access_key_id, True),
                 ('aws_secret_access_key', options.secret_access_key, True),
                 ('aws_region', options.region, True),
-                ('aws_ec2_instance_type', options.instance_type, True)]
+                # Recorded now so that the pre-flight checks look at
+                # the AMI that will be launched.
+                ('aws_ec2_ami', options.ami, False),
+                ('aws_ec2_instance_type', options.instance_type, True),
+                ('aws_ec2_placement', options.placement, False),
+                ('aws_ec2_zones', options.zones, False),
+                ('aws_ec2_launch_race', options.race, False),
+                ('aws_ec2_data_volumes', options.data_volume, False),
+                ('docker_storage_driver', options.storage_driver, False),
+                ('aws_address_mode', options.address_mode, True),
+                ('tuning_profile', options.tuning, True),
+                ('docker_host_network', options.host_network, False),
+                ('aws_ec2_executors', options.executors, True),
+                ('aws_ec2_service_registries', options.service_registries,
+                 False),
+                ('aws_ec2_dedicated_service_registries',
+                 options.dedicated_service_registries, False)]
         for (var, value, required) in vars:
             if required and not value:
                 sys.exit("config var %s is required" % (var,))
             stage_config.set(var, value)
-
-    def _executor_name(self, node):
-        return node.split('.')[0]
+        for component in (options.host_network or '').split(','):
+            if component and component not in services.HOST_NETWORK_COMPONENTS:
+                sys.exit("{0} cannot use host networking".format(component))
+        if options.executors < 1:
+            sys.exit("a stage needs at least one executor")
+        if options.race < 1:
+            sys.exit("--race must be at least 1")
+        if options.dedicated_service_registries:
+            if (options.service_registries is not None
+                    and options.service_registries < 1):
+                sys.exit("a stage needs at least one service registry")
+        elif (options.service_registries is not None
+                and not 1 <= options.service_registries <= options.executors):
+            sys.exit("service registries must be between 1 and the "
+                     "number of executors")
+        try:
+            parse_placement(options.placement)
+            parse_data_volumes(options.data_volume)
+            parse_instance_types(options.instance_type)
+            parse_zones(options.zones)
+        except ValueError, e:
+            sys.exit(str(e))
+
+    def _preflight(self, conn, stage_config, options):
+        """Check that the stage can be created before launching
+        anything, and exit with a report of all problems if not.
+        """
+        from .preflight import Preflight
+
+        images = ['{0}:{1}'.format(services.BOOTSTRAP_IMAGE,
+                                   options.bootstrap_tag)]
+        images.extend(sorted(services.IMAGES.values()))
+        results = Preflight(conn, stage_config, options.name,
+                            images=images,
+                            repository=options.repository).run()
+        failed = [(name, error) for name, error in results.items()
+                  if error is not None]
+        for name, error in failed:
+            sys.stderr.write('{0}: {1}\n'.format(name, error))
+        if failed:
+            sys.exit("{0} of {1} pre-flight checks failed".format(
+                    len(failed), len(results)))
+
+    def _resolve_image(self, conn, stage_config, options):
+        """Decide on what AMI to run and record it in the stage config."""
+        try:
+            image_id = options.ami or ami.resolve(conn, options.region)
+        except LookupError, e:
+            sys.exit(str(e))
+        stage_config.set('aws_ec2_ami', image_id)
 
     def _configure(self, stage, configure):
         """Set up basic configuration such as installing Docker (done
         by `configure`) and install components that lives outside of
         Gilliam such as the service-registry (executor depends on it)
         and the executor (the rest of the system depends on it).
+
+        :returns: a `hostname -> disk benchmark` mapping for the Docker
+            data root of every node.
         """
-        for hostname, roles in stage.iter_roles():
-            log.debug('configuring {0}'.format(hostname))
-            with configure.configure(hostname):
-                if 'service-registry' in roles:
-                    self._start_service_registry(stage, hostname, configure)
-                if 'executor' in roles:
-                    self._start_proxy(stage, hostname, configure)
-                    self._start_executor(stage, hostname, configure)
-
-    def _start_service_registry(self, stage, host, configure):
-        service_registry_cluster = self._make_service_registry_option(stage)
-        log.debug('launching service registry')
-        options = '-n {0} -c {1}'.format(host, service_registry_cluster)
-        configure.docker_run(_SERVICE_REGISTRY_IMAGE, options, ports=['3222:3222'])
-
-    def _start_executor(self, stage, host, configure):
-        log.debug('launching executor')
-        service_registry = self._make_service_registry_option(stage)
-        options = '--host {0} --name {1}'.format(host, self._executor_name(host))
-        env = {
-            'GILLIAM_SERVICE_REGISTRY': service_registry,
-            'DOCKER': 'http://{0}:3000'.format(host)
-            }
-        configure.docker_run(_EXECUTOR_IMAGE, options, env=env, ports=['9000:9000'])
-
-    def _start_proxy(self, stage, host, configure):
-        log.debug('launching proxy')
-        service_registry = self._make_service_registry_option(stage)
-        env = {
-            'GILLIAM_SERVICE_REGISTRY': service_registry,
-            }
-        configure.docker_run(_PROXY_IMAGE, 'bin/proxy', env=env, ports=['9001:9001'])
+        benchmarks = {}
+        for node in stage.nodes:
+            benchmarks[node.public_dns_name] = services.configure_node(
+                stage, node, configure)
+        return benchmarks
 
     def _bootstrap(self, stage, configure, tag):
         """Run bootstrap script that will bring the system to life."""
-        env = {
-            # The bootstrap script need to know how to talk to the
-            # service registry; fill in the service registry
-            # environment variable so gilliam-cli knows where to pick
-            # up the information.
-            'GILLIAM_SERVICE_REGISTRY': self._make_service_registry_option(
-                stage),
-
-            # Routers need special attention since they are pinned to
-            # specific executors.  The ROUTERS variable will hold a
-            # space separated list of executor instance names that
-            # should get a dedicated router.
-            'ROUTERS': ' '.join(self._executor_name(host)
-                                for (host, roles) in stage.iter_roles()
-                                if 'router' in roles),
-            }
-
-        hostname = random.choice([h for (h, roles) in stage.iter_roles()])
-        image = '{0}:{1}'.format(_BOOTSTRAP_IMAGE, tag)
-        with configure.enter(hostname):
-            log.debug("bootstrapping from {0} using {1}".format(hostname, image))
-            configure.docker_run(image, '', env=env, detach=False)
-
-    def _make_service_registry_option(self, stage):
-        return ','.join(
-            '{0}:3222'.format(hostname)
-            for (hostname, roles) in stage.iter_roles()
-            if 'service-registry' in roles)
+        hostname = random.choice(stage.nodes).public_dns_name
+        services.bootstrap(hostname, stage, configure, tag)
+
+    def _record(self, stage_config, stage, benchmarks, options):
+        """Store what was learned while creating `stage`."""
+        stage_config.set('service_registry', _service_registry_urls(stage))
+        stage_config.set('disk_benchmark', benchmarks)
+        if options.repository:
+            stage_config.set('repository', options.repository)
+
+
+class Apply(Command):
+    """create all stages listed in a manifest:
+
+      gilliam aws apply stages.yaml
+
+    Every stage is created as by `gilliam aws create`, with the
+    options given for it in the manifest.  All stages are created at
+    once, sharing the EC2 API rate limits, and their nodes are
+    configured by one pool of at most `--parallel` workers.  A stage
+    that fails does not stop the others; its stage config is written
+    anyway so that what was launched can be removed with `gilliam aws
+    destroy`.
+    """
+
+    def get_parser(self, prog_name):
+        parser = Command.get_parser(self, prog_name)
+        parser.add_argument('manifest')
+        parser.add_argument('--parallel', type=int, default=20, metavar="N")
+        parser.add_argument('--timeout', type=int, default=600,
+                            metavar="SECONDS")
+        return parser
+
+    def take_action(self, options):
+        from . import apply
+
+        try:
+            manifest = apply.load_manifest(options.manifest)
+        except ValueError, e:
+            sys.exit(str(e))
+
+        # Check every stage before launching anything.
+        create = Create(self.app, self.app_args)
+        parser = create.get_parser('gilliam aws create')
+        stages = []
+        for name, settings in manifest.items():
+            try:
+                stage_options = parser.parse_args(
+                    apply.create_args(name, settings))
+                create._check_existing(self.app.config, stage_options)
+                stage_config = StageConfig.create(name)
+                create._check_credentials(stage_config, stage_options)
+                create._build_config(stage_config, stage_options)
+            except SystemExit, e:
+                if not isinstance(e.code, basestring):
+                    raise
+                sys.exit("{0}: {1}".format(name, e.code))
+            stages.append((stage_config, stage_options))
+
+        # Stages in the same region share a client, and with it the
+        # API rate limits; every thread gets a connection of its own.
+        # AMIs are resolved once per region.
+        connections, targets = {}, []
+        for stage_config, stage_options in stages:
+            key = (stage_options.region, stage_options.access_key_id)
+            try:
+                if key not in connections:
+                    connections[key] = _connect(stage_config)
+                if not stage_options.skip_preflight:
+                    create._preflight(connections[key], stage_config,
+                                      stage_options)
+            except (ValueError, SystemExit), e:
+                sys.exit("{0}: {1}".format(
+                        stage_options.name, getattr(e, 'code', e)))
+            create._resolve_image(connections[key], stage_config,
+                                  stage_options)
+            targets.append(apply.Target(
+                    stage_options.name, stage_config, connections[key],
+                    stage_options.bootstrap_tag))
+
+        apply.apply(targets, parallel=options.parallel,
+                    timeout=options.timeout)
+
+        failed = []
+        for target, (stage_config, stage_options) in zip(targets, stages):
+            if target.error is not None:
+                failed.append(target.name)
+            if target.stage is not None:
+                create._record(stage_config, target.stage,
+                               target.benchmarks, stage_options)
+            # Failed stages are recorded too, so that whatever they
+            # launched can be destroyed.
+            stage_config.write()
+        if failed:
+            sys.exit("failed to create {0}; remove what was launched with "
+                     "`gilliam aws destroy`".format(', '.join(failed)))
+
+
+class NetCheck(ListerCommand):
+    """measure latency and throughput between the nodes of the stage
+
+    Every pair of nodes is measured in both directions, as many pairs
+    at a time as possible without a node taking part in two
+    measurements at once.
+    Pairs slower than `--max-latency` milliseconds or `--min-throughput`
+    Mbit/s are flagged; a baseline given this way is kept for later
+    runs.  Without a baseline pairs are compared to the median of the
+    stage.  The measurements are kept in the stage config.
+    """
+
+    FIELDS = ('source', 'target', 'latency', 'throughput', 'flag')
+
+    requires = {'stage': True}
+
+    def get_parser(self, prog_name):
+        parser = ListerCommand.get_parser(self, prog_name)
+        parser.add_argument('--max-latency', type=float, metavar="MS")
+        parser.add_argument('--min-throughput', type=float, metavar="MBPS")
+        parser.add_argument('--duration', type=int, default=5,
+                            metavar="SECONDS")
+        parser.add_argument('--parallel', type=int, default=10, metavar="N")
+        return parser
+
+    def take_action(self, options):
+        from . import netcheck
+        from .configure import Configure
+
+        stage_config = self.app.config.stage_config
+        conn = _connect(stage_config)
+        stage = AmazonWebServicesStage.get(
+            conn, stage_config, self.app.config.stage)
+        nodes = [node for node in stage.nodes
+                 if not node.pooled and node.state == 'running']
+        if len(nodes) < 2:
+            sys.exit("need at least two running nodes")
+
+        baseline = dict(stage_config.get('netcheck_baseline') or {})
+        if options.max_latency is not None:
+            baseline['max_latency'] = options.max_latency
+        if options.min_throughput is not None:
+            baseline['min_throughput'] = options.min_throughput
+
+        configure = Configure(stage.username, stage.ssh_key_file)
+        transport = netcheck.DockerTransport(
+            stage, configure, duration=options.duration,
+            parallel=options.parallel)
+        matrix = netcheck.measure(nodes, transport)
+        flags = dict(((source, target), reason) for source, target, reason
+                     in netcheck.outliers(matrix, **baseline))
+
+        netcheck.record(stage_config, matrix)
+        stage_config.set('netcheck_baseline', baseline)
+        stage_config.write()
+
+        def _format(value, fmt):
+            return fmt.format(value) if value is not None else '-'
+
+        rows = []
+        for source, row in sorted(matrix.items()):
+            for target, cell in sorted(row.items()):
+                rows.append((source, target,
+                             _format(cell['latency'], '{0:.2f}ms'),
+                             _format(cell['throughput'], '{0:.0f}Mbit/s'),
+                             flags.get((source, target), '')))
+        return self.FIELDS, rows
@@ -13,53 +13,361 @@
 # limitations under the License.
 
 import contextlib
+import json
 import logging
 import os
+import posixpath
+import socket
+import StringIO
+import time
 
-from fabric.api import sudo, settings, hide
+from fabric.api import env, execute, put, run, sudo, settings, hide
 from fabric.network import disconnect_all
 
+from . import tuning
+
 
 log = logging.getLogger(__name__)
 
 
+class DockerStorage(object):
+    """Describes how Docker stores its data on a host.
+
+    :param driver: Storage driver to run Docker with, or `None` for
+        Docker's default (aufs).
+    :param device: Block device to format and mount as the Docker data
+        root, or `None` to keep the data on the root volume.
+    """
+
+    DATA_ROOT = '/mnt/docker'
+
+    def __init__(self, driver=None, device=None):
+        self.driver = driver
+        self.device = device
+
+    @property
+    def root(self):
+        return self.DATA_ROOT if self.device else '/var/lib/docker'
+
+    def daemon_options(self):
+        """Return extra options for the docker daemon."""
+        options = []
+        if self.device:
+            options.extend(['-g', self.root])
+        if self.driver:
+            options.extend(['-s', self.driver])
+        return ''.join(' ' + option for option in options)
+
+
+_DOCKER = 'docker -H 127.0.0.1:3000'
+
+
+def _containers_of(image, all=False):
+    """Return a shell pipeline that lists ids of the containers of
+    `image`; all of them or only the running ones.
+    """
+    return ("{0} ps {1}| awk '{{ if (index($2, \"{2}\") == 1) "
+            "print $1 }}'".format(_DOCKER, '-a ' if all else '', image))
+
+
+def docker_images_command():
+    """Return the shell command that lists the image of every running
+    container, one per line.
+    """
+    return _DOCKER + " ps | awk 'NR > 1 { print $2 }'"
+
+
+def docker_rm_command(image):
+    """Return the shell command that force removes all containers of
+    `image`.
+    """
+    return (_containers_of(image, all=True) + ' | xargs -r ' + _DOCKER +
+            ' rm -f')
+
+
+def _dd_rate(output):
+    """Pick the rate out of the summary line that `dd` prints."""
+    return output.strip().splitlines()[-1].rsplit(',', 1)[-1].strip()
+
+
+class CommandResult(object):
+    """Outcome of running a command on a host.  `return_code` is
+    `None` if the command could not be run at all.
+    """
+
+    __slots__ = ('host', 'return_code', 'output', 'elapsed')
+
+    def __init__(self, host, return_code, output, elapsed):
+        self.host = host
+        self.return_code = return_code
+        self.output = output
+        self.elapsed = elapsed
+
+    @property
+    def failed(self):
+        return self.return_code != 0
+
+
+def stragglers(results, factor=2.0):
+    """Return the results that took more than `factor` times the
+    median time.
+    """
+    if not results:
+        return []
+    elapsed = sorted(result.elapsed for result in results)
+    median = elapsed[len(elapsed) // 2]
+    return [result for result in results
+            if result.elapsed > factor * median]
+
+
+def wait_for_ssh(host, timeout=600, port=22, interval=2):
+    """Wait until `host` accepts connections on the SSH port and
+    answers with an SSH banner.
+
+    :raises RuntimeError: if the host is not reachable within
+        `timeout` seconds.
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            sock = socket.create_connection((host, port), timeout=5)
+            try:
+                if sock.recv(64).startswith('SSH-'):
+                    return
+            finally:
+                sock.close()
+        except (socket.error, socket.timeout):
+            pass
+        time.sleep(interval)
+    raise RuntimeError("{0} not reachable over SSH within {1}s".format(
+            host, timeout))
+
+
+def _call_with_host(fn, args):
+    """Fabric task that :meth:`Configure.parallel` runs on every host."""
+    return fn(env.host_string, *args)
+
+
+def _run_command(commands, use_sudo):
+    """Fabric task that :meth:`Configure.run_each` runs on every host.
+    Returns a plain tuple since it is passed back from a worker process.
+    """
+    command = commands[env.host_string]
+    start = time.time()
+    try:
+        with hide('everything'):
+            result = (sudo if use_sudo else run)(command)
+    except (Exception, SystemExit), e:
+        return None, str(e), time.time() - start
+    return result.return_code, str(result), time.time() - start
+
+
+def docker_run_command(image, command=None, ports=None, binds=None, env=None,
+                       detach=True, open_stdin=False, tty=False, cpuset=None,
+                       cpu_shares=None, memory=None, ulimits=None,
+                       host_network=False, remove=False):
+    """Return the shell command that runs a docker container.
+
+    With `host_network` the container shares the network stack of
+    the host, and `ports` are not published since the container
+    listens on the host's ports directly.
+
+    `cpuset` pins the container to the given CPUs (`0,1`),
+    `cpu_shares` sets its relative CPU weight, `memory` limits its
+    memory (`512m`) and `ulimits` is a `name -> limit` mapping
+    (`{'nofile': '65536:65536'}`).  With `remove` the container is
+    removed when it exits.
+    """
+    options = []
+    if detach:
+        options.append('-d')
+    if open_stdin:
+        options.append('-i')
+    if tty:
+        options.append('-t')
+    if remove:
+        options.append('--rm')
+    if host_network:
+        options.extend(['--net', 'host'])
+    elif ports:
+        for port in ports:
+            options.extend(['-p', port])
+    if binds:
+        for bind in binds:
+            options.extend(['-v', bind])
+    if env:
+        for var, val in env.items():
+            options.extend(['-e', '"{0}={1}"'.format(var, val)])
+    if cpuset:
+        options.extend(['--cpuset-cpus', cpuset])
+    if cpu_shares:
+        options.extend(['--cpu-shares', str(cpu_shares)])
+    if memory:
+        options.extend(['--memory', memory])
+    if ulimits:
+        for name, limit in sorted(ulimits.items()):
+            options.extend(['--ulimit', '{0}={1}'.format(name, limit)])
+    return '{docker} run {options} {image} {command}'.format(
+        docker=_DOCKER, options=' '.join(options), image=image,
+        command=command or '')
+
+
 class Configure(object):
 
     def __init__(self, username, ssh_key_file):
         self.username = username
         self.ssh_key_file = ssh_key_file
 
-    def docker_run(self, image, command=None, ports=None, binds=None, env=None,
-                   detach=True, open_stdin=False, tty=False):
-        """Run a docker container."""
-        options = []
-        if detach:
-            options.append('-d')
-        if open_stdin:
-            options.append('-i')
-        if tty:
-            options.append('-t')
-        if ports:
-            for port in ports:
-                options.extend(['-p', port])
-        if binds:
-            for bind in binds:
-                options.extend(['-v', bind])
-        if env:
-            for var, val in env.items():
-                options.extend(['-e', '"{0}={1}"'.format(var, val)])
-        sudo('docker -H 127.0.0.1:3000 run {options} {image} {command}'.format(
-                options=' '.join(options), image=image,
-                command=command or ''))
-        
+    def docker_run(self, image, command=None, **kwargs):
+        """Run a docker container; see :func:`docker_run_command` for
+        the options.
+
+        :returns: the output of the container when not detached.
+        """
+        return sudo(docker_run_command(image, command, **kwargs))
+
+    def docker_pull(self, image):
+        """Pull `image` so that later runs do not have to."""
+        sudo('docker -H 127.0.0.1:3000 pull {0}'.format(image))
+
+    def docker_containers(self):
+        """Return `docker inspect` data of all running containers."""
+        with hide('stdout'):
+            output = sudo(_DOCKER + ' ps -q | xargs -r ' + _DOCKER +
+                          ' inspect')
+        return json.loads(output) if output.strip() else []
+
+    def docker_stop(self, image):
+        """Stop all running containers of `image`."""
+        sudo(_containers_of(image) + ' | xargs -r ' + _DOCKER + ' stop')
+
+    def docker_start(self, image):
+        """Start all stopped containers of `image` again."""
+        sudo(_containers_of(image, all=True) +
+             ' | xargs -r ' + _DOCKER + ' start')
+
+    def docker_rm(self, image):
+        """Stop and remove all containers of `image`."""
+        self.docker_stop(image)
+        sudo(_containers_of(image, all=True) + ' | xargs -r ' + _DOCKER +
+             ' rm')
+
+    def tune(self, profile):
+        """Apply and persist tuning `profile` on the current host.
+        Running this again with the same profile changes nothing.
+
+        :returns: the drift from the profile after applying it; see
+            :func:`gilliam_aws.tuning.drift`.
+        """
+        if profile == 'none':
+            return []
+        put(StringIO.StringIO(tuning.sysctl_conf(profile)),
+            tuning.SYSCTL_FILE, use_sudo=True, mode=0o644)
+        put(StringIO.StringIO(tuning.limits_conf(profile)),
+            tuning.LIMITS_FILE, use_sudo=True, mode=0o644)
+        # The conntrack settings only exist once the module is loaded;
+        # have it loaded at boot too, so that they apply after a
+        # reboot.
+        for module in tuning.modules(profile):
+            sudo('modprobe {0}'.format(module))
+            sudo('grep -qx {0} {1} || echo {0} >> {1}'.format(
+                    module, tuning.MODULES_FILE))
+        with hide('stdout'):
+            sudo('sysctl -p {0}'.format(tuning.SYSCTL_FILE))
+        return self.tuning_drift(profile)
+
+    def tuning_drift(self, profile):
+        """Return the drift of the current host from `profile`."""
+        keys = tuning.sysctl_keys(profile)
+        if not keys:
+            return []
+        with settings(hide('stdout'), warn_only=True):
+            output = sudo('sysctl {0}'.format(' '.join(keys)))
+        return tuning.drift(profile, tuning.parse_sysctl(output))
+
+    def disk_benchmark(self, path, size=256):
+        """Measure sequential write and read throughput of the disk
+        that backs `path`, bypassing the page cache.
+
+        :returns: a dict with the `write` and `read` rates as reported
+            by `dd`.
+        """
+        filename = posixpath.join(path, '.gilliam-disk-benchmark')
+        with hide('stdout'):
+            write = sudo('dd if=/dev/zero of={0} bs=1M count={1} '
+                         'oflag=direct 2>&1'.format(filename, size))
+            read = sudo('dd if={0} of=/dev/null bs=1M iflag=direct '
+                        '2>&1'.format(filename))
+        sudo('rm -f {0}'.format(filename))
+        return {'write': _dd_rate(write), 'read': _dd_rate(read)}
+
+    def run_all(self, hosts, command, parallel=10, use_sudo=False,
+                timeout=None):
+        """Run `command` on all `hosts`, at most `parallel` at a time.
+        A failing command does not stop the others.
+
+        :param timeout: seconds to let the command run on a host.
+
+        :returns: a list of :class:`CommandResult`, in the order of
+            `hosts`.
+        """
+        commands = dict((host, command) for host in hosts)
+        results = self.run_each(commands, parallel=parallel,
+                                use_sudo=use_sudo, timeout=timeout)
+        return [results[host] for host in hosts]
+
+    def run_each(self, commands, parallel=10, use_sudo=False, timeout=None):
+        """Like :meth:`run_all` but runs a command of its own on
+        every host of the `host -> command` mapping `commands`.
+
+        :returns: a `host -> CommandResult` mapping.
+        """
+        if not commands:
+            return {}
+        key_filename = os.path.expanduser(self.ssh_key_file)
+        try:
+            with settings(hide('running', 'status'),
+                          key_filename=key_filename,
+                          user=self.username,
+                          parallel=True,
+                          pool_size=parallel,
+                          warn_only=True,
+                          command_timeout=timeout):
+                results = execute(_run_command, commands, use_sudo,
+                                  hosts=list(commands))
+        finally:
+            with hide('status'):
+                disconnect_all()
+        return dict((host, CommandResult(host, *results[host]))
+                    for host in commands)
+
+    def parallel(self, hosts, fn, args=(), parallel=10):
+        """Call `fn(host, *args)` for every host, each in a worker
+        process of its own and at most `parallel` at a time.  `fn` may
+        use this object to connect to the host.
+
+        :returns: a `host -> return value` mapping.
+        """
+        key_filename = os.path.expanduser(self.ssh_key_file)
+        with settings(key_filename=key_filename,
+                      user=self.username,
+                      parallel=True,
+                      pool_size=parallel):
+            return execute(_call_with_host, fn, args, hosts=hosts)
+
+    def upload(self, local_path, remote_path):
+        """Upload `local_path` to the current host as `remote_path`."""
+        sudo('mkdir -p {0}'.format(posixpath.dirname(remote_path)))
+        put(local_path, remote_path, use_sudo=True)
+
     @contextlib.contextmanager
-    def configure(self, host):
+    def configure(self, host, storage=None):
         key_filename = os.path.expanduser(self.ssh_key_file)
         try:
             with settings(key_filename=key_filename,
                           user=self.username,
                           host_string=host):
-                self._init()
+                self._init(storage or DockerStorage())
                 yield
         finally:
             with hide('status'):
@@ -77,16 +385,50 @@ class Configure(object):
             with hide('status'):
                 disconnect_all()
 
-    def _init(self):
+    def _mount_data_volume(self, storage):
+        """Format and mount the data volume as the Docker data root.
+        Does nothing if something is already mounted there.
+        """
+        device, root = storage.device, storage.root
+        # cloud-init mounts the first ephemeral disk on /mnt; get rid
+        # of that mount and its fstab entry before formatting.
+        sudo('mountpoint -q {root} || ('
+             'umount {device}; '
+             'mkfs.ext4 -q -F {device} && '
+             'mkdir -p {root} && '
+             'mount -o noatime {device} {root})'.format(
+                device=device, root=root))
+        sudo('sed -i "\\#^{device}#d" /etc/fstab'.format(device=device))
+        sudo('echo "{device} {root} ext4 defaults,noatime,nobootwait 0 2"'
+             ' >> /etc/fstab'.format(device=device, root=root))
+
+    def remount(self, storage):
+        """Set up the data root of the current host again after its
+        instance-store volume was lost on a stop, and restart Docker
+        on it.  Docker itself is left as installed.
+        """
+        if storage.device:
+            self._mount_data_volume(storage)
+        sudo('service docker restart')
+        if storage.driver in (None, 'aufs'):
+            sudo('modprobe aufs')
+
+    def _init(self, storage):
         """Perform basic initialization of the host; installs and
         starts docker.
         """
+        if storage.device:
+            self._mount_data_volume(storage)
         sudo('curl https://get.docker.io/gpg | apt-key add -')
         sudo('echo "deb http://get.docker.io/ubuntu docker main" > /etc/apt/sources.list.d/docker.list')
         sudo('apt-get -qq update ')
         sudo('apt-get -qq install -y linux-image-extra-$(uname -r)')
         sudo('apt-get install -y lxc-docker')
         # XXX: right not we're running over HTTP to support WebSocket.
-        sudo('sed -i "s#docker -d#docker -d -H 0.0.0.0:3000#g" /etc/init/docker.conf')
+        # Only edit the daemon command line once.
+        sudo('grep -q "docker -d -H 0.0.0.0:3000" /etc/init/docker.conf || '
+             'sed -i "s#docker -d#docker -d -H 0.0.0.0:3000{0}#g" '
+             '/etc/init/docker.conf'.format(storage.daemon_options()))
         sudo('service docker restart')
-        sudo('modprobe aufs')
+        if storage.driver in (None, 'aufs'):
+            sudo('modprobe aufs')
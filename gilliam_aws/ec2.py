@@ -12,38 +12,43 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
 import logging
+import threading
 import time
 import os
 
-from boto.ec2 import connect_to_region
+from . import ami
+from .client import CAPACITY_ERROR_CODES, Client
 
 
 log = logging.getLogger(__name__)
 
 
-AMI_MAPPING = {
-    #'ap-northeast-1': 'ami-6b01666a',
-    #'ap-southeast-1': 'ami-1cdf8a4e',
-    'eu-west-1': 'ami-2adc3c5d',
-    #'sa-east-1': 'ami-ab3791b6',
-    #'us-east-1': 'ami-69d9fc00',
-    ##'us-west-1': 'ami-40aa9c05',
-    #'us-west-2': 'ami-b8b92288',
-    }
-
-
 def connect(region, **args):
     """Create a EC2 connection to a specific region.
 
-    :returns: The EC2 connection object
+    :returns: The EC2 connection object, wrapped in a rate limiting
+        and retrying :class:`gilliam_aws.client.Client` that gives
+        every thread a connection of its own.
     """
-    return connect_to_region(region, **args)
+    # boto is imported here rather than at module level so that loading
+    # the command entry points stays cheap.
+    from boto.ec2 import connect_to_region
+    conn = connect_to_region(region, **args)
+    if conn is None:
+        raise ValueError("unknown EC2 region {0}".format(region))
+    return Client(conn, factory=lambda: connect_to_region(region, **args))
 
 
-def _get_or_make_group(conn, name):
-    groups = conn.get_all_security_groups()
-    group = [g for g in groups if g.name == name]
+def region_names():
+    """Return names of all known EC2 regions."""
+    from boto.ec2 import regions
+    return [region.name for region in regions()]
+
+
+def _get_or_make_group(conn, name, existing):
+    group = [g for g in existing if g.name == name]
     if len(group) > 0:
         return group[0]
     else:
@@ -52,8 +57,11 @@ def _get_or_make_group(conn, name):
 
 
 def _create_security_groups(conn, prefix, allowed, spec):
+    # Describe the groups of this stage only, and only once.
+    existing = conn.get_all_security_groups(
+        filters={'group-name': prefix + '-*'})
     groups = {name: _get_or_make_group(
-                        conn, '{0}-{1}'.format(prefix, name))
+                        conn, '{0}-{1}'.format(prefix, name), existing)
               for name in spec.keys()}
 
     for name, rules in spec.items():
@@ -64,12 +72,18 @@ def _create_security_groups(conn, prefix, allowed, spec):
             if type(rule) in (tuple, list):
                 for allow in allowed:
                     rule = list(rule) + [allow]
-                    group.authorize(*rule)
+                    conn.call('authorize_security_group',
+                              group.authorize, *rule)
             else:
-                group.authorize(src_group=groups.get(rule))
+                conn.call('authorize_security_group',
+                          group.authorize, src_group=groups.get(rule))
     return groups
 
 
+#: Directory where the private keys of stage key pairs are stored.
+KEY_DIR = os.path.expanduser("~/.gilliam/ec2-ssh-keys")
+
+
 def _get_or_make_keypair(conn, key_dir, key_name):
     """Get or create a key pair with the given name."""
     try:
@@ -97,6 +111,284 @@ def _get_or_make_keypair(conn, key_dir, key_name):
     return key
 
 
+#: Placement strategies that can be given with `--placement`.
+PLACEMENT_STRATEGIES = ('cluster', 'spread')
+
+
+def parse_placement(value):
+    """Parse a placement specification into a `(strategy, zone)`
+    tuple.  The specification is either one of `PLACEMENT_STRATEGIES`
+    or `az=<zone>`.
+
+    :raises ValueError: if the specification is not understood.
+    """
+    if not value:
+        return None, None
+    if value.startswith('az='):
+        zone = value[len('az='):]
+        if not zone:
+            raise ValueError("no availability zone given")
+        return None, zone
+    if value not in PLACEMENT_STRATEGIES:
+        raise ValueError("unknown placement {0}".format(value))
+    return value, None
+
+
+def _get_or_make_placement_group(conn, name, strategy):
+    """Get or create placement group `name` using `strategy`.
+
+    :returns: the name of the placement group.
+    """
+    groups = conn.get_all_placement_groups()
+    group = [g for g in groups if g.name == name]
+    if group:
+        if group[0].strategy != strategy:
+            raise ValueError("placement group {0} exists with strategy "
+                             "{1}".format(name, group[0].strategy))
+    else:
+        log.info("creating placement group {0}".format(name))
+        conn.create_placement_group(name, strategy=strategy)
+    return name
+
+
+def _available_zones(conn):
+    """Return names of the available zones of the region, sorted."""
+    return sorted(zone.name for zone in conn.get_all_zones()
+                  if zone.state == 'available')
+
+
+def _spread_zones(conn, count):
+    """Return `count` zones, round-robin over the available zones."""
+    zones = _available_zones(conn)
+    return [zones[i % len(zones)] for i in range(count)]
+
+
+#: Device that data volumes are attached as.
+DATA_VOLUME_DEVICE = '/dev/sdb'
+
+#: Name of the data volume device as seen by the (Xen) guest.
+DATA_VOLUME_GUEST_DEVICE = '/dev/xvdb'
+
+#: Kinds of data volumes that can be attached to nodes.
+DATA_VOLUME_KINDS = ('ephemeral', 'io1')
+
+
+def parse_data_volumes(value):
+    """Parse a data volume specification into a `role -> (kind,
+    size, iops)` mapping.
+
+    The specification is a comma separated list of
+    `[role=]kind[:size[:iops]]` items, where kind is one of
+    `DATA_VOLUME_KINDS`.  An item without a role applies to all
+    nodes not otherwise mentioned and is stored under `None`.  Size
+    (in GiB) and IOPS only apply to provisioned-IOPS EBS volumes.
+
+    :raises ValueError: if the specification is not understood.
+    """
+    volumes = {}
+    for item in (value or '').split(','):
+        if not item:
+            continue
+        role, _, volume = item.rpartition('=')
+        role = GROUP_ROLE_MAP.get(role, role) or None
+        parts = volume.split(':')
+        kind = parts[0]
+        if kind not in DATA_VOLUME_KINDS:
+            raise ValueError("unknown data volume kind {0}".format(kind))
+        try:
+            size = int(parts[1]) if len(parts) > 1 else 100
+            iops = int(parts[2]) if len(parts) > 2 else 1000
+        except ValueError:
+            raise ValueError("bad data volume {0}".format(item))
+        volumes[role] = (kind, size, iops)
+    return volumes
+
+
+def data_volume_for(volumes, roles):
+    """Return the data volume for a node with the given `roles`, or
+    `None` if it should not have one.
+    """
+    for role in roles:
+        if role in volumes:
+            return volumes[role]
+    return volumes.get(None)
+
+
+#: Instance type of nodes whose roles are not given one.
+DEFAULT_INSTANCE_TYPE = 'm1.small'
+
+
+def _parse_alternatives(value, what):
+    """Parse a comma separated list of `[role=]choice[|choice...]`
+    items into a `role -> [choice, ...]` mapping.  An item without a
+    role applies to all nodes not otherwise mentioned and is stored
+    under `None`.
+    """
+    choices = {}
+    for item in (value or '').split(','):
+        if not item:
+            continue
+        role, _, alternatives = item.rpartition('=')
+        alternatives = alternatives.split('|')
+        if not all(alternatives):
+            raise ValueError("bad {0} {1}".format(what, item))
+        choices[GROUP_ROLE_MAP.get(role, role) or None] = alternatives
+    return choices
+
+
+def _alternatives_for(choices, roles, default):
+    """Return the choices for a node with the given `roles`.  Roles
+    are tried in order, so a node that runs an executor gets the
+    executor choices.
+    """
+    for role in roles:
+        if role in choices:
+            return choices[role]
+    return choices.get(None, default)
+
+
+def parse_instance_types(value):
+    """Parse an instance type specification into a `role -> [type,
+    ...]` mapping.
+
+    The specification is a comma separated list of `[role=]type`
+    items, for example `executor=c3.2xlarge,sr=m1.small`.  Types to
+    fall back to when EC2 is out of capacity can be given after the
+    preferred one: `executor=c3.2xlarge|m3.2xlarge`.
+
+    :raises ValueError: if the specification is not understood.
+    """
+    return _parse_alternatives(value, 'instance type')
+
+
+def instance_types_for(types, roles):
+    """Return the instance types, in order of preference, of a node
+    with the given `roles`.
+    """
+    return _alternatives_for(types, roles, [DEFAULT_INSTANCE_TYPE])
+
+
+def parse_zones(value):
+    """Parse a `[role=]zone[|zone...]` specification of the
+    availability zones to try, in order, when EC2 is out of capacity.
+
+    :raises ValueError: if the specification is not understood.
+    """
+    return _parse_alternatives(value, 'zone')
+
+
+def zones_for(zones, roles):
+    return _alternatives_for(zones, roles, [])
+
+
+def is_capacity_error(error):
+    return getattr(error, 'error_code', None) in CAPACITY_ERROR_CODES
+
+
+def launch_candidates(types, zone, zones):
+    """Return the `(instance type, zone)` combinations to try, in
+    order.  Other zones are tried before other types; a zone of
+    `None` lets EC2 pick one.
+    """
+    zones = ([zone] if zone else []) + [z for z in zones if z != zone]
+    return [(instance_type, zone) for instance_type in types
+            for zone in zones or [None]]
+
+
+def _race(launch, candidates):
+    """Launch all `candidates` at once, each from a thread of its
+    own.  `launch` should use a client made by :func:`connect`, which
+    gives every thread a connection of its own.
+
+    :returns: a `(launched, failed)` tuple: `(candidate, instances)`
+        in the order the launches succeeded, and `(candidate, error)`.
+    """
+    launched, failed = [], []
+    lock = threading.Lock()
+
+    def run(candidate):
+        try:
+            instances = launch(*candidate)
+        except Exception, e:
+            with lock:
+                failed.append((candidate, e))
+        else:
+            with lock:
+                launched.append((candidate, instances))
+
+    if len(candidates) == 1:
+        run(candidates[0])
+    else:
+        threads = [threading.Thread(target=run, args=(candidate,))
+                   for candidate in candidates]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return launched, failed
+
+
+def launch_with_fallback(conn, launch, candidates, race=1):
+    """Call `launch(instance_type, zone)` with the `candidates` in
+    order until one succeeds, moving on only on capacity errors.
+
+    With `race` greater than one that many candidates are launched at
+    once.  The first launch to succeed is kept and the instances of
+    the others are terminated.
+
+    Whatever happens, the winner is kept and the surplus is
+    terminated before an error is raised.  Errors other than capacity
+    errors are only raised when nothing could be launched.
+
+    :returns: a `(instances, outcome)` tuple; the outcome records
+        what was launched and the attempts that failed before.
+    """
+    attempts, error = [], None
+    for i in range(0, len(candidates), max(1, race)):
+        launched, failed = _race(launch, candidates[i:i + max(1, race)])
+        # Deal with what was launched before anything is raised, so
+        # that no instances are left behind.
+        for candidate, surplus in launched[1:]:
+            log.info("terminating surplus {0} instance(s)".format(
+                    candidate[0]))
+            conn.terminate_instances([instance.id for instance in surplus])
+        for (instance_type, zone), e in failed:
+            log.info("could not launch {0} in {1}: {2}".format(
+                    instance_type, zone or 'any zone',
+                    getattr(e, 'error_code', e)))
+            attempts.append([instance_type, zone,
+                             getattr(e, 'error_code', str(e))])
+        if launched:
+            (instance_type, zone), instances = launched[0]
+            return instances, {'instance_type': instance_type, 'zone': zone,
+                               'attempts': attempts}
+        for _, e in failed:
+            if not is_capacity_error(e):
+                raise e
+            error = e
+    raise error
+
+
+def _block_device_map(volume):
+    """Return a block device mapping that attaches `volume` as
+    `DATA_VOLUME_DEVICE`.
+    """
+    if volume is None:
+        return None
+    from boto.ec2.blockdevicemapping import (BlockDeviceMapping,
+                                             BlockDeviceType)
+    kind, size, iops = volume
+    mapping = BlockDeviceMapping()
+    if kind == 'ephemeral':
+        mapping[DATA_VOLUME_DEVICE] = BlockDeviceType(
+            ephemeral_name='ephemeral0')
+    else:
+        mapping[DATA_VOLUME_DEVICE] = BlockDeviceType(
+            size=size, volume_type='io1', iops=iops,
+            delete_on_termination=True)
+    return mapping
+
+
 def _wait_for_system_and_instance_status_checks(conn, instances):
     """Wait for the given instances to pass system and instance status
     checks.
@@ -114,37 +406,196 @@ def _wait_for_system_and_instance_status_checks(conn, instances):
         time.sleep(5)
 
 
+def _update_instances(conn, instances):
+    """Update `instances` in place with a single describe call."""
+    if not instances:
+        return
+    updated = {}
+    for reservation in conn.get_all_instances(
+            instance_ids=[i.id for i in instances]):
+        for instance in reservation.instances:
+            updated[instance.id] = instance
+    for i in instances:
+        if i.id in updated:
+            i._update(updated[i.id])
+
+
 def _wait_for_instances_to_become_running(conn, instances):
     """Wait for given instances to become running."""
     while True:
-        for i in instances:
-            i.update()
+        _update_instances(conn, instances)
         if len([i for i in instances if i.state == 'pending']) > 0:
             time.sleep(5)
         else:
             break
 
+
+def _wait_for_instances_to_stop(conn, instances):
+    """Wait for given instances to become stopped."""
+    while True:
+        _update_instances(conn, instances)
+        if len([i for i in instances if i.state == 'stopping']) > 0:
+            time.sleep(5)
+        else:
+            break
+
 def _wait_for_instances(conn, instances):
     """Wait for instances to become fully ready."""
     _wait_for_instances_to_become_running(conn, instances)
     _wait_for_system_and_instance_status_checks(conn, instances)
 
 
-def _reserve_instances(conn, config, security_groups, key_name):
-    """Create instances based on the given configuration.  This
-    implementation creates a single instance that has provides every
-    role.
+def service_registry_count(executors):
+    """Return the number of service registry replicas to run in a
+    stage with `executors` executor nodes.  The count is kept odd so
+    that the registry cluster can always form a majority.
+    """
+    if executors < 3:
+        return 1
+    elif executors < 10:
+        return 3
+    return 5
+
+
+def plan_nodes(executors, service_registries, dedicated=False):
+    """Return the security group names of every node in a stage.
+
+    The service registry replicas run on the first executor nodes, or
+    with `dedicated` on nodes of their own.  The first executor node
+    is also the router.
+    """
+    nodes = []
+    for i in range(executors):
+        groups = ['exec']
+        if i < service_registries and not dedicated:
+            groups.append('sr')
+        if i == 0:
+            groups.append('router')
+        nodes.append(tuple(sorted(groups)))
+    if dedicated:
+        nodes.extend([('sr',)] * service_registries)
+    return nodes
+
+
+def planned_nodes(config):
+    """Return the security group names of every node of a stage with
+    configuration `config`; see :func:`plan_nodes`.
+    """
+    executors = int(config.get('aws_ec2_executors') or 1)
+    registries = int(config.get('aws_ec2_service_registries')
+                     or service_registry_count(executors))
+    dedicated = bool(config.get('aws_ec2_dedicated_service_registries'))
+    return plan_nodes(executors, registries, dedicated)
+
+
+def _placement_group(conn, config, name):
+    """Return the placement group that instances of stage `name`
+    should be launched in, or `None`.
+    """
+    strategy, zone = parse_placement(config.get('aws_ec2_placement'))
+    if strategy is None:
+        return None
+    return _get_or_make_placement_group(
+        conn, '{0}-{1}'.format(name, strategy), strategy)
+
+
+def _launch_instances(conn, config, name, groups, count, zone=None):
+    """Launch `count` instances for stage `name` that are members of
+    the given security `groups` (without the stage prefix).
+
+    When EC2 is out of capacity the instance types and zones of the
+    `aws_ec2_instance_type` and `aws_ec2_zones` config vars are tried
+    in order; see :func:`launch_with_fallback`.  Instances in a
+    cluster placement group stay in its zone.
+
+    :returns: A list of :class:`boto.ec2.instance.Instance`.
+    """
+    image_id = config.get('aws_ec2_ami') or ami.resolve(
+        conn, config.get('aws_region'))
+    roles = [GROUP_ROLE_MAP.get(group, group) for group in groups]
+    volume = data_volume_for(
+        parse_data_volumes(config.get('aws_ec2_data_volumes')), roles)
+    types = instance_types_for(
+        parse_instance_types(config.get('aws_ec2_instance_type')), roles)
+    zones = zones_for(parse_zones(config.get('aws_ec2_zones')), roles)
+    placement_group = _placement_group(conn, config, name)
+    strategy, _ = parse_placement(config.get('aws_ec2_placement'))
+    if strategy == 'cluster' and zones:
+        # A cluster placement group lives in a single zone; only fall
+        # back to other instance types.
+        log.debug("not falling back to other zones in placement "
+                  "group {0}".format(placement_group))
+        zones = []
+
+    def launch(instance_type, zone):
+        reservation = conn.run_instances(
+            image_id,
+            key_name=name,
+            security_groups=['{0}-{1}'.format(name, group)
+                             for group in groups],
+            instance_type=instance_type,
+            placement=zone,
+            placement_group=placement_group,
+            block_device_map=_block_device_map(volume),
+            min_count=count,
+            max_count=count)
+        return reservation.instances
+
+    instances, outcome = launch_with_fallback(
+        conn, launch, launch_candidates(types, zone, zones),
+        race=int(config.get('aws_ec2_launch_race') or 1))
+    if outcome['attempts']:
+        # Remember that these did not get what was asked for, so that
+        # status can tell.
+        fallbacks = dict(config.get('aws_ec2_fallbacks') or {})
+        for instance in instances:
+            fallbacks[instance.id] = outcome
+        config.set('aws_ec2_fallbacks', fallbacks)
+    return instances
+
+
+def _reserve_instances(conn, config, name):
+    """Create instances based on the given configuration.
+
+    The `aws_ec2_executors` and `aws_ec2_service_registries` config
+    vars decide how many nodes to launch and how many of them that
+    run a service registry replica, on executor nodes or, with
+    `aws_ec2_dedicated_service_registries`, on nodes of their own;
+    see :func:`plan_nodes`.  Nodes with the same groups and zone are
+    launched together, with the instance type of their roles as given
+    by the `aws_ec2_instance_type` config var; see
+    :func:`parse_instance_types`.
 
-    :returns: The :class:`boto.ec2.instance.Reservation`.
+    The `aws_ec2_placement` config var controls where instances are
+    placed; see :func:`parse_placement`.  Placement groups are named
+    after the stage and reused if they already exist.  With the
+    spread strategy, service registry nodes are distributed over the
+    available zones.
+
+    :returns: A list of :class:`boto.ec2.instance.Instance`.
     """
-    ami = AMI_MAPPING[config.get('aws_region')]
-    image = conn.get_all_images(image_ids=[ami])[0]
-    return image.run(
-        key_name=key_name,
-        security_groups=security_groups.values(),
-        instance_type=config.get('aws_ec2_instance_type'),
-        min_count=1,
-        max_count=1)
+    strategy, zone = parse_placement(config.get('aws_ec2_placement'))
+    nodes = planned_nodes(config)
+
+    if strategy == 'spread':
+        registry_zones = iter(_spread_zones(
+                conn, len([groups for groups in nodes if 'sr' in groups])))
+    else:
+        registry_zones = None
+
+    launches = collections.OrderedDict()
+    for groups in nodes:
+        if registry_zones is not None and 'sr' in groups:
+            key = (groups, next(registry_zones))
+        else:
+            key = (groups, zone)
+        launches[key] = launches.get(key, 0) + 1
+
+    instances = []
+    for (groups, zone), count in launches.items():
+        instances.extend(_launch_instances(
+                conn, config, name, groups, count, zone))
+    return instances
 
 
 def _collect_instances(conn, name):
@@ -152,12 +603,13 @@ def _collect_instances(conn, name):
     belong to that stage.  Will only collect active instances.
     """
     instances = []
-    for reservation in conn.get_all_instances():
+    # Let EC2 do the filtering so that only our instances are described.
+    for reservation in conn.get_all_instances(
+            filters={'group-name': name + '-*'}):
         group_names = [g.name for g in reservation.groups]
         if any([group_name.startswith(name + '-') for group_name in group_names]):
             instances.extend(
-                i for i in reservation.instances)
-                #if is_active(i))
+                i for i in reservation.instances if is_active(i))
     return instances
 
 
@@ -168,44 +620,162 @@ def is_active(instance):
     return (instance.state in ['pending', 'running', 'stopping', 'stopped'])
 
 
+#: How nodes address each other: over their public DNS names, private
+#: IP addresses or private DNS names.
+ADDRESS_MODES = {
+    'public': 'public_dns_name',
+    'private-ip': 'private_ip_address',
+    'private-dns': 'private_dns_name',
+    }
+
+
+#: Number of vCPUs and MiB of memory of the instance types we know of.
+INSTANCE_TYPE_RESOURCES = {
+    't1.micro': (1, 613),
+    'm1.small': (1, 1740),
+    'm1.medium': (1, 3840),
+    'm1.large': (2, 7680),
+    'm1.xlarge': (4, 15360),
+    'm3.medium': (1, 3840),
+    'm3.large': (2, 7680),
+    'm3.xlarge': (4, 15360),
+    'm3.2xlarge': (8, 30720),
+    'c1.medium': (2, 1740),
+    'c1.xlarge': (8, 7168),
+    'c3.large': (2, 3840),
+    'c3.xlarge': (4, 7680),
+    'c3.2xlarge': (8, 15360),
+    'c3.4xlarge': (16, 30720),
+    'c3.8xlarge': (32, 61440),
+    'm2.xlarge': (2, 17510),
+    'm2.2xlarge': (4, 35020),
+    'm2.4xlarge': (8, 70041),
+    }
+
+
+#: Tag that marks instances that are kept in the warm pool.
+WARM_POOL_TAG = 'gilliam:warm-pool'
+
+
+#: Maps the security group suffix to the role it stands for.
+GROUP_ROLE_MAP = {
+    'sr': 'service-registry',
+    'exec': 'executor'
+    }
+
+
+class Node(object):
+    """Compact record of a stage instance.
+
+    The interesting attributes of the :class:`boto.ec2.instance.Instance`
+    are copied once, together with the roles derived from its security
+    groups, so that the rest of the code can look at nodes without
+    going through boto.
+    """
+
+    __slots__ = ('id', 'public_dns_name', 'private_dns_name',
+                 'private_ip_address', 'state', 'placement', 'launch_time',
+                 'instance_type', 'roles', 'pooled')
+
+    def __init__(self, id, public_dns_name, private_dns_name,
+                 private_ip_address, state, placement, launch_time,
+                 instance_type, roles, pooled=False):
+        self.id = id
+        self.public_dns_name = public_dns_name
+        self.private_dns_name = private_dns_name
+        self.private_ip_address = private_ip_address
+        self.state = state
+        self.placement = placement
+        self.launch_time = launch_time
+        self.instance_type = instance_type
+        self.roles = roles
+        self.pooled = pooled
+
+    @classmethod
+    def from_instance(cls, instance, roles):
+        return cls(instance.id, instance.public_dns_name,
+                   instance.private_dns_name, instance.private_ip_address,
+                   instance.state, instance.placement, instance.launch_time,
+                   instance.instance_type, tuple(roles),
+                   WARM_POOL_TAG in instance.tags)
+
+    def __repr__(self):
+        return '<Node {0} {1} {2}>'.format(
+            self.id, self.public_dns_name, ','.join(self.roles))
+
+
 class AmazonWebServicesStage(object):
 
+    # The executor (9000) and proxy (9001) listen on the same host
+    # ports whether they run with published ports or on the host
+    # network, so the rules hold for both.
     SECURITY_GROUPS = {
         'router': [
             ('tcp', 22, 22),
             ('tcp', 8080, 8080),
             ],
         'exec': [
-            'exec', 'router',
+            'exec', 'router', 'sr',
             ('tcp', 22, 22),
             ('tcp', 9000, 9000),
             ('tcp', 49153, 65535),    # the complete Docker port range
             ],
         'sr': [
-            'exec', 'router',
+            'exec', 'router', 'sr',
+            ('tcp', 22, 22),
             ('tcp', 3222, 3222)
             ],
         }
 
 
-    def __init__(self, config, name, nodes, ssh_key_file=None):
+    def __init__(self, config, name, instances, ssh_key_file=None):
         self.config = config
         self.name = name
-        self.nodes = nodes
+        self.instances = instances
         self.username = 'ubuntu'
         self.ssh_key_file = ssh_key_file
+        self._index()
+
+    def _index(self):
+        """Build node records and the role index from the instances."""
+        self.nodes = [Node.from_instance(instance, self._roles(instance))
+                      for instance in self.instances]
+        self._nodes_by_role = {}
+        for node in self.nodes:
+            # Warm pool nodes do not take part in the stage until they
+            # are taken out of the pool.
+            if node.pooled:
+                continue
+            for role in node.roles:
+                self._nodes_by_role.setdefault(role, []).append(node)
+        self._memo = {}
+
+    def refresh(self, conn):
+        """Update instance data from EC2 and rebuild the index."""
+        _update_instances(conn, self.instances)
+        self._index()
+
+    def reload(self, conn):
+        """Collect the instances of the stage from EC2 again, as
+        :meth:`get` does, so that instances launched or re-tagged by
+        other processes are seen too.
+        """
+        self.instances = _collect_instances(conn, self.name)
+        self._index()
 
     @classmethod
     def get(cls, conn, config, name):
         """Get an existing cluster if available."""
         nodes = _collect_instances(conn, name)
         if nodes:
-            return cls(config, name, nodes)
+            return cls(config, name, nodes, ssh_key_file=os.path.join(
+                    KEY_DIR, name + '.pem'))
         else:
             return None
 
     @classmethod
-    def create(cls, conn, config, name, allowed=['0.0.0.0/0']):
+    def create(cls, conn, config, name, allowed=['0.0.0.0/0'],
+               wait_for_status_checks=True):
         """
         Create a new stage running on Amazon Web Services. The stage
         config `config` provides data needed to bootstrap the stage.
@@ -219,47 +789,147 @@ class AmazonWebServicesStage(object):
         :param name: The name of the stage.
         :type name: `str`.
 
+        :param wait_for_status_checks: Whether to wait for all
+            instances to pass status checks, or only for them to be
+            running.
+
         :returns: the created `AmazonWebServicesStage` object.
         """
         log.info("creating stage {0}".format(name))
-        # FIXME: the path should not be specified here.
-        key_name = name
-        key_dir = os.path.expanduser("~/.gilliam/ec2-ssh-keys")
-        key_pair = _get_or_make_keypair(conn, key_dir, key_name)
-        security_groups = _create_security_groups(
+        _get_or_make_keypair(conn, KEY_DIR, name)
+        _create_security_groups(
             conn, name, allowed, AmazonWebServicesStage.SECURITY_GROUPS)
-        res = _reserve_instances(conn, config, security_groups, key_name)
-        _wait_for_instances(conn, res.instances)
-        return cls(config, name, res.instances, ssh_key_file=os.path.join(
-                key_dir, name + '.pem'))
+        instances = _reserve_instances(conn, config, name)
+        if wait_for_status_checks:
+            _wait_for_instances(conn, instances)
+        else:
+            _wait_for_instances_to_become_running(conn, instances)
+        return cls(config, name, instances, ssh_key_file=os.path.join(
+                KEY_DIR, name + '.pem'))
 
     def destroy(self, conn):
         """Destroy the cluster by terminating all instances."""
-        for inst in self.nodes:
+        for inst in self.instances:
             if inst.state not in ["shutting-down", "terminated"]:
-                inst.terminate()
+                conn.call('terminate_instances', inst.terminate)
+
+    def add_nodes(self, conn, groups, count=1, zone=None):
+        """Launch `count` new nodes that are members of the security
+        `groups` and wait for them to become ready.
+
+        :returns: the new :class:`Node` records.
+        """
+        log.info("adding {0} {1} node(s) to stage {2}".format(
+                count, '+'.join(groups), self.name))
+        instances = _launch_instances(conn, self.config, self.name, groups,
+                                      count, zone)
+        _wait_for_instances(conn, instances)
+        self.instances.extend(instances)
+        self._index()
+        ids = set(instance.id for instance in instances)
+        return [node for node in self.nodes if node.id in ids]
+
+    def remove_node(self, conn, node):
+        """Terminate the instance behind `node`."""
+        log.info("removing node {0} from stage {1}".format(
+                node.id, self.name))
+        instance = self._instance(node)
+        conn.call('terminate_instances', instance.terminate)
+        self.instances.remove(instance)
+        self._index()
+
+    def start_nodes(self, conn, nodes):
+        """Start the stopped instances behind `nodes` in one batch and
+        wait for them to become ready.
+        """
+        instances = [self._instance(node) for node in nodes]
+        conn.start_instances([instance.id for instance in instances])
+        _wait_for_instances(conn, instances)
+        self._index()
+
+    def stop_nodes(self, conn, nodes, wait=False):
+        """Stop the instances behind `nodes` in one batch.
+
+        :param wait: wait for the instances to become stopped.
+        """
+        conn.stop_instances([node.id for node in nodes])
+        if wait:
+            _wait_for_instances_to_stop(
+                conn, [self._instance(node) for node in nodes])
+            self._index()
+
+    def pool_nodes(self):
+        """Return the nodes that are kept in the warm pool."""
+        return [node for node in self.nodes if node.pooled]
+
+    def node(self, id):
+        """Return the node record of instance `id`."""
+        return [node for node in self.nodes if node.id == id][0]
+
+    def _instance(self, node):
+        return [i for i in self.instances if i.id == node.id][0]
 
     def _roles(self, node):
         """From a EC2 instance try to decuce what roles it has.
 
         :type node: a :class:`boto.ec2.instance.Instance`
         """
-        group_role_map = {
-            'sr': 'service-registry',
-            'exec': 'executor'
-            }
-
         group_names = [g.name for g in node.groups]
         roles = []
         for group in group_names:
             if not group.startswith(self.name + '-'):
                 continue
             role = group[len(self.name) + 1:]
-            role = group_role_map.get(role, role)
+            role = GROUP_ROLE_MAP.get(role, role)
             roles.append(role)
         return roles
 
     def iter_roles(self):
         """Return a sequence of `(hostname, roles)` tuples."""
         for node in self.nodes:
-            yield node.public_dns_name, self._roles(node)
+            yield node.public_dns_name, node.roles
+
+    @property
+    def address_mode(self):
+        return self.config.get('aws_address_mode') or 'public'
+
+    def address(self, node):
+        """Return the address that other nodes of the stage should use
+        to reach `node`.  The CLI itself always uses the public DNS name.
+        """
+        return getattr(node, ADDRESS_MODES[self.address_mode])
+
+    def data_volume(self, node):
+        """Return the `(kind, size, iops)` data volume attached to
+        `node`, or `None`.
+        """
+        return data_volume_for(
+            parse_data_volumes(self.config.get('aws_ec2_data_volumes')),
+            node.roles)
+
+    def nodes_with_role(self, role):
+        """Return the nodes that have role `role`."""
+        return self._nodes_by_role.get(role, [])
+
+    def service_registry_cluster(self, near=None):
+        """Return the `host:port,...` connection string of the service
+        registry cluster.
+
+        If a node is given with `near`, the list is ordered by
+        locality: a replica on that node first, then replicas in the
+        same zone, then the rest.  Replicas at the same distance are
+        rotated by node so that reads are spread over the cluster.
+        """
+        key = ('service_registry_cluster', near.id if near else None)
+        if key not in self._memo:
+            nodes = self.nodes_with_role('service-registry')
+            if near is not None:
+                offset = self.nodes.index(near)
+                rank = dict((node.id, (node.id != near.id,
+                                       node.placement != near.placement,
+                                       (i - offset) % len(nodes)))
+                            for i, node in enumerate(nodes))
+                nodes = sorted(nodes, key=lambda node: rank[node.id])
+            self._memo[key] = ','.join(
+                '{0}:3222'.format(self.address(node)) for node in nodes)
+        return self._memo[key]
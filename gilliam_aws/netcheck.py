@@ -0,0 +1,280 @@
+# Copyright 2013 Johan Rydberg.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Measure latency and throughput between the nodes of a stage.
+
+Every node runs a measurement server, and every pair of nodes is
+measured in both directions, since the path from one node to another
+need not perform like the way back: round trip latency with `ping`
+and TCP throughput with `iperf3`, run in a container.  Pairs are
+measured in rounds where every node takes part in at most one
+measurement, so measurements do not compete for bandwidth, while all
+pairs of a round run at once.
+
+How a pair is measured is up to a transport: :class:`DockerTransport`
+measures real nodes over SSH, :class:`LocalTransport` measures over
+loopback and stands in for it when trying things out.
+"""
+
+import json
+import logging
+import re
+import socket
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+#: Image with `iperf3` as its entrypoint.
+NETCHECK_IMAGE = 'networkstatic/iperf3'
+
+#: Port that the measurement servers listen on.
+NETCHECK_PORT = 5201
+
+#: Number of measurements kept in the stage config.
+HISTORY = 10
+
+_RTT_RE = re.compile(r'= [\d.]+/([\d.]+)/')
+
+
+def schedule(nodes):
+    """Split all ordered pairs of `nodes` into rounds where every node
+    is in at most one pair.  The pairs are scheduled one way with the
+    circle method, and then the other way in the same rounds.
+
+    :returns: a list of rounds, each a list of `(source, target)`.
+    """
+    nodes = list(nodes)
+    if len(nodes) % 2:
+        nodes.append(None)
+    rounds = []
+    for _ in range(len(nodes) - 1):
+        half = len(nodes) // 2
+        pairs = [(nodes[i], nodes[-1 - i]) for i in range(half)]
+        rounds.append([pair for pair in pairs if None not in pair])
+        nodes = [nodes[0], nodes[-1]] + nodes[1:-1]
+    rounds = [pairs for pairs in rounds if pairs]
+    return rounds + [[(target, source) for source, target in pairs]
+                     for pairs in rounds]
+
+
+def parse_rtt(output):
+    """Return the average round trip time, in milliseconds, from the
+    summary of `ping -q`, or `None`.
+    """
+    match = _RTT_RE.search(output or '')
+    return float(match.group(1)) if match else None
+
+
+def parse_iperf(output):
+    """Return the received throughput, in Mbit/s, from the JSON report
+    of `iperf3 -J`, or `None`.
+    """
+    try:
+        report = json.loads(output[output.index('{'):])
+        return report['end']['sum_received']['bits_per_second'] / 1e6
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+class DockerTransport(object):
+    """Measures the nodes of `stage` over SSH, with the measurement
+    servers and clients running in containers on the host network.
+    """
+
+    def __init__(self, stage, configure, duration=5, parallel=10):
+        self.stage = stage
+        self.configure = configure
+        self.duration = duration
+        self.parallel = parallel
+
+    def _run(self, commands):
+        return self.configure.run_each(commands, parallel=self.parallel,
+                                       use_sudo=True)
+
+    def start(self, nodes):
+        from .configure import docker_run_command
+        self._run(dict(
+                (node.public_dns_name, docker_run_command(
+                        NETCHECK_IMAGE, '-s -p {0}'.format(NETCHECK_PORT),
+                        host_network=True))
+                for node in nodes))
+
+    def stop(self, nodes):
+        from .configure import docker_rm_command
+        self._run(dict((node.public_dns_name,
+                        docker_rm_command(NETCHECK_IMAGE))
+                       for node in nodes))
+
+    def measure(self, pairs):
+        """Measure all `pairs` at once.
+
+        :returns: a `(source, target) -> (latency, throughput)`
+            mapping; values that could not be measured are `None`.
+        """
+        from .configure import docker_run_command
+        latency = self._run(dict(
+                (source.public_dns_name, 'ping -c 5 -q {0}'.format(
+                        self.stage.address(target)))
+                for source, target in pairs))
+        throughput = self._run(dict(
+                (source.public_dns_name, docker_run_command(
+                        NETCHECK_IMAGE, '-c {0} -p {1} -t {2} -J'.format(
+                            self.stage.address(target), NETCHECK_PORT,
+                            self.duration),
+                        detach=False, remove=True, host_network=True))
+                for source, target in pairs))
+        results = {}
+        for source, target in pairs:
+            host = source.public_dns_name
+            results[source, target] = (parse_rtt(latency[host].output),
+                                       parse_iperf(throughput[host].output))
+        return results
+
+
+class LocalTransport(object):
+    """Measures over loopback with in-process servers.  Nodes only
+    need an `id`.
+    """
+
+    def __init__(self, payload=8 << 20):
+        self.payload = payload
+        self._servers = {}
+
+    def _serve(self, sock):
+        while True:
+            try:
+                conn, _ = sock.accept()
+            except socket.error:
+                return
+            try:
+                while True:
+                    data = conn.recv(65536)
+                    if not data:
+                        break
+                    if len(data) == 1:
+                        conn.sendall(data)
+            finally:
+                conn.close()
+
+    def start(self, nodes):
+        for node in nodes:
+            sock = socket.socket()
+            sock.bind(('127.0.0.1', 0))
+            sock.listen(5)
+            thread = threading.Thread(target=self._serve, args=(sock,))
+            thread.daemon = True
+            thread.start()
+            self._servers[node.id] = sock
+
+    def stop(self, nodes):
+        for node in nodes:
+            sock = self._servers.pop(node.id)
+            # Wakes up the server thread blocked in accept().
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            sock.close()
+
+    def _pair(self, target):
+        conn = socket.create_connection(
+            self._servers[target.id].getsockname())
+        try:
+            start = time.time()
+            for _ in range(5):
+                conn.sendall('x')
+                conn.recv(1)
+            latency = (time.time() - start) / 5 * 1000
+            chunk = 'x' * 65536
+            start = time.time()
+            for _ in range(self.payload // len(chunk)):
+                conn.sendall(chunk)
+            throughput = self.payload * 8 / (time.time() - start) / 1e6
+        finally:
+            conn.close()
+        return latency, throughput
+
+    def measure(self, pairs):
+        return dict(((source, target), self._pair(target))
+                    for source, target in pairs)
+
+
+def measure(nodes, transport):
+    """Measure every pair of `nodes` with `transport`.
+
+    :returns: a `source id -> target id -> {'latency', 'throughput'}`
+        matrix, in milliseconds and Mbit/s.
+    """
+    matrix = dict((node.id, {}) for node in nodes)
+    transport.start(nodes)
+    try:
+        for pairs in schedule(nodes):
+            log.debug("measuring {0} pair(s)".format(len(pairs)))
+            for (source, target), (latency, throughput) in \
+                    transport.measure(pairs).items():
+                matrix[source.id][target.id] = {
+                    'latency': latency, 'throughput': throughput}
+    finally:
+        transport.stop(nodes)
+    return matrix
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2] if values else None
+
+
+def outliers(matrix, max_latency=None, min_throughput=None, factor=2.0):
+    """Return the `(source, target, reason)` of every pair that is
+    slower than the baseline, or could not be measured.
+
+    The baseline is `max_latency` milliseconds and `min_throughput`
+    Mbit/s.  Without them pairs are compared to the median of the
+    matrix: more than `factor` times its latency, or less than its
+    throughput divided by `factor`, is an outlier.
+    """
+    cells = [(source, target, cell) for source, row in matrix.items()
+             for target, cell in row.items()]
+    if max_latency is None:
+        median = _median([cell['latency'] for _, _, cell in cells
+                          if cell['latency'] is not None])
+        max_latency = median * factor if median is not None else None
+    if min_throughput is None:
+        median = _median([cell['throughput'] for _, _, cell in cells
+                          if cell['throughput'] is not None])
+        min_throughput = median / factor if median is not None else None
+
+    flagged = []
+    for source, target, cell in sorted(cells):
+        if cell['latency'] is None or cell['throughput'] is None:
+            flagged.append((source, target, 'unreachable'))
+        elif max_latency is not None and cell['latency'] > max_latency:
+            flagged.append((source, target, 'latency'))
+        elif (min_throughput is not None
+              and cell['throughput'] < min_throughput):
+            flagged.append((source, target, 'throughput'))
+    return flagged
+
+
+def record(config, matrix, clock=time.time):
+    """Append `matrix` to the measurement history in the stage
+    `config`, keeping the last `HISTORY` measurements.
+    """
+    history = list(config.get('netcheck') or [])
+    history.append({'measured_at': int(clock()), 'matrix': matrix})
+    config.set('netcheck', history[-HISTORY:])
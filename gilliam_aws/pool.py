@@ -0,0 +1,146 @@
+# Copyright 2013 Johan Rydberg.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Warm pool of configured, stopped executor nodes.
+
+Pool nodes have Docker installed and the executor and proxy images
+pulled, and are then stopped.  Taking a node out of the pool only
+requires starting the instance and the containers, which is a lot
+faster than launching and configuring a new instance.
+
+The pool is sized from the `WARM_POOL_TAG` tags of the instances as
+they are in EC2, so topping up is idempotent and several processes
+can share a pool without growing it past its size.
+"""
+
+import atexit
+import logging
+import multiprocessing
+
+from . import services
+from .ec2 import WARM_POOL_TAG
+
+
+log = logging.getLogger(__name__)
+
+
+class WarmPool(object):
+    """The warm pool of a stage.
+
+    :param size: Number of stopped nodes to keep in the pool.
+    """
+
+    def __init__(self, conn, stage, configure, size):
+        self.conn = conn
+        self.stage = stage
+        self.configure = configure
+        self.size = size
+        self._process = None
+
+    def available(self):
+        """Return pool nodes that are ready to be taken."""
+        return [node for node in self.stage.pool_nodes()
+                if node.state == 'stopped']
+
+    def top_up(self):
+        """Launch and prepare nodes until the pool has `size` nodes."""
+        self.stage.reload(self.conn)
+        missing = self.size - len(self.stage.pool_nodes())
+        if missing <= 0:
+            return []
+        log.info("adding {0} node(s) to the warm pool of {1}".format(
+                missing, self.stage.name))
+        nodes = self.stage.add_nodes(self.conn, ('exec',), missing)
+        ids = [node.id for node in nodes]
+        # Tag before preparing so that the nodes are counted by anyone
+        # else looking at the pool in the meantime.
+        self.conn.create_tags(ids, {WARM_POOL_TAG: '1'})
+        for node in nodes:
+            self._prepare(node)
+        self.stage.stop_nodes(self.conn, nodes)
+        self.stage.reload(self.conn)
+        return [self.stage.node(id) for id in ids]
+
+    def top_up_in_background(self):
+        """Top up the pool in a separate process, unless the last one
+        started is still at it.  The process is joined when this
+        process exits.
+
+        A process rather than a thread is used since the fabric based
+        configuration keeps its connection state in globals, which the
+        caller goes on using.  The pool is sized from EC2, so it does
+        not matter that the process works on a copy of the stage.
+
+        :returns: the :class:`multiprocessing.Process`.
+        """
+        if self._process is not None and self._process.is_alive():
+            return self._process
+        if self._process is None:
+            atexit.register(self._join)
+        self._process = multiprocessing.Process(target=self._top_up_forked)
+        self._process.start()
+        return self._process
+
+    def _top_up_forked(self):
+        # Do not share the EC2 connection of the parent process.
+        reset = getattr(self.conn, 'reset', None)
+        if reset is not None:
+            reset()
+        self.top_up()
+
+    def _join(self):
+        if self._process.is_alive():
+            log.info("waiting for the warm pool of {0} to be topped "
+                     "up".format(self.stage.name))
+        self._process.join()
+
+    def _prepare(self, node):
+        """Install Docker, apply the tuning profile of the stage and
+        pull the images of the executor node services, but do not
+        start anything.
+        """
+        storage = services.docker_storage(self.stage, node)
+        with self.configure.configure(node.public_dns_name, storage):
+            services.tune(self.stage, node, self.configure)
+            self.configure.docker_pull(services.image(self.stage, 'proxy'))
+            self.configure.docker_pull(services.image(self.stage, 'executor'))
+
+    def take(self):
+        """Take a node out of the pool, start it and its executor
+        services.
+
+        :returns: the node, or `None` if the pool is empty.
+        """
+        self.stage.reload(self.conn)
+        available = self.available()
+        if not available:
+            return None
+        node = available[0]
+        log.info("taking {0} out of the warm pool of {1}".format(
+                node.id, self.stage.name))
+        self.conn.delete_tags([node.id], [WARM_POOL_TAG])
+        self.stage.start_nodes(self.conn, [node])
+        self.stage.refresh(self.conn)
+        node = self.stage.node(node.id)
+        volume = self.stage.data_volume(node)
+        with self.configure.enter(node.public_dns_name):
+            if volume is not None and volume[0] == 'ephemeral':
+                # The instance-store volume did not survive the stop,
+                # and the pulled images went with it; set up the data
+                # root again.
+                self.configure.remount(
+                    services.docker_storage(self.stage, node))
+            services.start_services(self.stage, node, self.configure)
+        return node
@@ -0,0 +1,265 @@
+# Copyright 2013 Johan Rydberg.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Checks run before a stage is created.
+
+Mistakes such as bad credentials, a region without an image or a
+missing private key otherwise only show up after instances have been
+launched and waited for.  All checks run at once and every one of
+them is reported, so that all problems can be fixed in one go.
+"""
+
+import collections
+import logging
+import os
+import re
+import threading
+import time
+
+from . import ami
+from .ec2 import (GROUP_ROLE_MAP, INSTANCE_TYPE_RESOURCES, KEY_DIR,
+                  AmazonWebServicesStage, instance_types_for,
+                  parse_instance_types, planned_nodes)
+
+
+log = logging.getLogger(__name__)
+
+
+#: Security groups an account may have in a region.
+SECURITY_GROUP_LIMIT = 500
+
+#: Registry of images that do not name one.
+DEFAULT_REGISTRY = 'registry-1.docker.io'
+
+#: Manifest media types to accept from a registry.
+MANIFEST_TYPES = (
+    'application/vnd.docker.distribution.manifest.v2+json',
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+    'application/vnd.oci.image.index.v1+json',
+    'application/vnd.oci.image.manifest.v1+json',
+    )
+
+_CHALLENGE_RE = re.compile(r'(\w+)="([^"]*)"')
+
+
+def parse_image(image):
+    """Split `image` into a `(registry, name, tag)` tuple the way
+    Docker does: the first component names a registry if it has a
+    dot or a port, or is `localhost`.
+    """
+    first, _, rest = image.partition('/')
+    if rest and ('.' in first or ':' in first or first == 'localhost'):
+        registry, image = first, rest
+    else:
+        registry = None
+    name, _, tag = image.rpartition(':')
+    if not name or '/' in tag:
+        name, tag = image, None
+    if registry is None:
+        registry = DEFAULT_REGISTRY
+        if '/' not in name:
+            name = 'library/' + name
+    return registry, name, tag or 'latest'
+
+
+def _registry_status(url, timeout):
+    """Default transport of :class:`Preflight`: return the status of
+    a HEAD request for `url` on a v2 registry, getting a token first
+    if the registry asks for one.
+    """
+    import requests
+    headers = {'Accept': ', '.join(MANIFEST_TYPES)}
+    response = requests.head(url, headers=headers, timeout=timeout)
+    challenge = response.headers.get('WWW-Authenticate', '')
+    if response.status_code == 401 and challenge.startswith('Bearer '):
+        params = dict(_CHALLENGE_RE.findall(challenge))
+        realm = params.pop('realm', None)
+        if realm:
+            token = requests.get(realm, params=params, timeout=timeout)
+            if token.ok:
+                headers['Authorization'] = 'Bearer {0}'.format(
+                    token.json().get('token'))
+                response = requests.head(url, headers=headers,
+                                         timeout=timeout)
+    return response.status_code
+
+
+class CheckFailed(Exception):
+    """A pre-flight check found a problem."""
+
+
+class Preflight(object):
+    """Pre-flight checks for creating stage `name`, with configuration
+    `config`, through `conn`.
+
+    Every `check_*` method raises :exc:`CheckFailed`, or whatever the
+    API raised, if there is a problem.  Problems that may not be ones
+    are logged as warnings.
+
+    The checks run in threads of their own, so `conn` should be a
+    client made by :func:`gilliam_aws.ec2.connect`, which gives every
+    thread a connection of its own.
+
+    :param images: Images that have to exist in their registries.
+    :param repository: Repository, `[registry/]namespace`, that the
+        stage is to push images to.
+    :param transport: Callable that given a registry URL and a timeout
+        returns the HTTP status of a HEAD request for it.
+    """
+
+    def __init__(self, conn, config, name, images=(), repository=None,
+                 timeout=30, transport=_registry_status):
+        self.conn = conn
+        self.config = config
+        self.name = name
+        self.images = images
+        self.repository = repository
+        self.timeout = timeout
+        self.transport = transport
+
+    def check_credentials(self):
+        if not self.conn.get_all_zones():
+            raise CheckFailed("no availability zones in {0}".format(
+                    self.config.get('aws_region')))
+
+    def check_ami(self):
+        image_id = self.config.get('aws_ec2_ami')
+        if image_id is None:
+            try:
+                ami.resolve(self.conn, self.config.get('aws_region'))
+            except LookupError, e:
+                raise CheckFailed(str(e))
+        elif not self.conn.get_all_images(image_ids=[image_id]):
+            raise CheckFailed("AMI {0} does not exist".format(image_id))
+
+    def _vcpus_needed(self, nodes):
+        """Return the number of vCPUs that `nodes` need, counting
+        those of unknown instance types as one.
+        """
+        types = parse_instance_types(self.config.get('aws_ec2_instance_type'))
+        vcpus = 0
+        for groups in nodes:
+            roles = [GROUP_ROLE_MAP.get(group, group) for group in groups]
+            instance_type = instance_types_for(types, roles)[0]
+            vcpus += INSTANCE_TYPE_RESOURCES.get(instance_type, (1, 0))[0]
+        return vcpus
+
+    def check_quota(self):
+        """Check the legacy `max-instances` limit.  Most accounts are
+        limited by the number of running vCPUs instead, which the EC2
+        API does not tell, so that limit is not checked.
+        """
+        attributes = self.conn.describe_account_attributes(['max-instances'])
+        limit = int(attributes[0].attribute_values[0])
+        running = sum(len(reservation.instances) for reservation in
+                      self.conn.get_all_instances(filters={
+                    'instance-state-name': ['pending', 'running']}))
+        nodes = planned_nodes(self.config)
+        needed = len(nodes)
+        if running + needed > limit:
+            raise CheckFailed(
+                "{0} instances needed but only {1} of {2} left by the "
+                "max-instances limit; the vCPU limit of the account, "
+                "which applies instead on most accounts, is not checked "
+                "({3} vCPUs needed)".format(
+                    needed, max(0, limit - running), limit,
+                    self._vcpus_needed(nodes)))
+
+    def check_key_pair(self):
+        key_file = os.path.join(KEY_DIR, self.name + '.pem')
+        existing = self.conn.get_all_key_pairs(
+            filters={'key-name': self.name})
+        if existing and not os.path.exists(key_file):
+            raise CheckFailed("key pair {0} exists but {1} is missing".format(
+                    self.name, key_file))
+        directory = KEY_DIR
+        while not os.path.isdir(directory):
+            directory = os.path.dirname(directory)
+        if not os.access(directory, os.W_OK | os.X_OK):
+            raise CheckFailed("cannot write keys to {0}".format(KEY_DIR))
+
+    def check_security_groups(self):
+        groups = self.conn.get_all_security_groups()
+        names = set(group.name for group in groups)
+        missing = [group for group in AmazonWebServicesStage.SECURITY_GROUPS
+                   if '{0}-{1}'.format(self.name, group) not in names]
+        if len(groups) + len(missing) > SECURITY_GROUP_LIMIT:
+            raise CheckFailed(
+                "{0} security groups needed but only {1} of {2} left".format(
+                    len(missing), max(0, SECURITY_GROUP_LIMIT - len(groups)),
+                    SECURITY_GROUP_LIMIT))
+
+    def _status(self, url):
+        try:
+            return self.transport(url, self.timeout)
+        except EnvironmentError, e:
+            raise CheckFailed("cannot reach registry: {0}".format(e))
+
+    def check_images(self):
+        for image in self.images:
+            registry, name, tag = parse_image(image)
+            status = self._status('https://{0}/v2/{1}/manifests/{2}'.format(
+                    registry, name, tag))
+            if status == 404:
+                raise CheckFailed("image {0} does not exist".format(image))
+            if status != 200:
+                log.warning("could not check image {0}: {1} answered "
+                            "{2}".format(image, registry, status))
+
+    def check_repository(self):
+        if not self.repository:
+            return
+        registry, _, _ = parse_image(self.repository)
+        status = self._status('https://{0}/v2/'.format(registry))
+        # 401 only means that pushing needs a login.
+        if status not in (200, 401):
+            log.warning("registry {0} of repository {1} answered "
+                        "{2}".format(registry, self.repository, status))
+
+    def checks(self):
+        """Return an ordered `name -> check` mapping."""
+        return collections.OrderedDict(
+            (attr[len('check_'):].replace('_', '-'), getattr(self, attr))
+            for attr in sorted(dir(self)) if attr.startswith('check_'))
+
+    def run(self):
+        """Run all checks at once.
+
+        :returns: an ordered `name -> error` mapping, where the error
+            is `None` for checks that passed.
+        """
+        checks = self.checks()
+        results = collections.OrderedDict((name, 'timed out')
+                                          for name in checks)
+
+        def run(name, check):
+            try:
+                check()
+            except Exception, e:
+                log.debug("pre-flight check {0} failed".format(name),
+                          exc_info=True)
+                results[name] = str(e) or e.__class__.__name__
+            else:
+                results[name] = None
+
+        threads = [threading.Thread(target=run, args=item)
+                   for item in checks.items()]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        deadline = time.time() + self.timeout
+        for thread in threads:
+            thread.join(max(0, deadline - time.time()))
+        return results
@@ -0,0 +1,186 @@
+# Copyright 2013 Johan Rydberg.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Distribute a file to all nodes of a stage.
+
+The file is uploaded once, to a seed node.  From there it spreads
+node-to-node over the private network: every node that has the file
+serves it over HTTP, and in every round each of them hands it to one
+node that does not.  The number of nodes with the file doubles every
+round, so the transfer takes about log2(N) rounds.  Every copy is
+checked against the checksum of the local file.
+
+The nodes serve the file on their private address only, and only
+under a path with a random token that is made up for every push, so
+that other hosts and containers cannot fetch it.
+"""
+
+import binascii
+import hashlib
+import logging
+import os
+import pipes
+import posixpath
+
+
+log = logging.getLogger(__name__)
+
+
+#: Port that nodes serve the file on while it is being distributed.
+PUSH_PORT = 3223
+
+#: Directory on the nodes where the file is kept while distributed.
+STAGING_DIR = '/tmp/gilliam-push'
+
+#: Number of times a node is retried, from another source, before it
+#: is given up on.
+MAX_ATTEMPTS = 3
+
+#: Serves the file at path `argv[3]` of the working directory, and
+#: nothing else, on address `argv[1]` and port `argv[2]`.
+_SERVER = """\
+import BaseHTTPServer, SimpleHTTPServer, sys
+class Handler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    def send_head(self):
+        if self.path != sys.argv[3]:
+            self.send_error(404)
+            return None
+        return SimpleHTTPServer.SimpleHTTPRequestHandler.send_head(self)
+BaseHTTPServer.HTTPServer(
+    (sys.argv[1], int(sys.argv[2])), Handler).serve_forever()
+"""
+
+
+def checksum(path):
+    """Return the SHA-256 hex digest of local file `path`."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _url_path(token, digest):
+    return '/{0}/{1}'.format(token, digest)
+
+
+def _staged(token, digest):
+    return posixpath.join(STAGING_DIR, token, digest)
+
+
+def _install(token, digest, dest, address):
+    """Shell snippet that verifies the staged file and copies it to
+    `dest`, then serves it on `address` and waits until it does.
+    """
+    staged = _staged(token, digest)
+    url = 'http://{0}:{1}{2}'.format(address, PUSH_PORT,
+                                     _url_path(token, digest))
+    return ('echo {check} | sha256sum -c --quiet - && '
+            'mkdir -p {dest_dir} && cp {staged} {dest} && '
+            'cd {staging_dir} && '
+            '(nohup python -c {server} {address} {port} {path} '
+            '>/dev/null 2>&1 &) && '
+            'for i in $(seq 50); do '
+            'curl -sf -o /dev/null {url} && break; sleep 0.2; done && '
+            'curl -sf -o /dev/null {url}'.format(
+            check=pipes.quote('{0}  {1}'.format(digest, staged)),
+            staged=staged, dest=pipes.quote(dest),
+            dest_dir=pipes.quote(posixpath.dirname(dest) or '/'),
+            staging_dir=STAGING_DIR, server=pipes.quote(_SERVER),
+            address=address, port=PUSH_PORT,
+            path=_url_path(token, digest), url=url))
+
+
+def _fetch(source, token, digest, dest, address):
+    """Shell snippet that fetches the file from node `source`."""
+    staged = _staged(token, digest)
+    return ('mkdir -p {staged_dir} && '
+            'curl -sSf http://{source}:{port}{path} -o {staged} && '
+            '{install}'.format(
+            staged_dir=posixpath.dirname(staged), source=source,
+            port=PUSH_PORT, path=_url_path(token, digest), staged=staged,
+            install=_install(token, digest, dest, address)))
+
+
+def plan_round(holders, pending):
+    """Pair every holder with at most one pending node.
+
+    :returns: a list of `(holder, node)` pairs.
+    """
+    return zip(holders, pending)
+
+
+def push(configure, nodes, local_path, dest, parallel=10):
+    """Distribute `local_path` to `dest` on all `nodes`.
+
+    Nodes that already have an identical file are skipped.
+
+    :returns: a `(skipped, done, failed)` tuple of node lists.
+    """
+    digest = checksum(local_path)
+    token = binascii.hexlify(os.urandom(16))
+    hosts = dict((node.public_dns_name, node) for node in nodes)
+
+    existing = configure.run_all(
+        list(hosts), 'sha256sum {0} 2>/dev/null'.format(pipes.quote(dest)),
+        parallel=parallel, use_sudo=True)
+    skipped = [hosts[result.host] for result in existing
+               if not result.failed and result.output.split()[:1] == [digest]]
+    pending = [node for node in nodes if node not in skipped]
+    if not pending:
+        return skipped, [], []
+
+    seed = pending.pop(0)
+    log.info("uploading {0} to {1}".format(local_path, seed.public_dns_name))
+    with configure.enter(seed.public_dns_name):
+        configure.upload(local_path, _staged(token, digest))
+    seeded = configure.run_all(
+        [seed.public_dns_name],
+        _install(token, digest, dest, seed.private_ip_address),
+        use_sudo=True)[0]
+    if seeded.failed:
+        raise RuntimeError("could not install file on {0}: {1}".format(
+                seed.public_dns_name, seeded.output))
+
+    holders, failed, attempts = [seed], [], {}
+    while pending:
+        pairs = plan_round(holders, pending)
+        log.info("distributing from {0} node(s) to {1} node(s)".format(
+                len(holders), len(pairs)))
+        commands = dict(
+            (node.public_dns_name,
+             _fetch(holder.private_ip_address, token, digest, dest,
+                    node.private_ip_address))
+            for holder, node in pairs)
+        results = configure.run_each(commands, parallel=parallel,
+                                     use_sudo=True)
+        pending = pending[len(pairs):]
+        for holder, node in pairs:
+            if not results[node.public_dns_name].failed:
+                holders.append(node)
+                continue
+            attempts[node.id] = attempts.get(node.id, 0) + 1
+            if attempts[node.id] < MAX_ATTEMPTS:
+                pending.append(node)
+            else:
+                failed.append(node)
+
+    configure.run_all(
+        [node.public_dns_name for node in holders + failed],
+        # The brackets keep pkill from matching the shell it runs in.
+        'pkill -f "[{0}]{1}"; rm -rf {2}'.format(
+            token[0], token[1:], STAGING_DIR),
+        parallel=parallel, use_sudo=True)
+    return skipped, holders, failed
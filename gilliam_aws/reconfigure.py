@@ -0,0 +1,132 @@
+# Copyright 2013 Johan Rydberg.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Converge the containers running on a stage to what they should be.
+
+The desired containers of every node are computed from its roles, the
+same way they are when the stage is created, and compared to what is
+running.  Only containers whose image, command, environment or ports
+differ are replaced.
+"""
+
+import logging
+import shlex
+
+from . import services
+
+
+log = logging.getLogger(__name__)
+
+
+def _repository(image):
+    """Strip the tag from `image`."""
+    name, _, tag = image.rpartition(':')
+    if not name or '/' in tag:
+        return image
+    return name
+
+
+def _ports(container):
+    """Return the published ports of `container` as `host:container`
+    strings.
+    """
+    bindings = (container.get('HostConfig') or {}).get('PortBindings') or {}
+    ports = set()
+    for port, hosts in bindings.items():
+        for binding in hosts or []:
+            ports.add('{0}:{1}'.format(binding.get('HostPort'),
+                                       port.split('/')[0]))
+    return ports
+
+
+def differences(spec, container):
+    """Return the names of the fields where running `container` (as
+    returned by `docker inspect`) differs from `spec`.
+    """
+    config = container.get('Config') or {}
+    host_config = container.get('HostConfig') or {}
+    fields = []
+    image = spec['image']
+    if config.get('Image') not in (image, image + ':latest'):
+        fields.append('image')
+    if (config.get('Cmd') or []) != shlex.split(spec.get('command') or ''):
+        fields.append('command')
+    env = dict(var.split('=', 1) for var in config.get('Env') or []
+               if '=' in var)
+    if any(env.get(var) != str(value)
+           for var, value in (spec.get('env') or {}).items()):
+        fields.append('env')
+    if spec.get('host_network'):
+        if host_config.get('NetworkMode') != 'host':
+            fields.append('ports')
+    elif _ports(container) != set(spec.get('ports') or []):
+        fields.append('ports')
+    return fields
+
+
+def plan(stage, node, containers):
+    """Compare the desired containers of `node` with the running
+    `containers`.
+
+    :returns: a list of `(component, spec, reasons)` tuples for the
+        containers that have to be (re)started.
+    """
+    running = {}
+    for container in containers:
+        image = (container.get('Config') or {}).get('Image') or ''
+        running.setdefault(_repository(image), container)
+
+    changes = []
+    for component, spec in services.container_specs(stage, node):
+        container = running.get(services.IMAGES[component])
+        if container is None:
+            changes.append((component, spec, ['not running']))
+            continue
+        reasons = differences(spec, container)
+        if reasons:
+            changes.append((component, spec, reasons))
+    return changes
+
+
+def converge(host, stage, configure, dry_run=False):
+    """Converge the containers on `host`.  Runs in a worker process of
+    :meth:`gilliam_aws.configure.Configure.parallel`.
+
+    :returns: a list of `(component, reasons)` for the containers that
+        were, or with `dry_run` would have been, replaced.
+    """
+    node = [node for node in stage.nodes if node.public_dns_name == host][0]
+    changes = []
+    with configure.enter(host):
+        for component, spec, reasons in plan(
+                stage, node, configure.docker_containers()):
+            log.info("{0}: {1} differs in {2}".format(
+                    host, component, ', '.join(reasons)))
+            if not dry_run:
+                configure.docker_rm(services.IMAGES[component])
+                configure.docker_run(**spec)
+            changes.append((component, reasons))
+    return changes
+
+
+def reconfigure(stage, configure, parallel=10, dry_run=False):
+    """Converge all running nodes of `stage`, `parallel` at a time.
+
+    :returns: a `host -> changes` mapping; see :func:`converge`.
+    """
+    hosts = [node.public_dns_name for node in stage.nodes
+             if not node.pooled and node.state == 'running']
+    return configure.parallel(hosts, converge, (stage, configure, dry_run),
+                              parallel=parallel)
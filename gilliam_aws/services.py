@@ -0,0 +1,287 @@
+# Copyright 2013 Johan Rydberg.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Start the components that live outside of Gilliam on stage nodes:
+the service registry, the proxy and the executor.
+"""
+
+import logging
+
+from .ec2 import DATA_VOLUME_GUEST_DEVICE, INSTANCE_TYPE_RESOURCES
+
+
+log = logging.getLogger(__name__)
+
+
+SERVICE_REGISTRY_IMAGE = 'gilliam/service-registry'
+EXECUTOR_IMAGE = 'gilliam/executor'
+PROXY_IMAGE = 'gilliam/proxy'
+BOOTSTRAP_IMAGE = 'gilliam/bootstrap'
+
+#: Image repository of every component.
+IMAGES = {
+    'service-registry': SERVICE_REGISTRY_IMAGE,
+    'executor': EXECUTOR_IMAGE,
+    'proxy': PROXY_IMAGE,
+    }
+
+
+def resource_profile(node, component):
+    """Return the `docker_run` resource options for `component`
+    (`proxy`, `executor` or `service-registry`) on `node`, based on
+    its instance type.
+
+    The proxy is on the request path: it gets the highest CPU weight
+    and, when there are cores to spare, is pinned to the first one or
+    two cores.  Other containers can still run on those cores; the
+    weight is what keeps them from starving the proxy.  The executor
+    and service registry get a modest weight and memory cap so that
+    application containers cannot starve them and they cannot crowd
+    out applications.
+
+    Nodes of instance types that are not in `INSTANCE_TYPE_RESOURCES`
+    get the weights and file limits but no memory caps or pinning,
+    since these would be sized for a machine they may not be.
+    """
+    if component == 'proxy':
+        profile = {'cpu_shares': 2048,
+                   'ulimits': {'nofile': '65536:65536'}}
+    else:
+        profile = {'cpu_shares': 512,
+                   'ulimits': {'nofile': '16384:16384'}}
+    resources = INSTANCE_TYPE_RESOURCES.get(node.instance_type)
+    if resources is None:
+        return profile
+    cpus, memory = resources
+    if component == 'proxy':
+        profile['memory'] = '{0}m'.format(max(256, memory // 8))
+        if cpus >= 4:
+            profile['cpuset'] = '0,1'
+        elif cpus >= 2:
+            profile['cpuset'] = '0'
+    else:
+        profile['memory'] = '{0}m'.format(max(128, memory // 16))
+    return profile
+
+
+#: Components that can be run with host networking.
+HOST_NETWORK_COMPONENTS = ('proxy', 'executor')
+
+
+def host_network(stage, component):
+    """Return `True` if `component` should use host networking."""
+    components = stage.config.get('docker_host_network') or ''
+    return component in components.split(',')
+
+
+def executor_name(stage, node):
+    """Return the name of the executor running on `node`."""
+    # Named after the first label of the DNS name that matches the
+    # address mode; IP addresses do not make for names.
+    if stage.address_mode == 'public':
+        return node.public_dns_name.split('.')[0]
+    return node.private_dns_name.split('.')[0]
+
+
+def docker_storage(stage, node):
+    """Return the :class:`gilliam_aws.configure.DockerStorage` of
+    `node`.
+    """
+    from .configure import DockerStorage
+    return DockerStorage(
+        driver=stage.config.get('docker_storage_driver'),
+        device=(DATA_VOLUME_GUEST_DEVICE if stage.data_volume(node)
+                else None))
+
+
+def configure_node(stage, node, configure):
+    """Install Docker on `node` and start the components for its
+    roles.  The service-registry is started first since the executor
+    depends on it, and the rest of the system depends on the executor.
+
+    :returns: the disk benchmark of the Docker data root.
+    """
+    log.debug('configuring {0}'.format(node.public_dns_name))
+    storage = docker_storage(stage, node)
+    with configure.configure(node.public_dns_name, storage):
+        tune(stage, node, configure)
+        benchmark = configure.disk_benchmark(storage.root)
+        start_services(stage, node, configure)
+    return benchmark
+
+
+def tune(stage, node, configure):
+    """Apply the tuning profile of the stage to `node` and check
+    that it took.
+    """
+    profile = stage.config.get('tuning_profile') or 'none'
+    for key, expected, actual in configure.tune(profile):
+        log.warning("{0}: {1} is {2}, expected {3}".format(
+                node.public_dns_name, key, actual, expected))
+
+
+def images(node):
+    """Return the images of the components that run on `node`."""
+    images = []
+    if 'service-registry' in node.roles:
+        images.append(SERVICE_REGISTRY_IMAGE)
+    if 'executor' in node.roles:
+        images.extend([PROXY_IMAGE, EXECUTOR_IMAGE])
+    return images
+
+
+def wiring(stage, node):
+    """Return the addresses that the components on `node` are started
+    with.  If these change the components have to be started anew.
+    """
+    return [stage.address(node), stage.service_registry_cluster(node)]
+
+
+def resume_services(stage, node, configure, rewire):
+    """Bring the components of a restarted `node` back up.
+
+    The stopped containers are started again, unless `rewire` is
+    true or the node lost its data volume, in which case they are
+    replaced with new ones.
+    """
+    host = node.public_dns_name
+    volume = stage.data_volume(node)
+    if volume is not None and volume[0] == 'ephemeral':
+        # Instance-store volumes do not survive a stop; set up the
+        # data root again.  The containers went with it.
+        with configure.enter(host):
+            configure.remount(docker_storage(stage, node))
+            start_services(stage, node, configure)
+        return
+
+    with configure.enter(host):
+        if rewire:
+            for image in images(node):
+                configure.docker_rm(image)
+            start_services(stage, node, configure)
+        else:
+            for image in images(node):
+                configure.docker_start(image)
+
+
+def _provision(host, stage, configure, timeout):
+    from .configure import wait_for_ssh
+    node = [node for node in stage.nodes if node.public_dns_name == host][0]
+    wait_for_ssh(host, timeout)
+    return configure_node(stage, node, configure)
+
+
+def configure_nodes_pipelined(stage, configure, parallel=10, timeout=600):
+    """Configure all nodes of `stage` concurrently.  Every node is
+    configured as soon as it answers over SSH, without waiting for
+    the other nodes or for EC2 status checks.
+
+    :returns: a `hostname -> disk benchmark` mapping.
+    """
+    return configure.parallel(
+        [node.public_dns_name for node in stage.nodes], _provision,
+        (stage, configure, timeout), parallel=parallel)
+
+
+def bootstrap(host, stage, configure, tag):
+    """Run the bootstrap script that brings the system to life, from
+    `host`.
+    """
+    env = {
+        # The bootstrap script need to know how to talk to the
+        # service registry; fill in the service registry
+        # environment variable so gilliam-cli knows where to pick
+        # up the information.
+        'GILLIAM_SERVICE_REGISTRY': stage.service_registry_cluster(),
+
+        # Routers need special attention since they are pinned to
+        # specific executors.  The ROUTERS variable will hold a
+        # space separated list of executor instance names that
+        # should get a dedicated router.
+        'ROUTERS': ' '.join(executor_name(stage, node)
+                            for node in stage.nodes_with_role('router')),
+        }
+
+    image = '{0}:{1}'.format(BOOTSTRAP_IMAGE, tag)
+    with configure.enter(host):
+        log.debug("bootstrapping from {0} using {1}".format(host, image))
+        configure.docker_run(image, '', env=env, detach=False)
+
+
+def start_services(stage, node, configure):
+    """Start the components for the roles of `node`.  Must be called
+    with a connection to `node` set up by `configure`.
+    """
+    for component, spec in container_specs(stage, node):
+        log.debug('launching {0}'.format(component))
+        configure.docker_run(**spec)
+
+
+def container_specs(stage, node):
+    """Return the containers that should run on `node`, in the order
+    they should be started, as a list of `(component, spec)` tuples.
+    The spec holds the keyword arguments for `Configure.docker_run`.
+    """
+    specs = []
+    if 'service-registry' in node.roles:
+        specs.append(('service-registry', service_registry_spec(stage, node)))
+    if 'executor' in node.roles:
+        specs.append(('proxy', proxy_spec(stage, node)))
+        specs.append(('executor', executor_spec(stage, node)))
+    return specs
+
+
+def image(stage, component):
+    """Return the image, with tag if one is configured, of `component`."""
+    tag = (stage.config.get('image_tags') or {}).get(component)
+    if tag:
+        return '{0}:{1}'.format(IMAGES[component], tag)
+    return IMAGES[component]
+
+
+def service_registry_spec(stage, node):
+    service_registry_cluster = stage.service_registry_cluster(node)
+    options = '-n {0} -c {1}'.format(stage.address(node),
+                                     service_registry_cluster)
+    return dict(image=image(stage, 'service-registry'), command=options,
+                ports=['3222:3222'],
+                **resource_profile(node, 'service-registry'))
+
+
+def executor_spec(stage, node):
+    host = stage.address(node)
+    service_registry = stage.service_registry_cluster(node)
+    options = '--host {0} --name {1}'.format(
+        host, executor_name(stage, node))
+    on_host = host_network(stage, 'executor')
+    env = {
+        'GILLIAM_SERVICE_REGISTRY': service_registry,
+        # On the host network Docker can be reached over loopback.
+        'DOCKER': 'http://{0}:3000'.format('127.0.0.1' if on_host else host)
+        }
+    return dict(image=image(stage, 'executor'), command=options, env=env,
+                ports=['9000:9000'], host_network=on_host,
+                **resource_profile(node, 'executor'))
+
+
+def proxy_spec(stage, node):
+    service_registry = stage.service_registry_cluster(node)
+    env = {
+        'GILLIAM_SERVICE_REGISTRY': service_registry,
+        }
+    return dict(image=image(stage, 'proxy'), command='bin/proxy', env=env,
+                ports=['9001:9001'],
+                host_network=host_network(stage, 'proxy'),
+                **resource_profile(node, 'proxy'))
@@ -0,0 +1,129 @@
+# Copyright 2013 Johan Rydberg.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Kernel tuning profiles for stage nodes.
+
+A profile is a set of sysctl settings and a file descriptor limit.
+Profiles are written to `/etc/sysctl.d` and `/etc/security/limits.d`
+so that they survive reboots, and can be compared to what a running
+node actually has.
+"""
+
+
+#: Where the sysctl settings of a profile are written.
+SYSCTL_FILE = '/etc/sysctl.d/60-gilliam.conf'
+
+#: Where the file descriptor limits of a profile are written.
+LIMITS_FILE = '/etc/security/limits.d/60-gilliam.conf'
+
+#: Kernel modules that are loaded at boot.
+MODULES_FILE = '/etc/modules'
+
+#: Ephemeral ports of outgoing connections.  The range starts above
+#: the ports the stage listens on (3000, 3222, 3223, 5201, 8080, 9000,
+#: 9001), so that a connection can never take one of them while the
+#: container that listens on it is restarted.
+_LOCAL_PORT_RANGE = '10000 65535'
+
+
+_NETWORK = {
+    'net.core.somaxconn': '65535',
+    'net.core.netdev_max_backlog': '65536',
+    'net.ipv4.tcp_max_syn_backlog': '65535',
+    'net.ipv4.ip_local_port_range': _LOCAL_PORT_RANGE,
+    'net.ipv4.tcp_tw_reuse': '1',
+    'net.ipv4.tcp_fin_timeout': '15',
+    'net.netfilter.nf_conntrack_max': '1048576',
+    'net.core.rmem_max': '16777216',
+    'net.core.wmem_max': '16777216',
+    'net.ipv4.tcp_rmem': '4096 87380 16777216',
+    'net.ipv4.tcp_wmem': '4096 65536 16777216',
+    }
+
+
+#: `name -> (sysctl settings, nofile limit)`.  The proxy profile is
+#: for nodes that take a lot of connections; the executor profile
+#: raises the limits that containers run into first.
+PROFILES = {
+    'proxy': (dict(_NETWORK, **{'fs.file-max': '2097152'}), 1048576),
+    'executor': ({
+            'fs.file-max': '1048576',
+            'net.core.somaxconn': '4096',
+            'net.ipv4.ip_local_port_range': _LOCAL_PORT_RANGE,
+            'net.netfilter.nf_conntrack_max': '262144',
+            }, 262144),
+    'none': ({}, None),
+    }
+
+
+def sysctl_conf(name):
+    """Return the contents of the sysctl file for profile `name`."""
+    settings, _ = PROFILES[name]
+    return ''.join('{0} = {1}\n'.format(key, value)
+                   for key, value in sorted(settings.items()))
+
+
+def limits_conf(name):
+    """Return the contents of the limits file for profile `name`."""
+    _, nofile = PROFILES[name]
+    if nofile is None:
+        return ''
+    return ''.join('{0} {1} nofile {2}\n'.format(domain, kind, nofile)
+                   for domain in ('*', 'root')
+                   for kind in ('soft', 'hard'))
+
+
+def modules(name):
+    """Return the kernel modules that have to be loaded for the
+    settings of profile `name` to exist.
+    """
+    settings, _ = PROFILES[name]
+    if any(key.startswith('net.netfilter.nf_conntrack') for key in settings):
+        return ['nf_conntrack']
+    return []
+
+
+def sysctl_keys(name):
+    return sorted(PROFILES[name][0])
+
+
+def drift(name, values):
+    """Compare the `key -> value` mapping `values`, as read from a
+    node, to profile `name`.
+
+    :returns: a list of `(key, expected, actual)` tuples.
+    """
+    settings, _ = PROFILES[name]
+    result = []
+    for key in sorted(settings):
+        expected = ' '.join(settings[key].split())
+        actual = ' '.join((values.get(key) or '').split())
+        if expected != actual:
+            result.append((key, expected, actual or None))
+    return result
+
+
+def parse_sysctl(output):
+    """Parse the `key = value` lines that `sysctl <keys>` printed into
+    a mapping.  Anything else, like the errors about keys that do not
+    exist, is skipped, so a missing key cannot shift the values of the
+    others.
+    """
+    values = {}
+    for line in output.splitlines():
+        key, sep, value = line.partition(' = ')
+        if sep:
+            values[key.strip()] = value.strip()
+    return values
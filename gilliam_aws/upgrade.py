@@ -0,0 +1,221 @@
+# Copyright 2013 Johan Rydberg.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Rolling upgrade of the executor and proxy images of a stage.
+
+The new images are pulled on all nodes up front, so that replacing a
+container only takes as long as starting a new one.  Nodes are then
+upgraded a batch at a time, and a batch is only considered done when
+the health endpoints of the new containers answer.  If a batch fails,
+every upgraded node is rolled back to the previous images.  At most one
+batch of nodes is out of service at any time.
+"""
+
+import logging
+
+from . import services
+
+
+log = logging.getLogger(__name__)
+
+
+#: Components that can be upgraded, and the `(port, path)` of the
+#: HTTP endpoint that tells if they are healthy.
+HEALTH_CHECKS = {
+    'executor': (9000, '/container'),
+    'proxy': (9001, '/'),
+    }
+
+
+class UpgradeError(Exception):
+    """The upgrade failed and was rolled back."""
+
+
+def parse_images(values):
+    """Parse `component=tag` values into a `component -> tag`
+    mapping.
+
+    :raises ValueError: if a value is malformed or names a component
+        that cannot be upgraded.
+    """
+    tags = {}
+    for value in values:
+        component, sep, tag = value.partition('=')
+        if not sep or not tag:
+            raise ValueError("expected COMPONENT=TAG: {0}".format(value))
+        if component not in HEALTH_CHECKS:
+            raise ValueError("cannot upgrade {0}; choose from {1}".format(
+                    component, ', '.join(sorted(HEALTH_CHECKS))))
+        tags[component] = tag
+    return tags
+
+
+def health_command(components, timeout, interval=2):
+    """Shell snippet that waits up to `timeout` seconds for the health
+    endpoints of all `components` to answer without a server error.
+    """
+    checks = ' && '.join(
+        'code=$(curl -s -o /dev/null -w "%{{http_code}}" '
+        'http://127.0.0.1:{0}{1}) && [ "$code" -ge 200 -a "$code" -lt 500 ]'
+        .format(*HEALTH_CHECKS[component])
+        for component in sorted(components))
+    return ('for i in $(seq {tries}); do ({checks}) && exit 0; '
+            'sleep {interval}; done; exit 1'.format(
+            tries=max(1, timeout // interval), checks=checks,
+            interval=interval))
+
+
+def _node(stage, host):
+    return [node for node in stage.nodes if node.public_dns_name == host][0]
+
+
+def _pull(host, configure, images):
+    """Pull `images` on `host`.  Runs in a worker process.
+
+    :returns: `None` or the error that made the pull fail.
+    """
+    try:
+        with configure.enter(host):
+            for image in images:
+                configure.docker_pull(image)
+    except (Exception, SystemExit), e:
+        return str(e)
+
+
+def _replace(host, stage, configure, components):
+    """Replace the containers of `components` on `host` with
+    containers of the images currently configured for the stage.
+    Runs in a worker process.
+
+    :returns: `None` or the error that made the replacement fail.
+    """
+    node = _node(stage, host)
+    try:
+        with configure.enter(host):
+            for component, spec in services.container_specs(stage, node):
+                if component in components:
+                    configure.docker_rm(services.IMAGES[component])
+                    configure.docker_run(**spec)
+    except (Exception, SystemExit), e:
+        return str(e)
+
+
+def batches(nodes, size):
+    """Split `nodes` into batches of at most `size` nodes."""
+    size = max(1, size)
+    return [nodes[i:i + size] for i in range(0, len(nodes), size)]
+
+
+class RollingUpgrade(object):
+    """Upgrades the executor nodes of `stage` to the images tagged
+    `tags` (a `component -> tag` mapping).
+
+    The stage configuration is updated as the upgrade progresses; it is
+    up to the caller to write it once :meth:`run` returns.
+    """
+
+    def __init__(self, stage, configure, tags, batch_size=1, parallel=10,
+                 health_timeout=120):
+        self.stage = stage
+        self.configure = configure
+        self.tags = tags
+        self.batch_size = batch_size
+        self.parallel = parallel
+        self.health_timeout = health_timeout
+
+    def nodes(self):
+        return [node for node in self.stage.nodes_with_role('executor')
+                if node.state == 'running']
+
+    def _set_tags(self, tags):
+        self.stage.config.set('image_tags', tags)
+
+    def prepull(self, hosts):
+        """Pull the new images on all `hosts` at once.
+
+        :raises UpgradeError: if any host could not pull them.
+        """
+        images = ['{0}:{1}'.format(services.IMAGES[component], tag)
+                  for component, tag in sorted(self.tags.items())]
+        log.info("pulling {0} on {1} node(s)".format(
+                ', '.join(images), len(hosts)))
+        errors = self.configure.parallel(
+            hosts, _pull, (self.configure, images), parallel=self.parallel)
+        failed = dict((host, error) for host, error in errors.items()
+                      if error is not None)
+        if failed:
+            raise UpgradeError("could not pull images on {0}".format(
+                    ', '.join(sorted(failed))))
+
+    def _apply(self, hosts):
+        """Replace the containers on `hosts` and wait for them to
+        become healthy.
+
+        :returns: the hosts that failed.
+        """
+        components = list(self.tags)
+        errors = self.configure.parallel(
+            hosts, _replace, (self.stage, self.configure, components),
+            parallel=self.parallel)
+        failed = set(host for host, error in errors.items()
+                     if error is not None)
+        for host in sorted(failed):
+            log.error("{0}: {1}".format(host, errors[host]))
+        healthy = [host for host in hosts if host not in failed]
+        results = self.configure.run_all(
+            healthy, health_command(components, self.health_timeout),
+            parallel=self.parallel, timeout=self.health_timeout + 30)
+        for result in results:
+            if result.failed:
+                log.error("{0}: not healthy".format(result.host))
+                failed.add(result.host)
+        return failed
+
+    def run(self):
+        """Upgrade all executor nodes, one batch at a time.
+
+        :returns: the number of upgraded nodes.
+        :raises UpgradeError: if a batch failed; all upgraded nodes
+            have then been rolled back.
+        """
+        previous = dict(self.stage.config.get('image_tags') or {})
+        upgraded = dict(previous, **self.tags)
+        hosts = [node.public_dns_name for node in self.nodes()]
+        self.prepull(hosts)
+
+        self._set_tags(upgraded)
+        done = []
+        for batch in batches(hosts, self.batch_size):
+            log.info("upgrading {0}".format(', '.join(batch)))
+            failed = self._apply(batch)
+            if failed:
+                self._set_tags(previous)
+                self.rollback(done + batch)
+                raise UpgradeError("upgrade failed on {0}; rolled back".format(
+                        ', '.join(sorted(failed))))
+            done.extend(batch)
+        return len(done)
+
+    def rollback(self, hosts):
+        """Put the previous images back on `hosts`, most recently
+        upgraded first and one batch at a time.  Failures are logged
+        but do not stop the rollback.
+        """
+        for batch in reversed(batches(hosts, self.batch_size)):
+            log.info("rolling back {0}".format(', '.join(batch)))
+            failed = self._apply(batch)
+            if failed:
+                log.error("rollback failed on {0}".format(
+                        ', '.join(sorted(failed))))
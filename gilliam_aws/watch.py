@@ -0,0 +1,118 @@
+# Copyright 2013 Johan Rydberg.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Watch a stage and report nodes as they change.
+
+Every poll does one filtered describe of the stage's instances and
+one batched describe of their status checks.  The previous snapshot
+is kept in memory and only nodes whose state, address, health or
+roles changed are reported.
+"""
+
+import datetime
+import json
+import time
+
+from .ec2 import AmazonWebServicesStage
+
+
+#: Fields that are compared between snapshots.
+FIELDS = ('host', 'state', 'health', 'roles', 'az')
+
+
+def _health(status):
+    """Combine the system and instance status checks into one word."""
+    checks = (status.system_status.status, status.instance_status.status)
+    for word in ('impaired', 'insufficient-data', 'initializing'):
+        if word in checks:
+            return word
+    if checks == ('ok', 'ok'):
+        return 'ok'
+    return 'not-applicable'
+
+
+def snapshot(conn, config, name):
+    """Return an `instance id -> fields` mapping for the stage."""
+    stage = AmazonWebServicesStage.get(conn, config, name)
+    if stage is None:
+        return {}
+    health = {}
+    ids = [node.id for node in stage.nodes]
+    if ids:
+        for status in conn.get_all_instance_status(
+                instance_ids=ids, include_all_instances=True):
+            health[status.id] = _health(status)
+    return dict((node.id, {
+                'host': node.public_dns_name,
+                'state': node.state,
+                'health': health.get(node.id, 'not-applicable'),
+                'roles': list(node.roles) + (['warm-pool'] if node.pooled
+                                             else []),
+                'az': node.placement,
+                }) for node in stage.nodes)
+
+
+def diff(previous, current):
+    """Compare two snapshots.
+
+    :returns: a list of `(event, id, fields, changed)` tuples where
+        event is `added`, `changed` or `removed` and changed names the
+        fields that differ.
+    """
+    events = []
+    for id, fields in sorted(current.items()):
+        if id not in previous:
+            events.append(('added', id, fields, list(FIELDS)))
+            continue
+        changed = [field for field in FIELDS
+                   if previous[id].get(field) != fields.get(field)]
+        if changed:
+            events.append(('changed', id, fields, changed))
+    for id in sorted(set(previous) - set(current)):
+        events.append(('removed', id, previous[id], []))
+    return events
+
+
+def format_text(timestamp, event, id, fields, changed):
+    return '{0} {1} {2} {3}'.format(
+        timestamp, event, id, ' '.join(
+            '{0}={1}{2}'.format(
+                field,
+                ','.join(fields[field]) if field == 'roles'
+                else fields[field],
+                '*' if field in changed and event == 'changed' else '')
+            for field in FIELDS))
+
+
+def format_json(timestamp, event, id, fields, changed):
+    record = dict(fields, time=timestamp, event=event, id=id,
+                  changed=changed)
+    return json.dumps(record, sort_keys=True)
+
+
+def watch(conn, config, name, emit, interval=5, sleep=time.sleep,
+          clock=datetime.datetime.utcnow):
+    """Poll the stage forever and call `emit(timestamp, event, id,
+    fields, changed)` for every change.  The first poll reports every
+    node as added.
+    """
+    previous = {}
+    while True:
+        current = snapshot(conn, config, name)
+        timestamp = clock().strftime('%Y-%m-%dT%H:%M:%SZ')
+        for event in diff(previous, current):
+            emit(timestamp, *event)
+        previous = current
+        sleep(interval)
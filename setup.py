@@ -32,12 +32,25 @@ setup(
     license="Apache 2.0",
     keywords="app platform",
     url="https://github.com/gilliam/",
-    install_requires=['boto', 'fabric', 'requests', 'gilliam-py', 'gilliam-cli'],
+    install_requires=['boto', 'fabric', 'requests', 'PyYAML', 'gilliam-py',
+                      'gilliam-cli'],
     entry_points={
         'gilliam.commands': [
             'aws create = gilliam_aws.commands:Create',
             'aws status = gilliam_aws.commands:Status',
             'aws destroy = gilliam_aws.commands:Destroy',
+            'aws stop = gilliam_aws.commands:Stop',
+            'aws start = gilliam_aws.commands:Start',
+            'aws images = gilliam_aws.commands:Images',
+            'aws autoscale = gilliam_aws.commands:Autoscale',
+            'aws scale = gilliam_aws.commands:Scale',
+            'aws pool = gilliam_aws.commands:Pool',
+            'aws exec = gilliam_aws.commands:Exec',
+            'aws push = gilliam_aws.commands:Push',
+            'aws reconfigure = gilliam_aws.commands:Reconfigure',
+            'aws upgrade = gilliam_aws.commands:Upgrade',
+            'aws apply = gilliam_aws.commands:Apply',
+            'aws netcheck = gilliam_aws.commands:NetCheck',
             ]
         },
 )
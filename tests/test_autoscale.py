@@ -0,0 +1,241 @@
+# Copyright 2013 Johan Rydberg.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import contextlib
+import unittest
+
+from gilliam_aws import services
+from gilliam_aws.autoscale import (Controller, DockerProbe, LoadProbe,
+                                   Policy, ProbeError, StageScaler)
+
+
+class Result(object):
+
+    def __init__(self, output, failed=False):
+        self.output = output
+        self.failed = failed
+
+
+class FakeConfigure(object):
+    """Answers `run_all` with the output queued for every host."""
+
+    def __init__(self, outputs=None):
+        self.outputs = outputs
+        self.host = None
+        self.stopped = []
+
+    def run_all(self, hosts, command, **kwargs):
+        return [self.outputs[host] for host in hosts]
+
+    @contextlib.contextmanager
+    def enter(self, host):
+        self.host = host
+        yield
+        self.host = None
+
+    def docker_stop(self, image):
+        self.stopped.append((self.host, image))
+
+
+class FakeProbe(object):
+
+    def __init__(self, loads):
+        self.loads = loads
+
+    def load(self, host):
+        load = self.loads[host]
+        if load is None:
+            raise ProbeError(host)
+        return load
+
+
+class Node(object):
+
+    def __init__(self, id, roles=('executor',)):
+        self.id = id
+        self.public_dns_name = id
+        self.roles = roles
+        self.state = 'running'
+
+
+class FakeStage(object):
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.removed = []
+
+    def refresh(self, conn):
+        pass
+
+    def nodes_with_role(self, role):
+        return list(self.nodes)
+
+    def remove_node(self, conn, node):
+        self.removed.append(node)
+        self.nodes.remove(node)
+
+
+class FakeScaler(object):
+
+    def __init__(self, nodes):
+        self._nodes = nodes
+        self.added = []
+        self.drained = []
+
+    def nodes(self):
+        return list(self._nodes)
+
+    def removable(self, node):
+        return node.roles == ('executor',)
+
+    def add(self, count):
+        self.added.append(count)
+
+    def drain(self, node):
+        self.drained.append(node)
+
+
+class LoadProbeTest(unittest.TestCase):
+
+    def test_counts_containers_except_excluded_images(self):
+        urls = []
+
+        def transport(url, timeout):
+            urls.append(url)
+            return [{'Image': 'app:1'}, {'Image': 'gilliam/proxy:2'},
+                    {'Image': 'worker'}]
+
+        probe = LoadProbe(9000, '/container', exclude=('gilliam/proxy',),
+                          transport=transport)
+        self.assertEqual(2, probe.load('node-1'))
+        self.assertEqual(['http://node-1:9000/container'], urls)
+
+    def test_transport_failure_is_a_probe_error(self):
+        def transport(url, timeout):
+            raise IOError('connection refused')
+
+        probe = LoadProbe(9000, '/container', transport=transport)
+        self.assertRaises(ProbeError, probe.load, 'node-1')
+
+
+class DockerProbeTest(unittest.TestCase):
+
+    def test_counts_containers_except_our_own(self):
+        configure = FakeConfigure({'node-1': Result(
+                    'gilliam/executor\ngilliam/proxy:1.2\napp:3\n')})
+        probe = DockerProbe(configure, command='docker ps')
+        self.assertEqual(1, probe.load('node-1'))
+
+    def test_unreachable_node_is_a_probe_error(self):
+        configure = FakeConfigure({'node-1': Result('timeout', True)})
+        probe = DockerProbe(configure, command='docker ps')
+        self.assertRaises(ProbeError, probe.load, 'node-1')
+
+
+class DrainTest(unittest.TestCase):
+
+    def setUp(self):
+        self.nodes = [Node('a'), Node('b'), Node('c')]
+        self.stage = FakeStage(list(self.nodes))
+        self.configure = FakeConfigure()
+        self.sleeps = 0
+
+    def drain(self, loads, moves=(), timeout=600):
+        """Drain node `c`; every sleep applies the next of the
+        `host -> load` updates in `moves`.
+        """
+        moves = list(moves)
+
+        def sleep(seconds):
+            self.sleeps += 1
+            loads.update(moves.pop(0) if moves else {})
+
+        scaler = StageScaler(None, self.stage, self.configure,
+                             probe=FakeProbe(loads), drain_timeout=timeout,
+                             sleep=sleep)
+        scaler.drain(self.nodes[2])
+
+    def test_waits_for_containers_to_be_rescheduled(self):
+        self.drain({'a': 3, 'b': 1, 'c': 2}, [{'a': 4}, {'b': 2}])
+        self.assertEqual([('c', services.EXECUTOR_IMAGE)],
+                         self.configure.stopped)
+        self.assertEqual(2, self.sleeps)
+        self.assertEqual([self.nodes[2]], self.stage.removed)
+
+    def test_empty_node_is_removed_right_away(self):
+        self.drain({'a': 3, 'b': 1, 'c': 0})
+        self.assertEqual(0, self.sleeps)
+        self.assertEqual([self.nodes[2]], self.stage.removed)
+
+    def test_gives_up_after_timeout(self):
+        self.drain({'a': 3, 'b': None, 'c': 2}, timeout=0)
+        self.assertEqual(0, self.sleeps)
+        self.assertEqual([self.nodes[2]], self.stage.removed)
+
+
+class ControllerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 10000.0
+
+    def controller(self, nodes, loads, **policy):
+        self.scaler = FakeScaler(nodes)
+        return Controller(self.scaler, FakeProbe(loads),
+                          Policy(10, target=0.5, **policy),
+                          clock=lambda: self.now)
+
+    def test_scales_up_to_the_desired_number_of_nodes(self):
+        controller = self.controller([Node('a')], {'a': 12})
+        self.assertEqual('up', controller.step())
+        self.assertEqual([2], self.scaler.added)
+
+    def test_unmeasured_nodes_count_as_full(self):
+        controller = self.controller([Node('a'), Node('b')],
+                                     {'a': 4, 'b': None})
+        self.assertEqual('up', controller.step())
+        self.assertEqual([1], self.scaler.added)
+
+    def test_scale_up_waits_for_cooldown(self):
+        controller = self.controller([Node('a')], {'a': 12},
+                                     scale_up_cooldown=300)
+        controller.step()
+        self.now += 100
+        self.assertEqual(None, controller.step())
+        self.now += 200
+        self.assertEqual('up', controller.step())
+        self.assertEqual([2, 2], self.scaler.added)
+
+    def test_drains_the_least_loaded_removable_node(self):
+        nodes = [Node('a', ('executor', 'router')), Node('b'), Node('c')]
+        controller = self.controller(nodes, {'a': 0, 'b': 3, 'c': 1})
+        self.assertEqual('down', controller.step())
+        self.assertEqual([nodes[2]], self.scaler.drained)
+
+    def test_never_drains_unmeasured_nodes(self):
+        nodes = [Node('a', ('executor', 'router')), Node('b')]
+        controller = self.controller(nodes, {'a': 0, 'b': None},
+                                     max_nodes=1)
+        self.assertEqual(None, controller.step())
+        self.assertEqual([], self.scaler.drained)
+
+    def test_steady_load_does_nothing(self):
+        controller = self.controller([Node('a'), Node('b')],
+                                     {'a': 5, 'b': 5})
+        self.assertEqual(None, controller.step())
+        self.assertEqual([], self.scaler.added + self.scaler.drained)
+
+
+if __name__ == '__main__':
+    unittest.main()
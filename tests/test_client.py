@@ -0,0 +1,147 @@
+# Copyright 2013 Johan Rydberg.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import threading
+import unittest
+
+from gilliam_aws import client
+from gilliam_aws.client import Client
+
+
+class EC2Error(Exception):
+
+    def __init__(self, status, error_code=None):
+        Exception.__init__(self, error_code or status)
+        self.status = status
+        self.error_code = error_code
+
+
+class FakeConnection(object):
+    """Fails every call with the queued errors, then succeeds."""
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def _call(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'ok'
+
+    def run_instances(self):
+        return self._call()
+
+    def get_all_instances(self):
+        return self._call()
+
+
+def _client(conn):
+    return Client(conn, sleep=lambda seconds: None)
+
+
+class RetryTest(unittest.TestCase):
+
+    def test_idempotent_action_is_retried_on_server_error(self):
+        conn = FakeConnection(EC2Error(503), EC2Error(500))
+        self.assertEqual('ok', _client(conn).get_all_instances())
+        self.assertEqual(3, conn.calls)
+
+    def test_mutating_action_is_not_retried_on_server_error(self):
+        conn = FakeConnection(EC2Error(503))
+        self.assertRaises(EC2Error, _client(conn).run_instances)
+        self.assertEqual(1, conn.calls)
+
+    def test_mutating_action_is_not_retried_on_timeout(self):
+        conn = FakeConnection(IOError('timed out'))
+        self.assertRaises(IOError, _client(conn).run_instances)
+        self.assertEqual(1, conn.calls)
+
+    def test_mutating_action_is_retried_when_throttled(self):
+        conn = FakeConnection(EC2Error(503, 'RequestLimitExceeded'))
+        self.assertEqual('ok', _client(conn).run_instances())
+        self.assertEqual(2, conn.calls)
+
+    def test_capacity_error_is_not_retried(self):
+        conn = FakeConnection(EC2Error(500, 'InsufficientInstanceCapacity'))
+        self.assertRaises(EC2Error, _client(conn).get_all_instances)
+        self.assertEqual(1, conn.calls)
+
+    def test_gives_up_after_max_attempts(self):
+        conn = FakeConnection(*[EC2Error(500)] * 10)
+        c = Client(conn, max_attempts=3, sleep=lambda seconds: None)
+        self.assertRaises(EC2Error, c.get_all_instances)
+        self.assertEqual(3, conn.calls)
+        self.assertEqual(2, c.stats()['get_all_instances'].retries)
+
+
+class ThreadConnectionTest(unittest.TestCase):
+
+    def connections_of_threads(self, c):
+        seen = []
+        thread = threading.Thread(target=lambda: seen.append(c.conn))
+        thread.start()
+        thread.join()
+        return [c.conn] + seen
+
+    def test_other_threads_get_connections_of_their_own(self):
+        made = []
+
+        def factory():
+            made.append(FakeConnection())
+            return made[-1]
+
+        conn = FakeConnection()
+        c = Client(conn, factory=factory)
+        connections = self.connections_of_threads(c)
+        self.assertEqual(1, len(made))
+        self.assertEqual([conn] + made, connections)
+
+    def test_connection_is_shared_without_factory(self):
+        conn = FakeConnection()
+        self.assertEqual([conn, conn],
+                         self.connections_of_threads(_client(conn)))
+
+    def test_reset_makes_a_new_connection(self):
+        conn, new = FakeConnection(), FakeConnection()
+        c = Client(conn, factory=lambda: new)
+        c.reset()
+        self.assertTrue(c.conn is new)
+
+
+class DumpStatsAtExitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registered = []
+        self._register = client.atexit.register
+        client.atexit.register = self.registered.append
+        self._clients = client._exit_clients[:]
+        del client._exit_clients[:]
+
+    def tearDown(self):
+        client.atexit.register = self._register
+        client._exit_clients[:] = self._clients
+
+    def test_registers_one_handler_for_all_clients(self):
+        first, second = _client(FakeConnection()), _client(FakeConnection())
+        first.dump_stats_at_exit()
+        first.dump_stats_at_exit()
+        second.dump_stats_at_exit()
+        self.assertEqual(1, len(self.registered))
+        self.assertEqual([first, second], client._exit_clients)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+# Copyright 2013 Johan Rydberg.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+import unittest
+
+from gilliam_aws.ec2 import launch_with_fallback
+
+
+class EC2Error(Exception):
+
+    def __init__(self, error_code):
+        Exception.__init__(self, error_code)
+        self.error_code = error_code
+
+
+class Instance(object):
+
+    def __init__(self, id):
+        self.id = id
+
+
+class FakeConnection(object):
+
+    def __init__(self):
+        self.terminated = []
+
+    def terminate_instances(self, ids):
+        self.terminated.extend(ids)
+
+
+def _launcher(outcomes):
+    """Return a launch function that answers every `(instance type,
+    zone)` with the instances or error given for it in `outcomes`.
+    """
+    def launch(instance_type, zone):
+        outcome = outcomes[instance_type, zone]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+    return launch
+
+
+class LaunchWithFallbackTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = FakeConnection()
+
+    def test_falls_back_on_capacity_errors(self):
+        instances = [Instance('i-1')]
+        launch = _launcher({
+                ('c3.large', 'a'): EC2Error('InsufficientInstanceCapacity'),
+                ('c3.large', 'b'): instances})
+        result, outcome = launch_with_fallback(
+            self.conn, launch, [('c3.large', 'a'), ('c3.large', 'b')])
+        self.assertEqual(instances, result)
+        self.assertEqual('b', outcome['zone'])
+        self.assertEqual([['c3.large', 'a', 'InsufficientInstanceCapacity']],
+                         outcome['attempts'])
+
+    def test_other_errors_are_raised(self):
+        launch = _launcher({('c3.large', 'a'): EC2Error('InvalidAMIID'),
+                            ('c3.large', 'b'): [Instance('i-1')]})
+        self.assertRaises(EC2Error, launch_with_fallback, self.conn, launch,
+                          [('c3.large', 'a'), ('c3.large', 'b')])
+
+    def test_race_keeps_the_winner_despite_other_errors(self):
+        instances = [Instance('i-1')]
+        launch = _launcher({('c3.large', 'a'): EC2Error('InvalidAMIID'),
+                            ('c3.large', 'b'): instances})
+        result, outcome = launch_with_fallback(
+            self.conn, launch, [('c3.large', 'a'), ('c3.large', 'b')],
+            race=2)
+        self.assertEqual(instances, result)
+        self.assertEqual([], self.conn.terminated)
+
+    def test_race_terminates_the_surplus(self):
+        launch = _launcher({('c3.large', 'a'): [Instance('i-1')],
+                            ('c3.large', 'b'): [Instance('i-2')]})
+        result, _ = launch_with_fallback(
+            self.conn, launch, [('c3.large', 'a'), ('c3.large', 'b')],
+            race=2)
+        self.assertEqual(1, len(result))
+        self.assertEqual([id for id in ('i-1', 'i-2')
+                          if id != result[0].id], self.conn.terminated)
+
+    def test_raises_last_capacity_error_when_all_fail(self):
+        error = EC2Error('InsufficientInstanceCapacity')
+        launch = _launcher({('c3.large', None): error})
+        try:
+            launch_with_fallback(self.conn, launch, [('c3.large', None)])
+        except EC2Error, e:
+            self.assertTrue(e is error)
+        else:
+            self.fail("no error raised")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+# Copyright 2013 Johan Rydberg.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Loading the command entry points must not load boto, fabric or any
+other dependency that only some commands need.
+"""
+
+import subprocess
+import sys
+import unittest
+
+
+#: Packages that must only be imported by the commands that use them.
+HEAVY = ('boto', 'fabric', 'paramiko', 'requests', 'yaml')
+
+_PROBE = """
+import sys
+for name in sys.argv[1:]:
+    __import__(name)
+print(' '.join(sorted(set(module.split('.')[0] for module in sys.modules))))
+"""
+
+#: Stands in for the parts of gilliam-cli that the commands import, so
+#: that what gilliam-cli itself loads does not count.
+_STUB_CLI = """
+import imp, sys
+cli = sys.modules['gilliam_cli'] = imp.new_module('gilliam_cli')
+command = sys.modules['gilliam_cli.command'] = imp.new_module(
+    'gilliam_cli.command')
+config = sys.modules['gilliam_cli.config'] = imp.new_module(
+    'gilliam_cli.config')
+cli.command, cli.config = command, config
+command.Command = command.ListerCommand = object
+config.StageConfig = object
+"""
+
+
+def _loaded(*names, **kwargs):
+    """Import `names` in a fresh interpreter and return the top-level
+    packages that ended up loaded.
+
+    :param stub_cli: stub out gilliam-cli first.
+    """
+    probe = (_STUB_CLI if kwargs.get('stub_cli') else '') + _PROBE
+    process = subprocess.Popen([sys.executable, '-c', probe] + list(names),
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    out, err = process.communicate()
+    if process.returncode != 0:
+        raise ImportError(err.decode('utf-8', 'replace'))
+    return set(out.decode('ascii').split())
+
+
+class LazyImportTest(unittest.TestCase):
+
+    def assertNothingHeavy(self, *names, **kwargs):
+        loaded = _loaded(*names, **kwargs)
+        self.assertEqual([], sorted(loaded.intersection(HEAVY)))
+
+    def test_commands(self):
+        self.assertNothingHeavy('gilliam_aws.commands', stub_cli=True)
+
+    def test_modules_loaded_by_commands(self):
+        self.assertNothingHeavy(
+            'gilliam_aws.ami', 'gilliam_aws.client', 'gilliam_aws.ec2',
+            'gilliam_aws.services', 'gilliam_aws.tuning')
+
+    def test_modules_imported_by_single_commands(self):
+        self.assertNothingHeavy(
+            'gilliam_aws.apply', 'gilliam_aws.autoscale',
+            'gilliam_aws.netcheck', 'gilliam_aws.preflight',
+            'gilliam_aws.reconfigure', 'gilliam_aws.upgrade',
+            'gilliam_aws.watch')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+# Copyright 2013 Johan Rydberg.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+import itertools
+import unittest
+
+from gilliam_aws import netcheck
+
+
+class Node(object):
+
+    def __init__(self, id):
+        self.id = id
+
+    def __repr__(self):
+        return self.id
+
+
+def _nodes(count):
+    return [Node('n{0}'.format(i)) for i in range(count)]
+
+
+class ScheduleTest(unittest.TestCase):
+
+    def test_every_ordered_pair_once(self):
+        for count in range(1, 8):
+            nodes = _nodes(count)
+            pairs = [pair for pairs in netcheck.schedule(nodes)
+                     for pair in pairs]
+            self.assertEqual(sorted(itertools.permutations(nodes, 2)),
+                             sorted(pairs))
+
+    def test_node_in_at_most_one_pair_per_round(self):
+        for count in range(2, 8):
+            for pairs in netcheck.schedule(_nodes(count)):
+                members = [node for pair in pairs for node in pair]
+                self.assertEqual(len(members), len(set(members)))
+
+
+class MeasureTest(unittest.TestCase):
+
+    def test_measures_every_direction_over_loopback(self):
+        nodes = _nodes(3)
+        matrix = netcheck.measure(
+            nodes, netcheck.LocalTransport(payload=1 << 20))
+        for source, target in itertools.permutations(nodes, 2):
+            cell = matrix[source.id][target.id]
+            self.assertTrue(cell['latency'] >= 0)
+            self.assertTrue(cell['throughput'] > 0)
+        for node in nodes:
+            self.assertFalse(node.id in matrix[node.id])
+
+
+def _cell(latency, throughput):
+    return {'latency': latency, 'throughput': throughput}
+
+
+class OutliersTest(unittest.TestCase):
+
+    matrix = {
+        'a': {'b': _cell(1.0, 900.0), 'c': _cell(1.1, 950.0)},
+        'b': {'a': _cell(1.0, 920.0), 'c': _cell(5.0, 910.0)},
+        'c': {'a': _cell(0.9, 100.0), 'b': _cell(None, None)},
+        }
+
+    def test_compares_to_the_median(self):
+        self.assertEqual([('b', 'c', 'latency'),
+                          ('c', 'a', 'throughput'),
+                          ('c', 'b', 'unreachable')],
+                         netcheck.outliers(self.matrix))
+
+    def test_compares_to_a_baseline(self):
+        self.assertEqual([('a', 'c', 'latency'),
+                          ('b', 'c', 'latency'),
+                          ('c', 'a', 'throughput'),
+                          ('c', 'b', 'unreachable')],
+                         netcheck.outliers(self.matrix, max_latency=1.05,
+                                           min_throughput=500.0))
+
+
+if __name__ == '__main__':
+    unittest.main()
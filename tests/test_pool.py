@@ -0,0 +1,233 @@
+# Copyright 2013 Johan Rydberg.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+import contextlib
+import unittest
+
+from gilliam_aws import pool
+from gilliam_aws.ec2 import Node, WARM_POOL_TAG
+from gilliam_aws.pool import WarmPool
+
+
+class FakeEC2(object):
+    """Instance states and pool tags as EC2 sees them."""
+
+    def __init__(self):
+        self.instances = {}
+        self.launched = 0
+
+    def launch(self, count):
+        ids = []
+        for _ in range(count):
+            self.launched += 1
+            id = 'i-{0}'.format(self.launched)
+            self.instances[id] = {'state': 'running', 'pooled': False}
+            ids.append(id)
+        return ids
+
+    def create_tags(self, ids, tags):
+        for id in ids:
+            self.instances[id]['pooled'] = WARM_POOL_TAG in tags
+
+    def delete_tags(self, ids, tags):
+        for id in ids:
+            if WARM_POOL_TAG in tags:
+                self.instances[id]['pooled'] = False
+
+
+class FakeStage(object):
+    """Builds its nodes from `FakeEC2` whenever it is reloaded, like
+    :class:`gilliam_aws.ec2.AmazonWebServicesStage` does.
+    """
+
+    name = 'test'
+
+    def __init__(self, ec2, data_volume=None):
+        self.ec2 = ec2
+        self.config = {}
+        self.nodes = []
+        self._data_volume = data_volume
+
+    def reload(self, conn):
+        self.nodes = [Node(id, id, id, '10.0.0.1', state['state'], 'zone',
+                           None, 'm1.small', ('executor',), state['pooled'])
+                      for id, state in sorted(self.ec2.instances.items())]
+
+    refresh = reload
+
+    def add_nodes(self, conn, groups, count=1, zone=None):
+        ids = self.ec2.launch(count)
+        self.reload(conn)
+        return [self.node(id) for id in ids]
+
+    def start_nodes(self, conn, nodes):
+        for node in nodes:
+            self.ec2.instances[node.id]['state'] = 'running'
+
+    def stop_nodes(self, conn, nodes, wait=False):
+        for node in nodes:
+            self.ec2.instances[node.id]['state'] = 'stopped'
+
+    def pool_nodes(self):
+        return [node for node in self.nodes if node.pooled]
+
+    def node(self, id):
+        return [node for node in self.nodes if node.id == id][0]
+
+    def data_volume(self, node):
+        return self._data_volume
+
+
+class FakeConfigure(object):
+
+    def __init__(self):
+        self.pulled = []
+        self.configured = []
+        self.entered = []
+        self.remounted = []
+
+    @contextlib.contextmanager
+    def configure(self, host, storage=None):
+        self.configured.append(host)
+        yield
+
+    @contextlib.contextmanager
+    def enter(self, host):
+        self.entered.append(host)
+        yield
+
+    def docker_pull(self, image):
+        self.pulled.append(image)
+
+    def remount(self, storage):
+        self.remounted.append(storage)
+
+
+class FakeProcess(object):
+
+    started = []
+
+    def __init__(self, target):
+        self.target = target
+        self.alive = False
+
+    def start(self):
+        self.alive = True
+        self.started.append(self)
+
+    def is_alive(self):
+        return self.alive
+
+    def join(self):
+        self.alive = False
+
+
+class WarmPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.started = []
+        self.tuned = []
+        self._patched = (pool.services.docker_storage,
+                         pool.services.start_services, pool.services.tune)
+        pool.services.docker_storage = lambda stage, node: None
+        pool.services.tune = (
+            lambda stage, node, configure: self.tuned.append(node.id))
+        pool.services.start_services = (
+            lambda stage, node, configure: self.started.append(node.id))
+        self._process = pool.multiprocessing.Process, pool.atexit.register
+        self.at_exit = []
+        pool.multiprocessing.Process = FakeProcess
+        pool.atexit.register = self.at_exit.append
+        del FakeProcess.started[:]
+        self.ec2 = FakeEC2()
+        self.configure = FakeConfigure()
+
+    def tearDown(self):
+        (pool.services.docker_storage, pool.services.start_services,
+         pool.services.tune) = self._patched
+        pool.multiprocessing.Process, pool.atexit.register = self._process
+
+    def pool(self, size, data_volume=None):
+        stage = FakeStage(self.ec2, data_volume)
+        return WarmPool(self.ec2, stage, self.configure, size)
+
+    def pooled(self, state):
+        return sorted(id for id, instance in self.ec2.instances.items()
+                      if instance['pooled'] and instance['state'] == state)
+
+    def test_top_up_launches_and_stops_missing_nodes(self):
+        nodes = self.pool(2).top_up()
+        self.assertEqual(['i-1', 'i-2'], [node.id for node in nodes])
+        self.assertEqual(['i-1', 'i-2'], self.pooled('stopped'))
+        self.assertEqual(['i-1', 'i-2'], self.tuned)
+        self.assertEqual([], self.configure.entered)
+
+    def test_top_up_counts_nodes_added_by_others(self):
+        self.pool(1).top_up()
+        # A second pool object has not seen i-1 yet.
+        nodes = self.pool(2).top_up()
+        self.assertEqual(['i-2'], [node.id for node in nodes])
+
+    def test_top_up_is_idempotent(self):
+        warm_pool = self.pool(2)
+        warm_pool.top_up()
+        self.assertEqual([], warm_pool.top_up())
+        self.assertEqual(2, self.ec2.launched)
+
+    def test_take_starts_a_node_and_top_up_replaces_it(self):
+        self.pool(2).top_up()
+        warm_pool = self.pool(2)
+        node = warm_pool.take()
+        self.assertEqual('i-1', node.id)
+        self.assertEqual('running', node.state)
+        self.assertFalse(node.pooled)
+        self.assertEqual(['i-1'], self.started)
+        self.assertEqual(['i-1'], self.configure.entered)
+        self.assertEqual(['i-2'], self.pooled('stopped'))
+        self.assertEqual(['i-3'], [n.id for n in warm_pool.top_up()])
+
+    def test_take_from_empty_pool(self):
+        self.assertEqual(None, self.pool(2).take())
+        self.assertEqual(0, self.ec2.launched)
+
+    def test_one_background_top_up_at_a_time(self):
+        warm_pool = self.pool(2)
+        first = warm_pool.top_up_in_background()
+        self.assertTrue(warm_pool.top_up_in_background() is first)
+        first.join()
+        second = warm_pool.top_up_in_background()
+        self.assertFalse(second is first)
+        self.assertEqual([first, second], FakeProcess.started)
+        self.assertEqual(1, len(self.at_exit))
+
+    def test_take_sets_up_ephemeral_storage_again(self):
+        warm_pool = self.pool(1, data_volume=('ephemeral', None, None))
+        warm_pool.top_up()
+        del self.configure.configured[:]
+        warm_pool.take()
+        self.assertEqual([], self.configure.configured)
+        self.assertEqual(['i-1'], self.configure.entered)
+        self.assertEqual(1, len(self.configure.remounted))
+
+    def test_take_leaves_persistent_storage_alone(self):
+        warm_pool = self.pool(1)
+        warm_pool.top_up()
+        warm_pool.take()
+        self.assertEqual([], self.configure.remounted)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,175 @@
+# Copyright 2013 Johan Rydberg.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+import shutil
+import tempfile
+import unittest
+
+from gilliam_aws import preflight
+from gilliam_aws.preflight import Preflight, parse_image
+
+
+class Attribute(object):
+
+    def __init__(self, value):
+        self.attribute_values = [value]
+
+
+class Reservation(object):
+
+    def __init__(self, count):
+        self.instances = [object()] * count
+
+
+class Group(object):
+
+    def __init__(self, name):
+        self.name = name
+
+
+class StubConnection(object):
+    """Answers every API call a pre-flight check makes."""
+
+    def __init__(self, zones=('eu-west-1a',), images=('ami-1',),
+                 max_instances=20, running=0, key_pairs=(), groups=0):
+        self.zones = list(zones)
+        self.images = list(images)
+        self.max_instances = max_instances
+        self.running = running
+        self.key_pairs = list(key_pairs)
+        self.groups = [Group('other-{0}'.format(i)) for i in range(groups)]
+
+    def get_all_zones(self):
+        return self.zones
+
+    def get_all_images(self, image_ids):
+        return [image for image in image_ids if image in self.images]
+
+    def describe_account_attributes(self, names):
+        return [Attribute(str(self.max_instances))]
+
+    def get_all_instances(self, filters=None):
+        return [Reservation(self.running)]
+
+    def get_all_key_pairs(self, filters=None):
+        return self.key_pairs
+
+    def get_all_security_groups(self):
+        return self.groups
+
+
+CONFIG = {'aws_region': 'eu-west-1', 'aws_ec2_ami': 'ami-1',
+          'aws_ec2_executors': '3',
+          'aws_ec2_instance_type': 'executor=c3.xlarge'}
+
+
+class PreflightTest(unittest.TestCase):
+
+    def setUp(self):
+        self.key_dir = tempfile.mkdtemp()
+        self._key_dir = preflight.KEY_DIR
+        preflight.KEY_DIR = self.key_dir
+        self.urls = []
+        self.statuses = {}
+
+    def tearDown(self):
+        preflight.KEY_DIR = self._key_dir
+        shutil.rmtree(self.key_dir)
+
+    def transport(self, url, timeout):
+        self.urls.append(url)
+        return self.statuses.get(url, 200)
+
+    def run_checks(self, conn, **kwargs):
+        return Preflight(conn, CONFIG, 'test', transport=self.transport,
+                         **kwargs).run()
+
+    def failed(self, results):
+        return dict((name, error) for name, error in results.items()
+                    if error is not None)
+
+    def test_all_checks_pass(self):
+        results = self.run_checks(StubConnection(), images=['gilliam/proxy'],
+                                  repository='registry.example.com/team')
+        self.assertEqual(['ami', 'credentials', 'images', 'key-pair',
+                          'quota', 'repository', 'security-groups'],
+                         list(results))
+        self.assertEqual({}, self.failed(results))
+        self.assertEqual(
+            ['https://registry-1.docker.io/v2/gilliam/proxy/manifests/latest',
+             'https://registry.example.com/v2/'], sorted(self.urls))
+
+    def test_every_problem_is_reported(self):
+        conn = StubConnection(zones=(), images=(), max_instances=2,
+                              groups=preflight.SECURITY_GROUP_LIMIT)
+        failed = self.failed(self.run_checks(conn))
+        self.assertEqual(['ami', 'credentials', 'quota', 'security-groups'],
+                         sorted(failed))
+
+    def test_quota_error_tells_about_vcpus(self):
+        conn = StubConnection(max_instances=4, running=2)
+        error = self.failed(self.run_checks(conn))['quota']
+        self.assertTrue(error.startswith(
+                "3 instances needed but only 2 of 4 left"))
+        self.assertTrue('12 vCPUs' in error)
+
+    def test_key_pair_without_key_file(self):
+        conn = StubConnection(key_pairs=['test'])
+        self.assertTrue('missing' in self.failed(
+                self.run_checks(conn))['key-pair'])
+
+    def test_missing_image(self):
+        url = 'https://registry.example.com:5000/v2/app/manifests/1.2'
+        self.statuses[url] = 404
+        image = 'registry.example.com:5000/app:1.2'
+        failed = self.failed(self.run_checks(StubConnection(),
+                                             images=[image]))
+        self.assertEqual({'images': "image registry.example.com:5000/app:1.2 "
+                          "does not exist"}, failed)
+
+    def test_unexpected_status_is_only_a_warning(self):
+        url = 'https://registry-1.docker.io/v2/library/ubuntu/manifests/14.04'
+        self.statuses[url] = 503
+        self.assertEqual({}, self.failed(self.run_checks(
+                    StubConnection(), images=['ubuntu:14.04'])))
+
+    def test_unreachable_registry(self):
+        def transport(url, timeout):
+            raise IOError('connection refused')
+
+        results = Preflight(StubConnection(), CONFIG, 'test',
+                            images=['gilliam/proxy'],
+                            transport=transport).run()
+        self.assertTrue('connection refused' in results['images'])
+
+
+class ParseImageTest(unittest.TestCase):
+
+    def test_docker_hub(self):
+        self.assertEqual(('registry-1.docker.io', 'gilliam/proxy', '1.0'),
+                         parse_image('gilliam/proxy:1.0'))
+        self.assertEqual(('registry-1.docker.io', 'library/ubuntu', 'latest'),
+                         parse_image('ubuntu'))
+
+    def test_registry_with_port(self):
+        self.assertEqual(('localhost:5000', 'team/app', 'latest'),
+                         parse_image('localhost:5000/team/app'))
+        self.assertEqual(('registry.example.com:5000', 'app', '2'),
+                         parse_image('registry.example.com:5000/app:2'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+# Copyright 2013 Johan Rydberg.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+import unittest
+
+from gilliam_aws import tuning
+
+
+class ParseSysctlTest(unittest.TestCase):
+
+    def test_parses_key_value_lines(self):
+        output = ('net.core.somaxconn = 4096\n'
+                  'net.ipv4.ip_local_port_range = 1024\t65535\n')
+        self.assertEqual({'net.core.somaxconn': '4096',
+                          'net.ipv4.ip_local_port_range': '1024\t65535'},
+                         tuning.parse_sysctl(output))
+
+    def test_missing_key_does_not_shift_values(self):
+        output = ('fs.file-max = 1048576\n'
+                  'sysctl: cannot stat /proc/sys/net/netfilter/'
+                  'nf_conntrack_max: No such file or directory\n'
+                  'net.core.somaxconn = 4096\n')
+        values = tuning.parse_sysctl(output)
+        self.assertEqual('4096', values['net.core.somaxconn'])
+        drift = tuning.drift('executor', values)
+        self.assertEqual([('net.ipv4.ip_local_port_range', '10000 65535',
+                           None),
+                          ('net.netfilter.nf_conntrack_max', '262144',
+                           None)], drift)
+
+
+class ProfileTest(unittest.TestCase):
+
+    #: Ports that nodes of a stage listen on.
+    SERVICE_PORTS = (3000, 3222, 3223, 5201, 8080, 9000, 9001)
+
+    def test_local_ports_stay_clear_of_service_ports(self):
+        for name, (settings, _) in tuning.PROFILES.items():
+            value = settings.get('net.ipv4.ip_local_port_range')
+            if value is None:
+                continue
+            low, high = [int(port) for port in value.split()]
+            for port in self.SERVICE_PORTS:
+                self.assertFalse(low <= port <= high, (name, port))
+
+    def test_conntrack_module_is_loaded_for_its_settings(self):
+        self.assertEqual(['nf_conntrack'], tuning.modules('proxy'))
+        self.assertEqual(['nf_conntrack'], tuning.modules('executor'))
+        self.assertEqual([], tuning.modules('none'))
+
+
+if __name__ == '__main__':
+    unittest.main()